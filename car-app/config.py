@@ -49,3 +49,6 @@ RABBITMQ_PORT = 1883
 RABBITMQ_TOPIC = "xebikart-events"
 RABBITMQ_MODES_TOPIC = "xebikart-modes"
 RABBITMQ_VIDEO_TOPIC = "xebikart-car-video"
+# telemetry published while the broker is unreachable is kept on disk, None to disable
+MQTT_SPOOL_PATH = os.path.join(DATA_PATH, "mqtt.spool")
+MQTT_SPOOL_SIZE = 16 * 1024 * 1024
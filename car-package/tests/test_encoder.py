@@ -0,0 +1,116 @@
+"""
+BatchedVAEEncoder gives the latent vectors of `Model.predict`, and never leaves a caller waiting.
+
+    cd car-package && python -m unittest discover tests
+"""
+
+import threading
+import types
+import unittest
+
+import numpy as np
+
+try:
+    import tensorflow
+except ImportError:
+    tensorflow = None
+
+from xebikart.gym.envs.encoder import BatchedVAEEncoder
+
+
+class FailingEncoder(BatchedVAEEncoder):
+    """
+    Encoder whose compiled function raises, without tensorflow.
+    """
+    def _build_encode_fn(self):
+        def encode_fn(inputs):
+            raise ValueError("encoding failed")
+        return encode_fn
+
+
+def fake_vae(input_shape=(4, 4, 2), z_size=3):
+    return types.SimpleNamespace(input_shape=(None,) + input_shape, output_shape=(None, z_size))
+
+
+class TestBatchedVAEEncoderErrors(unittest.TestCase):
+    def test_leader_error(self):
+        # followers join the batch of the leader while it waits, the leader then fails for all of them
+        encoder = FailingEncoder(fake_vae(), max_batch_size=64, max_delay=0.2)
+        errors = []
+
+        def encode():
+            try:
+                encoder.encode_one(np.zeros((4, 4, 2)))
+            except ValueError as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=encode, daemon=True) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5.)
+        self.assertFalse(any(thread.is_alive() for thread in threads), "a caller is still waiting")
+        self.assertEqual(len(errors), len(threads))
+        self.assertEqual(encoder.pending, [])
+
+    def test_full_batch_error(self):
+        # a full batch wakes up the leader before max_delay
+        encoder = FailingEncoder(fake_vae(), max_batch_size=2, max_delay=10.)
+        errors = []
+
+        def encode():
+            try:
+                encoder.encode_one(np.zeros((4, 4, 2)))
+            except ValueError as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=encode, daemon=True) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5.)
+        self.assertEqual(len(errors), 2)
+
+
+@unittest.skipIf(tensorflow is None, "tensorflow is not installed")
+class TestBatchedVAEEncoder(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        from tensorflow.keras.models import Model
+        from xebikart.vae import create_variational_auto_encoder
+
+        # deterministic part of an untrained encoder, the latent mean
+        encoder = create_variational_auto_encoder((80, 160, 2), 32).get_layer("encoder")
+        cls.vae = Model(encoder.inputs, encoder.outputs[0])
+        rng = np.random.RandomState(0)
+        cls.observations = (rng.rand(5, 80, 160, 2) > 0.5).astype(np.float32) * 255.
+
+    def test_encode_one(self):
+        encoder = BatchedVAEEncoder(self.vae)
+        for observation in self.observations:
+            expected = self.vae.predict(np.expand_dims(observation / 255., 0))[0]
+            np.testing.assert_allclose(encoder.encode_one(observation), expected, rtol=1e-4, atol=1e-5)
+
+    def test_encode(self):
+        encoder = BatchedVAEEncoder(self.vae, max_batch_size=2)
+        np.testing.assert_allclose(encoder.encode(self.observations), self.vae.predict(self.observations / 255.),
+                                   rtol=1e-4, atol=1e-5)
+
+    def test_concurrent_encode_one(self):
+        encoder = BatchedVAEEncoder(self.vae, max_delay=0.1)
+        latents = [None] * len(self.observations)
+
+        def encode(index):
+            latents[index] = encoder.encode_one(self.observations[index])
+
+        threads = [threading.Thread(target=encode, args=(index,)) for index in range(len(self.observations))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        np.testing.assert_allclose(np.stack(latents), self.vae.predict(self.observations / 255.),
+                                   rtol=1e-4, atol=1e-5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+"""
+RemoteModeMQTTSubscriber returns the latest command received since the previous run.
+
+    cd car-package && python -m unittest discover tests
+"""
+
+import json
+import unittest
+from collections import namedtuple
+
+from xebikart.parts.mqtt import RemoteModeMQTTSubscriber
+
+MQTTMessage = namedtuple("MQTTMessage", ["topic", "payload"])
+
+
+class FakeConnection(object):
+    def acquire(self):
+        return self
+
+    def release(self):
+        pass
+
+    def subscribe(self, topic, callback):
+        pass
+
+    def unsubscribe(self, topic, callback):
+        pass
+
+
+class TestRemoteModeMQTTSubscriber(unittest.TestCase):
+    def setUp(self):
+        self.subscriber = RemoteModeMQTTSubscriber(1, None, "xebikart-car-remote", connection=FakeConnection())
+
+    def send(self, sub_topic, payload):
+        topic = "xebikart-car-remote/cars/1" + sub_topic
+        self.subscriber.on_message(None, None, MQTTMessage(topic, payload))
+
+    def test_last_wins(self):
+        self.send("/stop", b"")
+        self.send("", json.dumps({"mode": "ai_v2_mode"}).encode())
+        self.assertEqual(self.subscriber.run(), "ai_v2_mode")
+        self.assertEqual(self.subscriber.run(), "")
+
+        self.send("/mode", b"user")
+        self.send("/stop", b"")
+        self.assertEqual(self.subscriber.run(), "stop")
+
+        self.send("", json.dumps({"mode": "ai_v2_mode"}).encode())
+        self.send("", json.dumps({"mode": "stop"}).encode())
+        self.assertEqual(self.subscriber.run(), "stop")
+
+    def test_shared_topic(self):
+        self.send("", b"user")
+        message = {"mode": "stop", "data": {"carId": 1}}
+        self.subscriber.on_shared_message(None, None, MQTTMessage("xebikart-car-remote", json.dumps(message).encode()))
+        self.assertEqual(self.subscriber.run(), "stop")
+        # other sub-topics and cars are ignored
+        self.send("/telemetry", b"user")
+        message = {"mode": "user", "data": {"carId": 2}}
+        self.subscriber.on_shared_message(None, None, MQTTMessage("xebikart-car-remote", json.dumps(message).encode()))
+        self.assertEqual(self.subscriber.run(), "")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+"""
+ReplayBuffer rebuilds the stacked observations of FrameStack from the frames it stores.
+
+    cd car-package && python -m unittest discover tests
+"""
+
+import tempfile
+import unittest
+
+import numpy as np
+
+from xebikart.gym.replay_buffer import ReplayBuffer
+
+
+def episodes(lengths, frame_shape, num_stack, seed=0):
+    """
+    Transitions with the observations of FrameStack, the first frame of an episode is repeated.
+
+    :return: ([tuple]) observation, action, reward, next_observation, done
+    """
+    rng = np.random.RandomState(seed)
+    transitions = []
+    for length in lengths:
+        frames = [rng.randint(0, 256, size=frame_shape).astype(np.float32) / 255.]
+        for step in range(length):
+            frames.append(rng.randint(0, 256, size=frame_shape).astype(np.float32) / 255.)
+            stacks = [np.stack([frames[max(i, 0)] for i in range(end - num_stack, end)])
+                      for end in (len(frames) - 1, len(frames))]
+            transitions.append((stacks[0], rng.rand(2), float(len(transitions)), stacks[1], step == length - 1))
+    return transitions
+
+
+class TestFrameStackReplayBuffer(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = self.directory.name
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def assertSamples(self, buffer, transitions):
+        observations, actions, rewards, next_observations, dones = buffer.sample(200)
+        for observation, reward, next_observation, done in zip(observations, rewards, next_observations, dones):
+            # rewards are the index of the transitions
+            expected = transitions[int(reward)]
+            np.testing.assert_allclose(observation, expected[0], atol=1e-6)
+            np.testing.assert_allclose(next_observation, expected[3], atol=1e-6)
+            self.assertEqual(bool(done), expected[4])
+
+    def test_episodes(self):
+        transitions = episodes([1, 2, 7, 3], (3, 2), num_stack=4)
+        buffer = ReplayBuffer(self.path, 100, (4, 3, 2), (2,), storage_dtype=np.uint8, frame_stack=4, seed=0)
+        for transition in transitions:
+            buffer.add(*transition)
+        self.assertEqual(buffer.arrays["observations"].shape, (100, 3, 2))
+        self.assertSamples(buffer, transitions)
+
+        buffer.close()
+        buffer = ReplayBuffer.open(self.path, seed=1)
+        self.assertEqual(buffer.frame_stack, 4)
+        self.assertSamples(buffer, transitions)
+
+    def test_overwritten_frames(self):
+        # the oldest transitions left refer to overwritten frames, they are only checked for their own frame
+        transitions = episodes([30], (3, 2), num_stack=4)
+        buffer = ReplayBuffer(self.path, 8, (4, 3, 2), (2,), storage_dtype=np.uint8, frame_stack=4, seed=0)
+        for transition in transitions:
+            buffer.add(*transition)
+        observations, actions, rewards, next_observations, dones = buffer.sample(200)
+        oldest = len(transitions) - 8
+        for observation, reward, next_observation in zip(observations, rewards, next_observations):
+            expected = transitions[int(reward)]
+            kept = min(int(reward) - oldest + 1, 4)
+            np.testing.assert_allclose(observation[-kept:], expected[0][-kept:], atol=1e-6)
+            np.testing.assert_allclose(next_observation[-1], expected[3][-1], atol=1e-6)
+            np.testing.assert_allclose(observation[:-kept], np.repeat(observation[-kept][None], 4 - kept, 0))
+
+    def test_extend(self):
+        buffer = ReplayBuffer(self.path, 8, (4, 3, 2), (2,), frame_stack=4)
+        with self.assertRaises(ValueError):
+            buffer.extend(np.zeros((2, 4, 3, 2)), np.zeros((2, 2)), np.zeros(2), np.zeros((2, 4, 3, 2)), [0, 0])
+        with self.assertRaises(ValueError):
+            ReplayBuffer(self.path, 8, (3, 2), (2,), frame_stack=4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,166 @@
+"""
+Benchmarks of the simulator client, on a replayed telemetry capture.
+
+A capture is a file of newline delimited messages, as sent by the simulator.
+Without capture, synthetic telemetry messages with a random image of the same size are used.
+
+    python -m xebikart.gym.benchmark transport --capture telemetry.jsonl
+    python -m xebikart.gym.benchmark parse --capture telemetry.jsonl --decode-image
+"""
+
+import argparse
+import base64
+import json
+import os
+import socket
+import threading
+import time
+
+from xebikart.gym.core.telemetry import replace_float_notation, parse_message, decode_image
+from xebikart.gym.core.transport import IMesgHandler, SimTransport
+
+
+def load_capture(path):
+    """
+    :param path: (str) newline delimited messages
+    :return: ([bytes])
+    """
+    with open(path, "rb") as f:
+        return [line.strip() for line in f if len(line.strip()) > 0]
+
+
+def synthetic_telemetry(n_messages=200, image_size=15000, comma_decimal=False):
+    """
+    :param image_size: (int) size of the jpeg in bytes, the base64 image is a third larger
+    :param comma_decimal: (bool) numbers with a comma as decimal separator, like a sim on a french locale
+    :return: ([bytes])
+    """
+    image = base64.b64encode(os.urandom(image_size)).decode()
+    messages = []
+    for i in range(n_messages):
+        message = json.dumps({
+            "msg_type": "telemetry", "steering_angle": 0.1, "throttle": 0.3, "speed": 1.5 + i * 1e-3,
+            "image": image, "hit": "none", "pos_x": 10.25, "pos_y": 0.5, "pos_z": -3.75 - i * 1e-3,
+            "time": 1.5 + i * 0.05, "cte": -0.125
+        }, separators=(",", ":"))
+        if comma_decimal:
+            # unity writes unquoted numbers with the locale decimal separator
+            for key in ("steering_angle", "throttle", "speed", "pos_x", "pos_y", "pos_z", "time", "cte"):
+                start = message.index('"%s":' % key) + len(key) + 3
+                end = start
+                while message[end] not in ",}":
+                    end += 1
+                message = message[:start] + message[start:end].replace(".", ",") + message[end:]
+        messages.append(message.encode())
+    return messages
+
+
+class CountingHandler(IMesgHandler):
+    def __init__(self, expected):
+        self.expected = expected
+        self.received = 0
+        self.done = threading.Event()
+
+    def on_recv_message(self, message):
+        self.received += 1
+        if self.received >= self.expected:
+            self.done.set()
+
+
+def _start_asyncore_server(address, handler):
+    import asyncore
+    from xebikart.gym.core.tcp_server import SimServer
+
+    server = SimServer(address, handler)
+    running = threading.Event()
+    running.set()
+
+    def loop():
+        while running.is_set():
+            asyncore.loop(timeout=0.05, count=1)
+    thread = threading.Thread(target=loop, daemon=True)
+    thread.start()
+
+    def close():
+        # sockets are closed outside of the loop, select() fails on a closed socket
+        running.clear()
+        thread.join()
+        server.handle_close()
+    return server.address, close
+
+
+def _start_selectors_server(address, handler):
+    transport = SimTransport(address, handler)
+    return transport.address, transport.close
+
+
+def benchmark_transport(messages, server="selectors", repeat=10, write_size=16 * 1024):
+    """
+    Send the messages `repeat` times to the server, by chunks of `write_size` bytes,
+    and measure how fast they are parsed.
+
+    :param server: (str) "selectors" or "asyncore" (legacy)
+    :return: (float, float) messages per second, MB per second
+    """
+    data = b"\n".join(messages * repeat) + b"\n"
+    handler = CountingHandler(len(messages) * repeat)
+    start_server = _start_selectors_server if server == "selectors" else _start_asyncore_server
+    address, close = start_server(("127.0.0.1", 0), handler)
+
+    client = socket.create_connection(address)
+    start_time = time.perf_counter()
+    for i in range(0, len(data), write_size):
+        client.sendall(data[i:i + write_size])
+    handler.done.wait(300.)
+    elapsed = time.perf_counter() - start_time
+    client.close()
+    close()
+    return handler.received / elapsed, len(data) / elapsed / 1e6
+
+
+def legacy_parse_message(data):
+    """
+    Parsing of the asyncore server, kept as reference.
+    """
+    return json.loads(replace_float_notation(data.decode("utf-8")))
+
+
+def benchmark_parse(messages, parser="fast", decode=False, repeat=10):
+    """
+    :param parser: (str) "fast" or "legacy"
+    :param decode: (bool) decode the jpeg images too
+    :return: (float) messages per second
+    """
+    parse = parse_message if parser == "fast" else legacy_parse_message
+    start_time = time.perf_counter()
+    for _ in range(repeat):
+        for data in messages:
+            message = parse(data)
+            if decode and "image" in message:
+                decode_image(message["image"])
+    return len(messages) * repeat / (time.perf_counter() - start_time)
+
+
+def main(args):
+    messages = load_capture(args.capture) if args.capture else synthetic_telemetry(comma_decimal=args.comma_decimal)
+    print("%d messages, %.1f KB on average" % (len(messages), sum(map(len, messages)) / len(messages) / 1e3))
+    if args.benchmark == "transport":
+        for server in args.servers:
+            messages_per_second, mb_per_second = benchmark_transport(messages, server=server, repeat=args.repeat)
+            print("{:<10} {:>10.0f} messages/s {:>8.1f} MB/s".format(server, messages_per_second, mb_per_second))
+    elif args.benchmark == "parse":
+        for parser in ("legacy", "fast"):
+            messages_per_second = benchmark_parse(messages, parser=parser, decode=args.decode_image, repeat=args.repeat)
+            print("{:<10} {:>10.0f} messages/s".format(parser, messages_per_second))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("benchmark", choices=["transport", "parse"])
+    parser.add_argument("--capture", help="file of newline delimited simulator messages")
+    parser.add_argument("--comma-decimal", action="store_true", help="synthetic messages with comma decimals")
+    parser.add_argument("--decode-image", action="store_true",
+                        help="include jpeg decoding, the synthetic image is random bytes and can not be decoded")
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--servers", nargs="+", default=["asyncore", "selectors"])
+    main(parser.parse_args())
@@ -36,6 +36,12 @@ class DonkeyUnityProcess(object):
 
         print("Donkey subprocess started")
 
+    def is_alive(self):
+        """
+        :return: (bool) True if the simulator is running
+        """
+        return self.process is not None and self.process.poll() is None
+
     def quit(self):
         """
         Shutdown unity environment
@@ -1,342 +1,466 @@
-# Original author: Tawn Kramer
-
-import asyncore
-import base64
-import time
-from io import BytesIO
-from threading import Thread
-
-import numpy as np
-from PIL import Image
-
-from xebikart.gym.core.fps import FPSTimer
-from xebikart.gym.core.tcp_server import IMesgHandler, SimServer
-
-
-class DonkeyUnitySimController:
-    """
-    Wrapper for communicating with unity simulation.
-
-    :param level: (int) Level index
-    :param port: (int) Port to use for communicating with the simulator
-    """
-
-    def __init__(self, level, port=9090, camera_shape=(120, 160, 3)):
-        self.level = level
-        self.verbose = False
-
-        # sensor size - height, width, depth
-        self.camera_img_size = camera_shape
-
-        self.address = ('0.0.0.0', port)
-
-        # Socket message handler
-        self.handler = DonkeyUnitySimHandler(level, self.camera_img_size)
-        # Create the server to which the unity sim will connect
-        self.server = SimServer(self.address, self.handler)
-        # Start the Asynchronous socket handler thread
-        self.thread = Thread(target=asyncore.loop)
-        self.thread.daemon = True
-        self.thread.start()
-
-    def close_connection(self):
-        self.server.handle_close()
-        self.thread.join()
-
-    def wait_until_loaded(self):
-        """
-        Wait for a client (Unity simulator).
-        """
-        while not self.handler.loaded:
-            print("Waiting for sim to start..."
-                  "if the simulation is running, press EXIT to go back to the menu")
-            time.sleep(3.0)
-
-    def reset(self):
-        self.handler.reset()
-
-    def get_sensor_size(self):
-        """
-        :return: (int, int, int)
-        """
-        return self.handler.get_sensor_size()
-
-    def take_action(self, action):
-        self.handler.take_action(action)
-
-    def observe(self):
-        """
-        :return: (np.ndarray)
-        """
-        return self.handler.observe()
-
-    def quit(self):
-        pass
-
-    def render(self, mode):
-        pass
-
-    def has_hit(self):
-        return self.handler.hit != "none"
-
-    def cte(self):
-        return self.handler.cte
-
-    def last_throttle(self):
-        return self.handler.last_throttle
-
-    def info(self):
-        return {
-            "x": self.handler.x,
-            "y": self.handler.y,
-            "z": self.handler.z,
-            "speed": self.handler.speed,
-            "cte": self.handler.cte,
-            "hit": self.handler.hit != "none",
-            "throttle": self.handler.last_throttle,
-            "steering": self.handler.steering_angle
-        }
-
-
-class DonkeyUnitySimHandler(IMesgHandler):
-    """
-    Socket message handler.
-
-    :param level: (int) Level ID
-    """
-
-    def __init__(self, level, camera_shape):
-        self.level_idx = level
-        self.sock = None
-        self.loaded = False
-        self.verbose = False
-        self.timer = FPSTimer(verbose=0)
-
-        # sensor size - height, width, depth
-        self.camera_img_size = camera_shape
-        self.image_array = np.zeros(self.camera_img_size)
-        self.original_image = None
-        self.last_obs = None
-        self.last_throttle = 0.0
-        # Disabled: hit was used to end episode when bumping into an object
-        self.hit = "none"
-        # Cross track error
-        self.cte = 0.0
-        self.x = 0.0
-        self.y = 0.0
-        self.z = 0.0
-        self.steering_angle = 0.0
-        self.current_step = 0
-        self.speed = 0
-        self.steering = None
-
-        # Define which method should be called
-        # for each type of message
-        self.fns = {'telemetry': self.on_telemetry,
-                    "scene_selection_ready": self.on_scene_selection_ready,
-                    "scene_names": self.on_recv_scene_names,
-                    "car_loaded": self.on_car_loaded}
-
-    def on_connect(self, socket_handler):
-        """
-        :param socket_handler: (socket object)
-        """
-        self.sock = socket_handler
-
-    def on_disconnect(self):
-        """
-        Close socket.
-        """
-        self.sock.close()
-        self.sock = None
-
-    def on_recv_message(self, message):
-        """
-        Distribute the received message to the appropriate function.
-
-        :param message: (dict)
-        """
-        if 'msg_type' not in message:
-            print('Expected msg_type field')
-            return
-
-        msg_type = message['msg_type']
-        if msg_type in self.fns:
-            self.fns[msg_type](message)
-        else:
-            print('Unknown message type', msg_type)
-
-    def reset(self):
-        """
-        Global reset, notably it
-        resets car to initial position.
-        """
-        if self.verbose:
-            print("resetting")
-        self.image_array = np.zeros(self.camera_img_size)
-        self.last_obs = None
-        self.hit = "none"
-        self.cte = 0.0
-        self.x = 0.0
-        self.y = 0.0
-        self.z = 0.0
-        self.current_step = 0
-        self.send_reset_car()
-        self.send_control(0, 0)
-        time.sleep(1.0)
-        self.timer.reset()
-
-    def get_sensor_size(self):
-        """
-        :return: (tuple)
-        """
-        return self.camera_img_size
-
-    def take_action(self, action):
-        """
-        :param action: ([float]) Steering and throttle
-        """
-        if self.verbose:
-            print("take_action")
-
-        throttle = action[1]
-        self.steering = action[0]
-        self.last_throttle = throttle
-        self.current_step += 1
-
-        self.send_control(self.steering, throttle)
-
-    def observe(self):
-        while self.last_obs is self.image_array:
-            time.sleep(1.0 / 120.0)
-
-        self.last_obs = self.image_array
-        observation = self.image_array
-
-        self.timer.on_frame()
-
-        return observation
-
-    # ------ Socket interface ----------- #
-
-    def on_telemetry(self, data):
-        """
-        Update car info when receiving telemetry message.
-
-        :param data: (dict)
-        """
-        img_string = data["image"]
-        image = Image.open(BytesIO(base64.b64decode(img_string)))
-        # Resize and crop image
-        image = np.array(image)
-        # Save original image for render
-        self.original_image = np.copy(image)
-        # Resize if using higher resolution images
-        # image = cv2.resize(image, CAMERA_RESOLUTION)
-        # Convert RGB to BGR
-        image = image[:, :, ::-1]
-        self.image_array = image
-        # Here resize is not useful for now (the image have already the right dimension)
-        # self.image_array = cv2.resize(image, (IMAGE_WIDTH, IMAGE_HEIGHT))
-
-        # name of object we just hit. "none" if nothing.
-        # NOTE: obstacle detection disabled
-        # if self.hit == "none":
-        #     self.hit = data["hit"]
-
-        self.x = data["pos_x"]
-        self.y = data["pos_y"]
-        self.z = data["pos_z"]
-        self.steering_angle = data['steering_angle']
-        self.speed = data["speed"]
-
-        # Cross track error not always present.
-        # Will be missing if path is not setup in the given scene.
-        # It should be setup in the 3 scenes available now.
-        try:
-            self.cte = data["cte"]
-            # print(self.cte)
-        except KeyError:
-            print("No Cross Track Error in telemetry")
-            pass
-
-    def on_scene_selection_ready(self, _data):
-        """
-        Get the level names when the scene selection screen is ready
-        """
-        print("Scene Selection Ready")
-        self.send_get_scene_names()
-
-    def on_car_loaded(self, _data):
-        if self.verbose:
-            print("Car Loaded")
-        self.loaded = True
-
-    def on_recv_scene_names(self, data):
-        """
-        Select the level.
-
-        :param data: (dict)
-        """
-        if data is not None:
-            names = data['scene_names']
-            if self.verbose:
-                print("SceneNames:", names)
-            self.send_load_scene(names[self.level_idx])
-
-    def send_control(self, steer, throttle):
-        """
-        Send message to the server for controlling the car.
-
-        :param steer: (float)
-        :param throttle: (float)
-        """
-        if not self.loaded:
-            return
-        msg = {'msg_type': 'control', 'steering': steer.__str__(), 'throttle': throttle.__str__(), 'brake': '0.0'}
-        self.queue_message(msg)
-
-    def send_reset_car(self):
-        """
-        Reset car to initial position.
-        """
-        msg = {'msg_type': 'reset_car'}
-        self.queue_message(msg)
-
-    def send_get_scene_names(self):
-        """
-        Get the different levels availables
-        """
-        msg = {'msg_type': 'get_scene_names'}
-        self.queue_message(msg)
-
-    def send_load_scene(self, scene_name):
-        """
-        Load a level.
-
-        :param scene_name: (str)
-        """
-        msg = {'msg_type': 'load_scene', 'scene_name': scene_name}
-        self.queue_message(msg)
-
-    def send_exit_scene(self):
-        """
-        Go back to scene selection.
-        """
-        msg = {'msg_type': 'exit_scene'}
-        self.queue_message(msg)
-
-    def queue_message(self, msg):
-        """
-        Add message to socket queue.
-
-        :param msg: (dict)
-        """
-        if self.sock is None:
-            if self.verbose:
-                print('skipping:', msg)
-            return
-
-        if self.verbose:
-            print('sending', msg)
-        self.sock.queue_message(msg)
+# Original author: Tawn Kramer
+
+import threading
+import time
+
+import numpy as np
+
+from xebikart.gym.core.fps import FPSTimer, WaitStats
+from xebikart.gym.core.telemetry import decode_image
+from xebikart.gym.core.transport import IMesgHandler, SimTransport
+
+
+class DonkeyUnitySimController:
+    """
+    Wrapper for communicating with unity simulation.
+
+    :param level: (int) Level index
+    :param port: (int) Port to use for communicating with the simulator
+    :param reset_delay: (float) seconds to let the car settle after a reset
+    """
+
+    def __init__(self, level, port=9090, camera_shape=(120, 160, 3), reset_delay=1.0):
+        self.level = level
+        self.verbose = False
+
+        # sensor size - height, width, depth
+        self.camera_img_size = camera_shape
+
+        self.address = ('0.0.0.0', port)
+
+        # Socket message handler
+        self.handler = DonkeyUnitySimHandler(level, self.camera_img_size, reset_delay=reset_delay)
+        # Create the server to which the unity sim will connect, it runs in its own thread
+        self.server = SimTransport(self.address, self.handler)
+
+    def close_connection(self):
+        self.server.close()
+
+    def wait_until_loaded(self, timeout=None):
+        """
+        Wait for a client (Unity simulator).
+
+        :param timeout: (float) seconds, None to wait forever
+        """
+        start_time = time.perf_counter()
+        while not self.handler.loaded_event.wait(3.0):
+            if timeout is not None and time.perf_counter() - start_time > timeout:
+                raise TimeoutError("The simulator did not load the level in {:.0f}s".format(timeout))
+            print("Waiting for sim to start..."
+                  "if the simulation is running, press EXIT to go back to the menu")
+
+    def load_level(self, level, timeout=None):
+        """
+        Switch to another level, through the scene selection menu, without restarting the simulator.
+
+        :param level: (int) Level index
+        :param timeout: (float) seconds, None to wait forever
+        """
+        if level != self.level:
+            self.level = level
+            self.handler.load_level(level)
+        self.wait_until_loaded(timeout)
+
+    def reset(self, timeout=None):
+        """
+        :param timeout: (float) seconds to wait for the telemetry of the reset position, None to wait forever
+        """
+        self.handler.reset(timeout)
+
+    def get_sensor_size(self):
+        """
+        :return: (int, int, int)
+        """
+        return self.handler.get_sensor_size()
+
+    def take_action(self, action):
+        self.handler.take_action(action)
+
+    def observe(self, timeout=None):
+        """
+        :param timeout: (float) seconds, None to wait forever
+        :return: (np.ndarray)
+        """
+        return self.handler.observe(timeout)
+
+    def observe_last(self):
+        """
+        :return: (np.ndarray) image of the last telemetry waited for, without waiting
+        """
+        return self.handler.observe_last()
+
+    def wait_telemetry(self, timeout=None):
+        """
+        Wait for the next telemetry, without decoding its image.
+
+        :param timeout: (float) seconds, None to wait forever
+        """
+        self.handler.wait_telemetry(timeout)
+
+    def wait_stats(self):
+        """
+        :return: (dict) time spent waiting for telemetry, see WaitStats
+        """
+        return self.handler.wait_stats.summary()
+
+    def quit(self):
+        pass
+
+    def render(self, mode):
+        pass
+
+    def has_hit(self):
+        return self.handler.hit != "none"
+
+    def cte(self):
+        return self.handler.cte
+
+    def last_throttle(self):
+        return self.handler.last_throttle
+
+    def info(self):
+        return {
+            "x": self.handler.x,
+            "y": self.handler.y,
+            "z": self.handler.z,
+            "speed": self.handler.speed,
+            "cte": self.handler.cte,
+            "hit": self.handler.hit != "none",
+            "throttle": self.handler.last_throttle,
+            "steering": self.handler.steering_angle
+        }
+
+
+class DonkeyUnitySimHandler(IMesgHandler):
+    """
+    Socket message handler.
+
+    Telemetry images are kept compressed and only decoded by observe(), in turn into one of two
+    preallocated BGR arrays: an observation stays valid until the next but one call to observe().
+
+    :param level: (int) Level ID
+    :param reset_delay: (float) seconds
+    """
+
+    def __init__(self, level, camera_shape, reset_delay=1.0):
+        self.level_idx = level
+        self.reset_delay = reset_delay
+        self.sock = None
+        # set when the simulator drops the connection, waiting for telemetry then fails
+        self.disconnected = False
+        self.loaded = False
+        self.loaded_event = threading.Event()
+        self.verbose = False
+        self.timer = FPSTimer(verbose=0)
+        self.wait_stats = WaitStats()
+
+        # sensor size - height, width, depth
+        self.camera_img_size = camera_shape
+        # base64 jpeg of the latest telemetry
+        self.image_data = None
+        # incremented by each telemetry, observe() waits for the next one through the condition
+        self.telemetry_condition = threading.Condition()
+        self.telemetry_sequence = 0
+        self.observed_sequence = 0
+        self.observed_image_data = None
+        self.image_buffers = [np.zeros(self.camera_img_size, dtype=np.uint8) for _ in range(2)]
+        self.image_buffer_index = 0
+        self.image_array = self.image_buffers[0]
+        self.last_throttle = 0.0
+        # Disabled: hit was used to end episode when bumping into an object
+        self.hit = "none"
+        # Cross track error
+        self.cte = 0.0
+        self.x = 0.0
+        self.y = 0.0
+        self.z = 0.0
+        self.steering_angle = 0.0
+        self.current_step = 0
+        self.speed = 0
+        self.steering = None
+
+        # Define which method should be called
+        # for each type of message
+        self.fns = {'telemetry': self.on_telemetry,
+                    "scene_selection_ready": self.on_scene_selection_ready,
+                    "scene_names": self.on_recv_scene_names,
+                    "car_loaded": self.on_car_loaded}
+
+    def on_connect(self, socket_handler):
+        """
+        :param socket_handler: (socket object)
+        """
+        self.sock = socket_handler
+        with self.telemetry_condition:
+            self.disconnected = False
+
+    def on_disconnect(self):
+        """
+        Close socket, and wake up the threads waiting for telemetry.
+        """
+        self.sock.close()
+        self.sock = None
+        with self.telemetry_condition:
+            self.disconnected = True
+            self.telemetry_condition.notify_all()
+
+    def on_recv_message(self, message):
+        """
+        Distribute the received message to the appropriate function.
+
+        :param message: (dict)
+        """
+        if 'msg_type' not in message:
+            print('Expected msg_type field')
+            return
+
+        msg_type = message['msg_type']
+        if msg_type in self.fns:
+            self.fns[msg_type](message)
+        else:
+            print('Unknown message type', msg_type)
+
+    def reset(self, timeout=None):
+        """
+        Global reset, notably it
+        resets car to initial position.
+        Returns once the telemetry of the reset position is observed, see observe_last().
+
+        :param timeout: (float) seconds, None to wait forever
+        """
+        if self.verbose:
+            print("resetting")
+        self.hit = "none"
+        self.cte = 0.0
+        self.x = 0.0
+        self.y = 0.0
+        self.z = 0.0
+        self.current_step = 0
+        with self.telemetry_condition:
+            sequence = self.telemetry_sequence
+        self.send_reset_car()
+        self.send_control(0, 0)
+        time.sleep(self.reset_delay)
+        # the simulator answers both messages, a lockstep simulator like the emulator with one telemetry each
+        self.wait_telemetry(timeout, min_sequence=sequence + 2)
+        self.timer.reset()
+        self.wait_stats.reset()
+
+    def get_sensor_size(self):
+        """
+        :return: (tuple)
+        """
+        return self.camera_img_size
+
+    def take_action(self, action):
+        """
+        :param action: ([float]) Steering and throttle
+        """
+        if self.verbose:
+            print("take_action")
+
+        throttle = action[1]
+        self.steering = action[0]
+        self.last_throttle = throttle
+        self.current_step += 1
+
+        self.send_control(self.steering, throttle)
+
+    def wait_telemetry(self, timeout=None, min_sequence=None):
+        """
+        Wait for a telemetry not observed yet.
+        Raises ConnectionError if the simulator is disconnected, TimeoutError after `timeout` seconds.
+
+        :param timeout: (float) seconds, None to wait forever
+        :param min_sequence: (int) wait for this telemetry, or a later one, instead
+        """
+        if min_sequence is None:
+            min_sequence = self.observed_sequence + 1
+        start_time = time.perf_counter()
+        with self.telemetry_condition:
+            if not self.telemetry_condition.wait_for(
+                    lambda: self.telemetry_sequence >= min_sequence or self.disconnected, timeout):
+                raise TimeoutError("No telemetry from the simulator for {:.1f}s".format(timeout))
+            if self.telemetry_sequence < min_sequence:
+                raise ConnectionError("The simulator disconnected")
+            self.observed_sequence = self.telemetry_sequence
+            self.observed_image_data = self.image_data
+        self.wait_stats.add(time.perf_counter() - start_time)
+
+        self.timer.on_frame()
+
+    def observe(self, timeout=None):
+        """
+        :param timeout: (float) seconds, None to wait forever
+        :return: (np.ndarray)
+        """
+        self.wait_telemetry(timeout)
+        return self.decode_observation(self.observed_image_data)
+
+    def observe_last(self):
+        """
+        :return: (np.ndarray) image of the last telemetry waited for
+        """
+        return self.decode_observation(self.observed_image_data)
+
+    def decode_observation(self, image_data):
+        """
+        :param image_data: (bytes) base64 jpeg, None for a black image
+        :return: (np.ndarray) read-only BGR image, a view on a reused buffer which is overwritten
+            by the second next decoded observation: copy it to keep it longer
+        """
+        self.image_buffer_index = 1 - self.image_buffer_index
+        observation = self.image_buffers[self.image_buffer_index]
+        if image_data is None:
+            observation.fill(0)
+        else:
+            image = decode_image(image_data)
+            if image.shape != observation.shape:
+                # Resize if using higher resolution images
+                self.image_buffers = [np.zeros(image.shape, dtype=np.uint8) for _ in range(2)]
+                observation = self.image_buffers[self.image_buffer_index]
+            # Convert RGB to BGR, in a contiguous array
+            np.copyto(observation, image[:, :, ::-1])
+        # the buffer stays writable for the next decoding
+        observation = observation.view()
+        observation.flags.writeable = False
+        self.image_array = observation
+        return observation
+
+    @property
+    def original_image(self):
+        """
+        :return: (np.ndarray) RGB image of the latest telemetry, for render
+        """
+        image_data = self.image_data
+        if image_data is None:
+            return None
+        return np.array(decode_image(image_data))
+
+    # ------ Socket interface ----------- #
+
+    def on_telemetry(self, data):
+        """
+        Update car info when receiving telemetry message.
+
+        :param data: (dict)
+        """
+        # name of object we just hit. "none" if nothing.
+        # NOTE: obstacle detection disabled
+        # if self.hit == "none":
+        #     self.hit = data["hit"]
+
+        self.x = data["pos_x"]
+        self.y = data["pos_y"]
+        self.z = data["pos_z"]
+        self.steering_angle = data['steering_angle']
+        self.speed = data["speed"]
+
+        # Cross track error not always present.
+        # Will be missing if path is not setup in the given scene.
+        # It should be setup in the 3 scenes available now.
+        try:
+            self.cte = data["cte"]
+            # print(self.cte)
+        except KeyError:
+            print("No Cross Track Error in telemetry")
+            pass
+
+        with self.telemetry_condition:
+            # decoded on demand, by observe() or render()
+            self.image_data = data["image"]
+            self.telemetry_sequence += 1
+            self.telemetry_condition.notify_all()
+
+    def on_scene_selection_ready(self, _data):
+        """
+        Get the level names when the scene selection screen is ready
+        """
+        print("Scene Selection Ready")
+        self.send_get_scene_names()
+
+    def on_car_loaded(self, _data):
+        if self.verbose:
+            print("Car Loaded")
+        self.loaded = True
+        self.loaded_event.set()
+
+    def load_level(self, level):
+        """
+        Exit the current scene, the level is loaded once the scene selection is ready.
+
+        :param level: (int) Level ID
+        """
+        self.level_idx = level
+        self.loaded = False
+        self.loaded_event.clear()
+        self.send_exit_scene()
+
+    def on_recv_scene_names(self, data):
+        """
+        Select the level.
+
+        :param data: (dict)
+        """
+        if data is not None:
+            names = data['scene_names']
+            if self.verbose:
+                print("SceneNames:", names)
+            self.send_load_scene(names[self.level_idx])
+
+    def send_control(self, steer, throttle):
+        """
+        Send message to the server for controlling the car.
+
+        :param steer: (float)
+        :param throttle: (float)
+        """
+        if not self.loaded:
+            return
+        msg = {'msg_type': 'control', 'steering': steer.__str__(), 'throttle': throttle.__str__(), 'brake': '0.0'}
+        self.queue_message(msg)
+
+    def send_reset_car(self):
+        """
+        Reset car to initial position.
+        """
+        msg = {'msg_type': 'reset_car'}
+        self.queue_message(msg)
+
+    def send_get_scene_names(self):
+        """
+        Get the different levels availables
+        """
+        msg = {'msg_type': 'get_scene_names'}
+        self.queue_message(msg)
+
+    def send_load_scene(self, scene_name):
+        """
+        Load a level.
+
+        :param scene_name: (str)
+        """
+        msg = {'msg_type': 'load_scene', 'scene_name': scene_name}
+        self.queue_message(msg)
+
+    def send_exit_scene(self):
+        """
+        Go back to scene selection.
+        """
+        msg = {'msg_type': 'exit_scene'}
+        self.queue_message(msg)
+
+    def queue_message(self, msg):
+        """
+        Add message to socket queue.
+
+        :param msg: (dict)
+        """
+        if self.sock is None:
+            if self.verbose:
+                print('skipping:', msg)
+            return
+
+        if self.verbose:
+            print('sending', msg)
+        self.sock.queue_message(msg)
@@ -0,0 +1,283 @@
+"""
+Pure Python stand-in for the Unity simulator, to run and benchmark the gym environments without it.
+
+It speaks the same TCP JSON protocol as the simulator, drives a kinematic car on a circular track
+and renders camera frames with NumPy. Telemetry is sent in lockstep: once after each control
+or reset, as fast as the environment consumes it.
+
+    DONKEY_SIM_EMULATOR=1 python train.py
+    python -m xebikart.gym.core.emulator --port 9091
+"""
+
+import argparse
+import base64
+import json
+import math
+import socket
+import threading
+import time
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+SCENE_NAMES = ["generated_road", "warehouse", "sparkfun_avc", "generated_track", "mountain_track"]
+
+GRASS = np.array([40, 110, 40], dtype=np.uint8)
+ROAD = np.array([90, 90, 90], dtype=np.uint8)
+LINE = np.array([230, 230, 230], dtype=np.uint8)
+SKY = np.array([150, 190, 230], dtype=np.uint8)
+PALETTE = np.stack([GRASS, ROAD, LINE])
+
+
+class CircularTrack(object):
+    """
+    :param radius: (float) radius of the center line in meters
+    :param half_width: (float) meters
+    :param line_width: (float) width of the side lines in meters
+    """
+    def __init__(self, radius=10., half_width=1.5, line_width=0.1):
+        self.radius = radius
+        self.half_width = half_width
+        self.line_width = line_width
+
+    def start_pose(self):
+        """
+        :return: (float, float, float) x, z and heading of the car, on the center line going counterclockwise
+        """
+        return self.radius, 0., 0.
+
+    def cte(self, x, z):
+        """
+        :return: (np.ndarray or float) signed distance to the center line, positive outside
+        """
+        return np.hypot(x, z) - self.radius
+
+
+class KinematicCar(object):
+    """
+    Bicycle model, throttle is an acceleration command, brake is the drag.
+
+    :param wheelbase: (float) meters
+    :param max_steering_angle: (float) degrees
+    :param max_acceleration: (float) m/s^2 at full throttle
+    :param drag: (float) 1/s
+    """
+    def __init__(self, wheelbase=0.3, max_steering_angle=25., max_acceleration=8., drag=1.):
+        self.wheelbase = wheelbase
+        self.max_steering_angle = max_steering_angle
+        self.max_acceleration = max_acceleration
+        self.drag = drag
+        self.x, self.z, self.heading, self.speed = 0., 0., 0., 0.
+
+    def reset(self, x, z, heading):
+        self.x, self.z, self.heading, self.speed = x, z, heading, 0.
+
+    def update(self, steering, throttle, dt):
+        """
+        :param steering: (float) in [-1, 1], positive to the right
+        :param throttle: (float) in [-1, 1]
+        :param dt: (float) seconds
+        """
+        self.speed += (throttle * self.max_acceleration - self.drag * self.speed) * dt
+        self.speed = max(self.speed, 0.)
+        steering_angle = math.radians(np.clip(steering, -1, 1) * self.max_steering_angle)
+        # heading 0 goes toward +z and increases when turning right
+        self.heading += self.speed / self.wheelbase * math.tan(steering_angle) * dt
+        self.x += self.speed * math.sin(self.heading) * dt
+        self.z += self.speed * math.cos(self.heading) * dt
+
+
+class CameraRenderer(object):
+    """
+    Render the ground seen by a pinhole camera on the car, the ground position of every pixel
+    below the horizon is computed once, each frame is a rotation and a color lookup.
+
+    :param shape: (int, int, int) height, width, channels
+    :param height: (float) camera height in meters
+    :param fov: (float) horizontal field of view in degrees
+    :param pitch: (float) camera angle below the horizon in degrees
+    """
+    def __init__(self, shape=(120, 160, 3), height=0.3, fov=90., pitch=15.):
+        self.shape = shape
+        rows, columns = shape[:2]
+        focal = columns / 2. / math.tan(math.radians(fov) / 2.)
+        pitch = math.radians(pitch)
+        # pixel coordinates from the optical center, v going down
+        v = (np.arange(rows) - rows / 2. + 0.5)[:, None]
+        u = (np.arange(columns) - columns / 2. + 0.5)[None, :]
+        # the ray of each row goes down by `down` for each unit along it, the ground is below the horizon
+        down = v * math.cos(pitch) + focal * math.sin(pitch)
+        self.horizon = int(np.argmax(down[:, 0] > 1e-3 * focal))
+        v, down = v[self.horizon:], down[self.horizon:]
+        scale = height / down
+        # ground coordinates in the car frame: forward and right
+        self.forward = (scale * (focal * math.cos(pitch) - v * math.sin(pitch)) * np.ones_like(u)).astype(np.float32)
+        self.right = (scale * u).astype(np.float32)
+
+        self.frame = np.empty(shape, dtype=np.uint8)
+        self.frame[:self.horizon] = SKY
+
+    def render(self, track, car):
+        """
+        :return: (np.ndarray) RGB frame, reused by the next call
+        """
+        sin, cos = math.sin(car.heading), math.cos(car.heading)
+        x = car.x + self.forward * sin + self.right * cos
+        z = car.z + self.forward * cos - self.right * sin
+        distance = np.abs(track.cte(x, z))
+        colors = (distance < track.half_width).view(np.uint8)
+        colors[np.abs(distance - track.half_width) < track.line_width] = 2
+        np.take(PALETTE, colors, axis=0, out=self.frame[self.horizon:])
+        return self.frame
+
+
+class DonkeySimEmulator(object):
+    """
+    Simulator client, with the interface of DonkeyUnityProcess.
+
+    :param dt: (float) simulated seconds between two telemetries
+    :param camera_shape: (int, int, int)
+    :param jpeg_quality: (int)
+    """
+    def __init__(self, dt=0.05, camera_shape=(120, 160, 3), jpeg_quality=75):
+        self.dt = dt
+        self.jpeg_quality = jpeg_quality
+        self.track = CircularTrack()
+        self.car = KinematicCar()
+        self.renderer = CameraRenderer(camera_shape)
+        self.steering = 0.
+        self.throttle = 0.
+        self.steps = 0
+
+        # for compatibility with DonkeyUnityProcess
+        self.process = None
+        self.sock = None
+        self.thread = None
+        self.running = False
+
+    def start(self, sim_path=None, headless=True, port=9091, host="127.0.0.1"):
+        """
+        Connect to the environment in a background thread, the server may not be listening yet.
+
+        :param sim_path: ignored
+        :param headless: ignored
+        :param port: (int)
+        :param host: (str)
+        """
+        self.running = True
+        self.thread = threading.Thread(target=self.run, args=(host, port))
+        self.thread.daemon = True
+        self.thread.start()
+        print("Donkey emulator started")
+
+    def is_alive(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def quit(self):
+        self.running = False
+        if self.sock is not None:
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+        self.thread = None
+
+    def connect(self, host, port):
+        while self.running:
+            try:
+                return socket.create_connection((host, port))
+            except ConnectionRefusedError:
+                time.sleep(0.1)
+
+    def run(self, host, port):
+        self.sock = self.connect(host, port)
+        if self.sock is None:
+            return
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.send({"msg_type": "scene_selection_ready"})
+        decoder = json.JSONDecoder()
+        buffer = ""
+        try:
+            while self.running:
+                data = self.sock.recv(64 * 1024)
+                if len(data) == 0:
+                    break
+                buffer += data.decode("utf-8")
+                # messages from the environment are concatenated JSON objects, without delimiter
+                position = 0
+                while True:
+                    while position < len(buffer) and buffer[position] in " \r\n\t":
+                        position += 1
+                    try:
+                        message, position = decoder.raw_decode(buffer, position)
+                    except ValueError:
+                        break
+                    self.on_message(message)
+                buffer = buffer[position:]
+        except OSError:
+            pass
+        finally:
+            self.sock.close()
+
+    def send(self, message):
+        self.sock.sendall(json.dumps(message).encode() + b"\n")
+
+    def on_message(self, message):
+        msg_type = message.get("msg_type")
+        if msg_type == "get_scene_names":
+            self.send({"msg_type": "scene_names", "scene_names": SCENE_NAMES})
+        elif msg_type == "load_scene":
+            self.reset()
+            self.send({"msg_type": "car_loaded"})
+            self.send_telemetry()
+        elif msg_type == "exit_scene":
+            self.send({"msg_type": "scene_selection_ready"})
+        elif msg_type == "reset_car":
+            self.reset()
+            self.send_telemetry()
+        elif msg_type == "control":
+            self.steering = float(message["steering"])
+            self.throttle = float(message["throttle"])
+            self.car.update(self.steering, self.throttle, self.dt)
+            self.steps += 1
+            self.send_telemetry()
+
+    def reset(self):
+        self.car.reset(*self.track.start_pose())
+        self.steering = 0.
+        self.throttle = 0.
+
+    def send_telemetry(self):
+        frame = self.renderer.render(self.track, self.car)
+        jpeg = BytesIO()
+        Image.fromarray(frame).save(jpeg, format="jpeg", quality=self.jpeg_quality)
+        self.send({
+            "msg_type": "telemetry",
+            "steering_angle": self.steering * self.car.max_steering_angle,
+            "throttle": self.throttle,
+            "speed": self.car.speed,
+            "image": base64.b64encode(jpeg.getvalue()).decode(),
+            "hit": "none",
+            "pos_x": self.car.x,
+            "pos_y": 0.,
+            "pos_z": self.car.z,
+            "time": self.steps * self.dt,
+            "cte": float(self.track.cte(self.car.x, self.car.z))
+        })
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9091)
+    args = parser.parse_args()
+
+    emulator = DonkeySimEmulator()
+    emulator.start(port=args.port, host=args.host)
+    try:
+        emulator.thread.join()
+    except KeyboardInterrupt:
+        emulator.quit()
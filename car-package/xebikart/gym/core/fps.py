@@ -1,5 +1,8 @@
 # Original author: Tawn Kramer
 import time
+from collections import deque
+
+import numpy as np
 
 
 class FPSTimer(object):
@@ -24,3 +27,39 @@ class FPSTimer(object):
                 print('{:.2f} fps'.format(100.0 / (end_time - self.start_time)))
             self.start_time = time.time()
             self.iter = 0
+
+
+class WaitStats(object):
+    """
+    Statistics of the time spent waiting, on the last `size` waits.
+
+    :param size: (int)
+    """
+    def __init__(self, size=1000):
+        self.waits = deque(maxlen=size)
+        self.total = 0.
+        self.count = 0
+
+    def reset(self):
+        self.waits.clear()
+        self.total = 0.
+        self.count = 0
+
+    def add(self, seconds):
+        self.waits.append(seconds)
+        self.total += seconds
+        self.count += 1
+
+    def summary(self):
+        """
+        :return: (dict) number of waits and total since reset, mean, p50, p95 and max of the last waits in seconds
+        """
+        waits = np.array(self.waits) if len(self.waits) > 0 else np.zeros(1)
+        return {
+            "count": self.count,
+            "total": self.total,
+            "mean": float(waits.mean()),
+            "p50": float(np.percentile(waits, 50)),
+            "p95": float(np.percentile(waits, 95)),
+            "max": float(waits.max())
+        }
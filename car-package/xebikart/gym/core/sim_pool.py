@@ -0,0 +1,172 @@
+"""
+Pool of simulators kept running between environments, to skip their start-up.
+
+    pool = DonkeySimPool(size=2)
+    env = DonkeyEnv(level=4, simulator=pool.acquire(level=4))
+    ...
+    env.close()  # the simulator goes back to the pool
+    pool.close()
+
+Each simulator has its own port and its own server. A level change goes through the scene selection
+menu of the running simulator. An acquired simulator is health-checked first: a simulator which
+stopped, or does not answer a control with telemetry, is replaced by a new one.
+"""
+
+import os
+import queue
+import threading
+import time
+
+from xebikart.gym.core.donkey_proc import DonkeyUnityProcess
+from xebikart.gym.core.donkey_sim import DonkeyUnitySimController
+from xebikart.gym.core.emulator import DonkeySimEmulator
+from xebikart.gym.utils import find_free_port, get_or_download_simulator
+
+
+class PooledSimulator(object):
+    """
+    A running simulator with its controller.
+
+    :param pool: (DonkeySimPool)
+    :param port: (int)
+    :param process: (DonkeyUnityProcess or DonkeySimEmulator)
+    :param controller: (DonkeyUnitySimController)
+    """
+    def __init__(self, pool, port, process, controller):
+        self.pool = pool
+        self.port = port
+        self.process = process
+        self.controller = controller
+
+    def is_alive(self):
+        return self.process.is_alive()
+
+    def is_responsive(self, timeout):
+        """
+        :param timeout: (float) seconds
+        :return: (bool) the simulator answers a control with telemetry
+        """
+        handler = self.controller.handler
+        if not handler.loaded:
+            return False
+        with handler.telemetry_condition:
+            sequence = handler.telemetry_sequence
+        handler.send_control(0, 0)
+        with handler.telemetry_condition:
+            return handler.telemetry_condition.wait_for(lambda: handler.telemetry_sequence != sequence, timeout)
+
+    def release(self):
+        """
+        Give the simulator back to the pool.
+        """
+        self.pool.release(self)
+
+    def quit(self):
+        self.process.quit()
+        self.controller.close_connection()
+        self.controller.quit()
+
+
+class DonkeySimPool(object):
+    """
+    :param size: (int) number of simulators
+    :param level: (int) level loaded at start
+    :param sim_path: (str) simulator executable, found or downloaded in DONKEY_SIM_HOME by default
+    :param headless: (bool)
+    :param camera_shape: (int, int, int)
+    :param use_emulator: (bool) pool of pure Python emulators, by default if DONKEY_SIM_EMULATOR is set to 1
+    :param start_timeout: (float) seconds for a simulator to load a level
+    :param health_timeout: (float) seconds for a simulator to answer a control
+    """
+    def __init__(self, size, level=0, sim_path=None, headless=True, camera_shape=(120, 160, 3),
+                 use_emulator=None, start_timeout=120., health_timeout=5.):
+        if use_emulator is None:
+            use_emulator = os.environ.get('DONKEY_SIM_EMULATOR', '0') == '1'
+        if not use_emulator and sim_path is None:
+            sim_path = get_or_download_simulator(os.environ.get('DONKEY_SIM_HOME'))
+        self.size = size
+        self.level = level
+        self.sim_path = sim_path
+        self.headless = headless
+        self.camera_shape = camera_shape
+        self.use_emulator = use_emulator
+        self.start_timeout = start_timeout
+        self.health_timeout = health_timeout
+
+        self.idle = queue.Queue()
+        self.simulators = []
+        self.lock = threading.Lock()
+        self.closed = False
+
+        # simulators start in parallel
+        started = [self._start_simulator() for _ in range(size)]
+        for simulator in started:
+            simulator.controller.wait_until_loaded(start_timeout)
+            self.idle.put(simulator)
+
+    def _start_simulator(self):
+        port = find_free_port()
+        # the emulator answers a reset with the telemetry of the new position, no need to wait
+        controller = DonkeyUnitySimController(level=self.level, port=port, camera_shape=self.camera_shape,
+                                              reset_delay=0. if self.use_emulator else 1.0)
+        if self.use_emulator:
+            process = DonkeySimEmulator(camera_shape=self.camera_shape)
+        else:
+            process = DonkeyUnityProcess()
+        process.start(self.sim_path, headless=self.headless, port=port)
+        simulator = PooledSimulator(self, port, process, controller)
+        with self.lock:
+            self.simulators.append(simulator)
+        return simulator
+
+    def _recycle(self, simulator):
+        """
+        :return: (PooledSimulator) a new simulator replacing the given one
+        """
+        print("Restarting simulator on port {}".format(simulator.port))
+        with self.lock:
+            self.simulators.remove(simulator)
+        simulator.quit()
+        simulator = self._start_simulator()
+        simulator.controller.wait_until_loaded(self.start_timeout)
+        return simulator
+
+    def acquire(self, level=None, timeout=None):
+        """
+        :param level: (int) level to load, the current one by default
+        :param timeout: (float) seconds to wait for an idle simulator, None to wait forever
+        :return: (PooledSimulator)
+        """
+        assert not self.closed, "the pool is closed"
+        try:
+            simulator = self.idle.get(timeout=timeout)
+        except queue.Empty:
+            raise TimeoutError("No idle simulator after {:.0f}s".format(timeout))
+        start_time = time.perf_counter()
+        if not simulator.is_alive() or not simulator.is_responsive(self.health_timeout):
+            simulator = self._recycle(simulator)
+        if level is not None:
+            try:
+                simulator.controller.load_level(level, self.start_timeout)
+            except TimeoutError:
+                simulator = self._recycle(simulator)
+                simulator.controller.load_level(level, self.start_timeout)
+        print("Simulator on port {} ready in {:.2f}s".format(simulator.port, time.perf_counter() - start_time))
+        return simulator
+
+    def release(self, simulator):
+        """
+        :param simulator: (PooledSimulator)
+        """
+        if self.closed:
+            # already stopped by close()
+            return
+        # the car is stopped by the reset of the next environment
+        self.idle.put(simulator)
+
+    def close(self):
+        self.closed = True
+        with self.lock:
+            simulators, self.simulators = self.simulators, []
+        for simulator in simulators:
+            simulator.quit()
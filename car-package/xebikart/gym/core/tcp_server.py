@@ -1,48 +1,16 @@
 # Original author: Tawn Kramer
+"""
+Legacy asyncore server, replaced by xebikart.gym.core.transport.
+Kept for comparison in xebikart.gym.benchmark, asyncore is removed from Python 3.12.
+"""
 
 import asyncore
 import json
-import re
 import socket
 
-
-def replace_float_notation(string):
-    """
-    Replace unity float notation for languages like
-    French or German that use comma instead of dot.
-    This convert the json sent by Unity to a valid one.
-    Ex: "test": 1,2, "key": 2 -> "test": 1.2, "key": 2
-
-    :param string: (str) The incorrect json string
-    :return: (str) Valid JSON string
-    """
-    regex_french_notation = r'"[a-zA-Z_]+":(?P<num>[0-9,E-]+),'
-    regex_end = r'"[a-zA-Z_]+":(?P<num>[0-9,E-]+)}'
-
-    for regex in [regex_french_notation, regex_end]:
-        matches = re.finditer(regex, string, re.MULTILINE)
-
-        for match in matches:
-            num = match.group('num').replace(',', '.')
-            string = string.replace(match.group('num'), num)
-    return string
-
-
-class IMesgHandler(object):
-    """
-    Abstract class that represent a socket message handler.
-    """
-    def on_connect(self, socket_handler):
-        pass
-
-    def on_recv_message(self, message):
-        pass
-
-    def on_close(self):
-        pass
-
-    def on_disconnect(self):
-        pass
+# kept importable from here
+from xebikart.gym.core.telemetry import replace_float_notation
+from xebikart.gym.core.transport import IMesgHandler
 
 
 class SimServer(asyncore.dispatcher):
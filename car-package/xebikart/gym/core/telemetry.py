@@ -0,0 +1,80 @@
+import base64
+import json
+import re
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+IMAGE_KEY = b'"image"'
+# a number with a comma as decimal separator, written by a sim running on a french or german locale
+COMMA_DECIMAL_PROBE = re.compile(rb'":-?[0-9]+,[0-9]')
+
+
+def replace_float_notation(string):
+    """
+    Replace unity float notation for languages like
+    French or German that use comma instead of dot.
+    This convert the json sent by Unity to a valid one.
+    Ex: "test": 1,2, "key": 2 -> "test": 1.2, "key": 2
+
+    :param string: (str) The incorrect json string
+    :return: (str) Valid JSON string
+    """
+    regex_french_notation = r'"[a-zA-Z_]+":(?P<num>[0-9,E-]+),'
+    regex_end = r'"[a-zA-Z_]+":(?P<num>[0-9,E-]+)}'
+
+    for regex in [regex_french_notation, regex_end]:
+        matches = re.finditer(regex, string, re.MULTILINE)
+
+        for match in matches:
+            num = match.group('num').replace(',', '.')
+            string = string.replace(match.group('num'), num)
+    return string
+
+
+def split_image(data):
+    """
+    Cut the base64 image out of a message, without going through the rest of it.
+
+    :param data: (bytes) JSON message
+    :return: (bytes, bytes) message with "image": null, base64 image or None
+    """
+    key_start = data.find(IMAGE_KEY)
+    if key_start < 0:
+        return data, None
+    value_start = key_start + len(IMAGE_KEY)
+    # skip ':' and spaces
+    while value_start < len(data) and data[value_start] in b': ':
+        value_start += 1
+    if data[value_start:value_start + 1] != b'"':
+        return data, None
+    # base64 has neither quotes nor escapes
+    value_end = data.find(b'"', value_start + 1)
+    if value_end < 0:
+        return data, None
+    return data[:key_start] + b'"image":null' + data[value_end + 1:], data[value_start + 1:value_end]
+
+
+def parse_message(data):
+    """
+    Parse a simulator message, the image, if any, is kept as base64 bytes.
+
+    :param data: (bytes) JSON message
+    :return: (dict)
+    """
+    data, image = split_image(data)
+    if COMMA_DECIMAL_PROBE.search(data) is not None:
+        data = replace_float_notation(data.decode("utf-8"))
+    message = json.loads(data)
+    if image is not None:
+        message["image"] = image
+    return message
+
+
+def decode_image(image):
+    """
+    :param image: (bytes or str) base64 jpeg
+    :return: (np.ndarray) RGB image
+    """
+    return np.asarray(Image.open(BytesIO(base64.b64decode(image))))
@@ -0,0 +1,273 @@
+import json
+import selectors
+import socket
+import threading
+from collections import deque
+
+from xebikart.gym.core.telemetry import parse_message
+
+
+class IMesgHandler(object):
+    """
+    Abstract class that represent a socket message handler.
+    """
+    def on_connect(self, socket_handler):
+        pass
+
+    def on_recv_message(self, message):
+        pass
+
+    def on_close(self):
+        pass
+
+    def on_disconnect(self):
+        pass
+
+
+class SimTransport:
+    """
+    Receives network connections from the simulator, on a selector loop running in its own thread.
+    Each client connection is handled by a new instance of the SimConnection class.
+
+    :param address: (str, int) (address, port)
+    :param msg_handler: (socket message handler object)
+    :param chunk_size: (int) max number of bytes read at once
+    """
+    def __init__(self, address, msg_handler, chunk_size=(64 * 1024)):
+        self.msg_handler = msg_handler
+        self.chunk_size = chunk_size
+        self.connection = None
+        self.running = True
+        # functions to run in the loop thread
+        self.callbacks = deque()
+
+        self.selector = selectors.DefaultSelector()
+
+        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # in case we have shutdown recently, allow the os to reuse this address. helps when restarting
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server_socket.bind(address)
+        self.server_socket.listen(5)
+        self.server_socket.setblocking(False)
+        self.address = self.server_socket.getsockname()
+        print('Binding to', self.address)
+        self.selector.register(self.server_socket, selectors.EVENT_READ, self._accept)
+
+        # other threads wake up the loop when they queue a message or close the transport
+        self._wakeup_receiver, self._wakeup_sender = socket.socketpair()
+        self._wakeup_receiver.setblocking(False)
+        self._wakeup_sender.setblocking(False)
+        self.selector.register(self._wakeup_receiver, selectors.EVENT_READ, self._on_wakeup)
+
+        self.thread = threading.Thread(target=self.loop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def in_loop(self):
+        return threading.current_thread() is self.thread
+
+    def call_soon(self, callback):
+        self.callbacks.append(callback)
+        self.wakeup()
+
+    def wakeup(self):
+        try:
+            self._wakeup_sender.send(b"\0")
+        except (BlockingIOError, OSError):
+            # already pending, or closed
+            pass
+
+    def loop(self):
+        while self.running:
+            for key, events in self.selector.select():
+                key.data(events)
+        self._close_all()
+
+    def _accept(self, events):
+        # Called when a client connects to our socket
+        sock, client_address = self.server_socket.accept()
+        print('Got a new client', client_address)
+        self.connection = SimConnection(self, sock, self.msg_handler)
+
+    def _on_wakeup(self, events):
+        try:
+            while self._wakeup_receiver.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        while len(self.callbacks) > 0:
+            self.callbacks.popleft()()
+        connection = self.connection
+        if connection is not None:
+            connection.on_wakeup()
+
+    def _close_all(self):
+        print("Server shutdown")
+        if self.msg_handler is not None:
+            self.msg_handler.on_close()
+        if self.connection is not None:
+            self.connection.close()
+        self.selector.unregister(self.server_socket)
+        self.server_socket.close()
+        self.selector.unregister(self._wakeup_receiver)
+        self._wakeup_receiver.close()
+        self._wakeup_sender.close()
+        self.selector.close()
+
+    def close(self):
+        """
+        Stop the loop, close every socket and wait for the thread.
+        """
+        self.running = False
+        if self.in_loop():
+            return
+        self.wakeup()
+        self.thread.join()
+
+
+class SimConnection:
+    """
+    Handles newline delimited JSON messages from a single TCP client.
+
+    Received bytes are accumulated in a bytearray and only the new bytes are searched for
+    the delimiter, so a message spanning many chunks is not rescanned nor copied on every read.
+
+    :param transport: (SimTransport)
+    :param sock: (socket object)
+    :param msg_handler: (socket message handler object)
+    """
+
+    def __init__(self, transport, sock, msg_handler=None):
+        self.transport = transport
+        self.sock = sock
+        self.sock.setblocking(False)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.msg_handler = msg_handler
+        self.closed = False
+
+        self.read_buffer = bytearray()
+        # position in read_buffer from which the delimiter has not been searched yet
+        self.scan_position = 0
+        # bytes or memoryview of the messages to send, appended from any thread
+        self.write_queue = deque()
+        self.writing = False
+
+        self.transport.selector.register(self.sock, selectors.EVENT_READ, self.handle_events)
+
+        if msg_handler:
+            msg_handler.on_connect(self)
+
+    def queue_message(self, msg):
+        """
+        :param msg: (dict) sent as JSON, may be called from any thread
+        """
+        if self.closed:
+            return
+        self.write_queue.append(json.dumps(msg).encode())
+        if self.transport.in_loop():
+            self.on_wakeup()
+        else:
+            self.transport.wakeup()
+
+    def on_wakeup(self):
+        if self.closed:
+            return
+        if len(self.write_queue) > 0 and not self.writing:
+            self.writing = True
+            self.transport.selector.modify(self.sock, selectors.EVENT_READ | selectors.EVENT_WRITE,
+                                           self.handle_events)
+
+    def handle_events(self, events):
+        if events & selectors.EVENT_READ:
+            self.handle_read()
+        if events & selectors.EVENT_WRITE and not self.closed:
+            self.handle_write()
+
+    def handle_write(self):
+        """
+        Write as much of the queued messages as the socket accepts.
+        """
+        while len(self.write_queue) > 0:
+            data = self.write_queue[0]
+            try:
+                sent = self.sock.send(data)
+            except BlockingIOError:
+                return
+            except OSError:
+                self.close()
+                return
+            if sent < len(data):
+                self.write_queue[0] = memoryview(data)[sent:]
+                return
+            self.write_queue.popleft()
+        self.writing = False
+        self.transport.selector.modify(self.sock, selectors.EVENT_READ, self.handle_events)
+
+    def handle_read(self):
+        try:
+            data = self.sock.recv(self.transport.chunk_size)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b""
+
+        if len(data) == 0:
+            # this only happens when the connection is dropped
+            self.close()
+            return
+
+        self.read_buffer += data
+        start = 0
+        end = self.read_buffer.find(b"\n", self.scan_position)
+        while end >= 0:
+            if end - start >= 2:
+                self.handle_message(bytes(self.read_buffer[start:end]))
+            start = end + 1
+            end = self.read_buffer.find(b"\n", start)
+        if start > 0:
+            del self.read_buffer[:start]
+        self.scan_position = len(self.read_buffer)
+
+    def handle_message(self, data):
+        """
+        We are expecing a json object.
+
+        :param data: (bytes) one line
+        """
+        data = data.strip()
+        if len(data) < 2 or data[:1] != b'{' or data[-1:] != b'}':
+            print('Skipping invalid message:', data[:100])
+            return
+        try:
+            json_obj = parse_message(data)
+        except Exception as e:
+            # something bad happened, usually malformed json packet. jump back to idle and hope things continue
+            print(e, 'failed to read json ', data[:100])
+            return
+
+        try:
+            if self.msg_handler:
+                self.msg_handler.on_recv_message(json_obj)
+        except Exception as e:
+            print(e, '>>> failure during on_recv_message:', data[:100])
+
+    def close(self):
+        """
+        Close the connection, closing is done by the loop when called from another thread.
+        """
+        if self.closed:
+            return
+        if not self.transport.in_loop() and self.transport.thread.is_alive():
+            self.transport.call_soon(self.close)
+            return
+        self.closed = True
+        self.transport.selector.unregister(self.sock)
+        self.sock.close()
+        # when client drops or closes connection
+        if self.msg_handler is not None:
+            msg_handler = self.msg_handler
+            self.msg_handler = None
+            msg_handler.on_disconnect()
+            print('Connection dropped')
+        if self.transport.connection is self:
+            self.transport.connection = None
@@ -4,7 +4,7 @@ def create_env(vae, level=4, frame_skip=2, max_cte_error=3.0,
                min_steering=-1, max_steering=1,
                min_throttle=0.1, max_throttle=0.3,
                max_steering_diff=0.15, n_history=10,
-               headless=True, reward_fn=None):
+               headless=True, reward_fn=None, port=None, observation_timeout=None):
 
     from xebikart.gym.envs.donkey_env import DonkeyEnv
     from xebikart.gym.envs.wrappers import CropObservationWrapper, ConvVariationalAutoEncoderObservationWrapper, \
@@ -15,7 +15,7 @@ def create_env(vae, level=4, frame_skip=2, max_cte_error=3.0,
       level=level, frame_skip=frame_skip, max_cte_error=max_cte_error,
       min_steering=min_steering, max_steering=max_steering,
       min_throttle=min_throttle, max_throttle=max_throttle,
-      headless=headless, reward_fn=reward_fn
+      headless=headless, reward_fn=reward_fn, port=port, observation_timeout=observation_timeout
     )
 
     # CropObservation
@@ -34,7 +34,7 @@ def create_stack_obs_clipping_steering(vae, level=4, frame_skip=2, max_cte_error
                                        min_steering=-1, max_steering=1,
                                        min_throttle=0.1, max_throttle=0.3,
                                        max_steering_diff=0.15, num_stack=4,
-                                       headless=True, reward_fn=None):
+                                       headless=True, reward_fn=None, port=None, observation_timeout=None):
 
     from xebikart.gym.envs.donkey_env import DonkeyEnv
     from xebikart.gym.envs.wrappers import CropObservationWrapper, ConvVariationalAutoEncoderObservationWrapper, \
@@ -46,7 +46,7 @@ def create_stack_obs_clipping_steering(vae, level=4, frame_skip=2, max_cte_error
       level=level, frame_skip=frame_skip, max_cte_error=max_cte_error,
       min_steering=min_steering, max_steering=max_steering,
       min_throttle=min_throttle, max_throttle=max_throttle,
-      headless=headless, reward_fn=reward_fn
+      headless=headless, reward_fn=reward_fn, port=port, observation_timeout=observation_timeout
     )
 
     # CropObservation
@@ -65,7 +65,7 @@ def create_stack_obs_clipping_steering(vae, level=4, frame_skip=2, max_cte_error
 
 def create_fix_throttle_env(vae, level=4, frame_skip=2, max_cte_error=3.0,
                             min_steering=-1, max_steering=1, throttle=0.2,
-                            headless=True, reward_fn=None):
+                            headless=True, reward_fn=None, port=None, observation_timeout=None):
 
     from xebikart.gym.envs.donkey_env import DonkeyEnv
     from xebikart.gym.envs.wrappers import CropObservationWrapper, ConvVariationalAutoEncoderObservationWrapper, \
@@ -76,7 +76,7 @@ def create_fix_throttle_env(vae, level=4, frame_skip=2, max_cte_error=3.0,
       level=level, frame_skip=frame_skip, max_cte_error=max_cte_error,
       min_steering=min_steering, max_steering=max_steering,
       min_throttle=throttle, max_throttle=throttle,
-      headless=headless, reward_fn=reward_fn
+      headless=headless, reward_fn=reward_fn, port=port, observation_timeout=observation_timeout
     )
 
     # CropObservation
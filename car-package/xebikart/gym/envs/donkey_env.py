@@ -1,5 +1,6 @@
 # Original author: Roma Sokolkov
 # Edited by Antonin Raffin
+import copy
 import os
 import math
 
@@ -9,6 +10,7 @@ from gym import spaces
 
 from xebikart.gym.core.donkey_proc import DonkeyUnityProcess
 from xebikart.gym.core.donkey_sim import DonkeyUnitySimController
+from xebikart.gym.core.emulator import DonkeySimEmulator
 from xebikart.gym.utils import get_or_download_simulator
 from xebikart.gym.envs import rewards
 
@@ -26,6 +28,19 @@ class DonkeyEnv(gym.Env):
     :param max_steering: (float)
     :param max_cte_error: (float) Max cross track error before game over
     :param camera_shape: (int, int, int) Camera shape (height, width, channel)
+    :param port: (int) TCP port of the simulator, DONKEY_SIM_PORT or 9091 by default
+    :param observation_timeout: (float) seconds without telemetry before raising TimeoutError, None to wait forever
+    :param use_emulator: (bool) use the pure Python emulator instead of the Unity simulator,
+        by default if DONKEY_SIM_EMULATOR is set to 1
+    :param accumulate_reward: (bool) the reward of a step is the sum of the rewards of its frames,
+        instead of the reward of its last frame
+    :param async_step: (bool) step() returns without waiting for the telemetry of its last control,
+        the agent and the wrappers then run while the simulator computes that frame, see step_async()
+    :param simulator: (PooledSimulator) running simulator from DonkeySimPool.acquire(level), used instead
+        of starting one, and released by close()
+
+    Observations are read-only images decoded into two alternating buffers, valid until the second next
+    observation: wrappers return new arrays, an agent keeping raw observations longer has to copy them.
     """
 
     metadata = {
@@ -36,21 +51,39 @@ class DonkeyEnv(gym.Env):
                  camera_shape=(120, 160, 3),
                  min_steering=-1, max_steering=1,
                  min_throttle=0.4, max_throttle=0.6,
-                 reward_fn=None, headless=True):
-        # Check for env variable
-        exe_path = get_or_download_simulator(os.environ.get('DONKEY_SIM_HOME'))
+                 reward_fn=None, headless=True, port=None, observation_timeout=None, use_emulator=None,
+                 accumulate_reward=False, async_step=False, simulator=None):
+        if use_emulator is None:
+            use_emulator = os.environ.get('DONKEY_SIM_EMULATOR', '0') == '1'
 
         # TCP port for communicating with simulation
-        port = int(os.environ.get('DONKEY_SIM_PORT', 9091))
+        if port is None:
+            port = int(os.environ.get('DONKEY_SIM_PORT', 9091))
+        self.observation_timeout = observation_timeout
 
         self.unity_process = None
+        self.simulator = simulator
         print("Starting DonkeyGym env")
-        # Start Unity simulation subprocess if needed
-        self.unity_process = DonkeyUnityProcess()
-        self.unity_process.start(exe_path, headless=headless, port=port)
+        if simulator is not None:
+            self.unity_process = simulator.process
+        elif use_emulator:
+            self.unity_process = DonkeySimEmulator(camera_shape=camera_shape)
+            self.unity_process.start(port=port)
+        else:
+            # Check for env variable
+            exe_path = get_or_download_simulator(os.environ.get('DONKEY_SIM_HOME'))
+            # Start Unity simulation subprocess if needed
+            self.unity_process = DonkeyUnityProcess()
+            self.unity_process.start(exe_path, headless=headless, port=port)
 
         # start simulation com
-        self.viewer = DonkeyUnitySimController(level=level, port=port, camera_shape=camera_shape)
+        if simulator is not None:
+            self.viewer = simulator.controller
+            self.viewer.load_level(level, observation_timeout)
+        else:
+            # the emulator answers a reset with the telemetry of the new position, no need to wait
+            self.viewer = DonkeyUnitySimController(level=level, port=port, camera_shape=camera_shape,
+                                                   reset_delay=0. if use_emulator else 1.0)
 
         # min/max steering/throttle
         self.min_throttle = min_throttle
@@ -73,7 +106,11 @@ class DonkeyEnv(gym.Env):
             crash_reward_weight=-10,
             crash_speed_reward_weight=-5
         )
-        self.reward_fn = reward_fn if reward_fn is not None else default_reward_fn
+        # deep copied, the state of a reward function, and of the ones it chains, is kept per environment
+        if reward_fn is not None and not isinstance(reward_fn, rewards.RewardFunction):
+            print("Warning: reward_fn is not a RewardFunction, the reward functions it calls are shared between "
+                  "environments and not reset at the start of an episode, use rewards.ChainedReward instead")
+        self.reward_fn = copy.deepcopy(reward_fn) if reward_fn is not None else default_reward_fn
 
         # steering + throttle, action space must be symmetric
         self.action_space = spaces.Box(low=np.array([-1, -1]),
@@ -86,6 +123,10 @@ class DonkeyEnv(gym.Env):
         self.seed()
         # Frame Skipping
         self.frame_skip = frame_skip
+        self.accumulate_reward = accumulate_reward
+        self.async_step = async_step
+        # a control was sent and its telemetry not waited for yet
+        self.pending_telemetry = False
         # wait until loaded
         self.viewer.wait_until_loaded()
 
@@ -111,20 +152,66 @@ class DonkeyEnv(gym.Env):
         # Convert from [0, 1] to [min, max]
         action[1] = (1 - t) * self.min_throttle + self.max_throttle * t
 
-        # Repeat action if using frame_skip
-        for _ in range(self.frame_skip):
+        if self.async_step:
+            return self.step_async(action)
+
+        # Repeat action if using frame_skip, only the last frame is decoded
+        reward = 0.
+        for i in range(self.frame_skip):
             self.viewer.take_action(action)
-            observation = self.viewer.observe()
+            if i < self.frame_skip - 1:
+                self.viewer.wait_telemetry(self.observation_timeout)
+            else:
+                observation = self.viewer.observe(self.observation_timeout)
             info = self.info()
             done = self.is_game_over(info)
-            reward = self.reward_fn(0, done, info)
+            frame_reward = self.reward_fn(0, done, info)
+            reward = reward + frame_reward if self.accumulate_reward else frame_reward
 
         return observation, reward, done, info
 
+    def step_async(self, action):
+        """
+        Pipelined step: each control is sent before the reward of the previous frame is computed,
+        and the last control of the step is not waited for, so that the simulator runs while the agent
+        and the wrappers process the observation.
+
+        The observation, reward and done of a step are those of the last frame received, one frame behind
+        the action: with frame_skip=1, the first step after a reset returns the reset observation.
+        A frame ending the episode stops the step.
+
+        :param action: (np.ndarray) already scaled
+        :return: (np.ndarray, float, bool, dict)
+        """
+        reward = 0.
+        done = False
+        info = None
+        for _ in range(self.frame_skip):
+            if self.pending_telemetry:
+                self.viewer.wait_telemetry(self.observation_timeout)
+                # read before the next control, the telemetry thread updates it
+                info = self.info()
+            self.viewer.take_action(action)
+            self.pending_telemetry = True
+            if info is not None:
+                done = self.is_game_over(info)
+                frame_reward = self.reward_fn(0, done, info)
+                reward = reward + frame_reward if self.accumulate_reward else frame_reward
+                if done:
+                    break
+
+        if info is None:
+            info = self.info()
+        return self.viewer.observe_last(), reward, done, info
+
     def reset(self):
-        self.viewer.reset()
-        observation = self.viewer.observe()
-        return observation
+        if self.pending_telemetry:
+            self.viewer.wait_telemetry(self.observation_timeout)
+            self.pending_telemetry = False
+        if hasattr(self.reward_fn, "reset"):
+            self.reward_fn.reset()
+        self.viewer.reset(self.observation_timeout)
+        return self.viewer.observe_last()
 
     def render(self, mode='human'):
         """
@@ -135,6 +222,10 @@ class DonkeyEnv(gym.Env):
         return None
 
     def close(self):
+        if self.simulator is not None:
+            self.simulator.release()
+            self.simulator = None
+            return
         if self.unity_process is not None:
             self.unity_process.quit()
         self.viewer.close_connection()
@@ -0,0 +1,139 @@
+import threading
+
+import numpy as np
+
+
+class _EncodingRequest(object):
+    __slots__ = ["observation", "latent", "error", "done"]
+
+    def __init__(self, observation):
+        self.observation = observation
+        self.latent = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class BatchedVAEEncoder(object):
+    """
+    Encode observations with a VAE encoder through a compiled backend function, instead of
+    `Model.predict` whose overhead dominates on a batch of one.
+
+    encode() encodes a batch at once. encode_one() may be called concurrently by environments
+    running in threads: the first caller waits up to `max_delay` seconds for the others, and
+    encodes all pending observations in one call.
+
+    :param vae: tf.keras.Model from an observation to its latent vector
+    :param scale: (float) observations are multiplied by scale before encoding
+    :param max_batch_size: (int)
+    :param max_delay: (float) seconds
+    """
+    def __init__(self, vae, scale=1. / 255., max_batch_size=64, max_delay=0.):
+        self.vae = vae
+        self.encode_fn = self._build_encode_fn()
+        self.input_shape = tuple(vae.input_shape[1:])
+        self.z_size = vae.output_shape[1]
+        self.scale = scale
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+
+        self.condition = threading.Condition()
+        self.pending = []
+
+    def _build_encode_fn(self):
+        """
+        :return: function from [batch of observations] to [batch of latent vectors]
+        """
+        from tensorflow.keras import backend as K
+
+        return K.function(self.vae.inputs, self.vae.outputs)
+
+    def encode(self, observations):
+        """
+        :param observations: (np.ndarray) batch of observations, (n,) + input_shape
+        :return: (np.ndarray) latent vectors, (n, z_size)
+        """
+        observations = np.asarray(observations, dtype=np.float32)
+        latents = []
+        for start in range(0, len(observations), self.max_batch_size):
+            batch = observations[start:start + self.max_batch_size] * self.scale
+            latents.append(self.encode_fn([batch])[0])
+        if len(latents) == 1:
+            return latents[0]
+        return np.concatenate(latents) if len(latents) > 0 else np.zeros((0, self.z_size), dtype=np.float32)
+
+    def encode_one(self, observation):
+        """
+        :param observation: (np.ndarray) input_shape
+        :return: (np.ndarray) latent vector, (z_size,)
+        """
+        request = _EncodingRequest(observation)
+        with self.condition:
+            self.pending.append(request)
+            leader = len(self.pending) == 1
+            if len(self.pending) >= self.max_batch_size:
+                self.condition.notify_all()
+        if leader:
+            with self.condition:
+                if self.max_delay > 0.:
+                    self.condition.wait_for(lambda: len(self.pending) >= self.max_batch_size, self.max_delay)
+                batch, self.pending = self.pending, []
+            try:
+                latents = self.encode(np.stack([pending.observation for pending in batch]))
+                for pending, latent in zip(batch, latents):
+                    pending.latent = latent
+            except Exception as e:
+                for pending in batch:
+                    pending.error = e
+            for pending in batch:
+                pending.done.set()
+        else:
+            request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.latent
+
+
+class VAEVecEnvWrapper(object):
+    """
+    Encode the batched observations of a vectorized environment, e.g. DonkeyVecEnv, with one call per step.
+    The workers then only deal with images and do not need tensorflow.
+
+    :param venv: vectorized environment
+    :param encoder: (BatchedVAEEncoder)
+    """
+    def __init__(self, venv, encoder):
+        from gym.spaces import Box
+
+        assert tuple(venv.observation_space.shape) == encoder.input_shape
+
+        self.venv = venv
+        self.encoder = encoder
+        self.num_envs = venv.num_envs
+        self.action_space = venv.action_space
+        self.observation_space = Box(low=np.finfo(np.float32).min,
+                                     high=np.finfo(np.float32).max,
+                                     shape=(encoder.z_size,),
+                                     dtype=np.float32)
+
+    def reset(self):
+        return self.encoder.encode(self.venv.reset())
+
+    def step_async(self, actions):
+        self.venv.step_async(actions)
+
+    def step_wait(self):
+        observations, rewards, dones, infos = self.venv.step_wait()
+        terminal_indexes = [i for i, info in enumerate(infos) if info.get("terminal_observation") is not None]
+        # terminal observations are encoded with the batch
+        batch = [observations] + [infos[i]["terminal_observation"][None] for i in terminal_indexes]
+        latents = self.encoder.encode(np.concatenate(batch))
+        for i, latent in zip(terminal_indexes, latents[self.num_envs:]):
+            infos[i]["terminal_observation"] = latent
+        return latents[:self.num_envs], rewards, dones, infos
+
+    def step(self, actions):
+        self.step_async(actions)
+        return self.step_wait()
+
+    def close(self):
+        self.venv.close()
@@ -5,12 +5,50 @@ from gym.spaces import Box
 from gym import ObservationWrapper
 
 
+class CompressedFrame(object):
+    """
+    lz4 compressed frame. It is decompressed at most once while it is in the window of a
+    :class:`FrameStack`, and again on each conversion once out of it.
+    """
+    __slots__ = ["data", "shape", "dtype", "cached", "in_window"]
+
+    def __init__(self, frame):
+        from lz4.block import compress
+        frame = np.ascontiguousarray(frame)
+        self.data = compress(frame)
+        self.shape = frame.shape
+        self.dtype = frame.dtype
+        self.cached = None
+        self.in_window = False
+
+    def __array__(self, dtype=None):
+        frame = self.cached
+        if frame is None:
+            from lz4.block import decompress
+            frame = np.frombuffer(decompress(self.data), dtype=self.dtype).reshape(self.shape)
+            if self.in_window:
+                self.cached = frame
+        if dtype is not None:
+            return frame.astype(dtype)
+        return frame
+
+    def enter_window(self):
+        self.in_window = True
+
+    def leave_window(self):
+        self.in_window = False
+        self.cached = None
+
+
 class LazyFrames(object):
     r"""Ensures common frames are only stored once to optimize memory use.
 
     To further reduce the memory use, it is optionally to turn on lz4 to
     compress the observations.
 
+    Frames are either a read-only view on the frames of :class:`FrameStack`, returned as is by
+    `np.asarray`, or a list of frames stacked on conversion.
+
     .. note::
 
         This object should only be converted to numpy array just before forward pass.
@@ -18,29 +56,31 @@ class LazyFrames(object):
     """
     def __init__(self, frames, lz4_compress=False):
         if lz4_compress:
-            from lz4.block import compress
-            self.shape = frames[0].shape
-            self.dtype = frames[0].dtype
-            frames = [compress(frame) for frame in frames]
+            frames = [frame if isinstance(frame, CompressedFrame) else CompressedFrame(frame) for frame in frames]
         self._frames = frames
         self.lz4_compress = lz4_compress
 
     def __array__(self, dtype=None):
-        if self.lz4_compress:
-            from lz4.block import decompress
-            frames = [np.frombuffer(decompress(frame), dtype=self.dtype).reshape(self.shape) for frame in self._frames]
+        if isinstance(self._frames, np.ndarray):
+            out = self._frames
         else:
-            frames = self._frames
-        out = np.stack(frames, axis=0)
+            out = np.stack([np.asarray(frame) for frame in self._frames], axis=0)
         if dtype is not None:
             out = out.astype(dtype)
         return out
 
     def __len__(self):
-        return len(self.__array__())
+        return len(self._frames)
 
     def __getitem__(self, i):
-        return self.__array__()[i]
+        return np.asarray(self._frames[i])
+
+    @property
+    def last_frame(self):
+        """
+        Most recent frame, replay buffers may store it instead of the whole stack.
+        """
+        return self[-1]
 
 
 class FrameStack(ObservationWrapper):
@@ -71,29 +111,80 @@ class FrameStack(ObservationWrapper):
     Args:
         env (Env): environment object
         num_stack (int): number of stacks
+        lz4_compress (bool): compress the frames
+        block_size (int): number of frames allocated at once, without compression
 
     """
-    def __init__(self, env, num_stack, lz4_compress=False):
+    def __init__(self, env, num_stack, lz4_compress=False, block_size=256):
         super(FrameStack, self).__init__(env)
         self.num_stack = num_stack
         self.lz4_compress = lz4_compress
+        self.block_size = max(block_size, num_stack)
 
+        # compressed frames of the stack
         self.frames = deque(maxlen=num_stack)
+        # uncompressed frames are written one after the other in preallocated blocks, the stack
+        # is a view on the last `num_stack` ones. A full block is replaced by a new one, starting with
+        # the last frames of the full one, and freed once no observation refers to it.
+        self.block = None
+        self.position = 0
+        self.episode_start = 0
 
         low = np.repeat(self.observation_space.low[np.newaxis, ...], num_stack, axis=0)
         high = np.repeat(self.observation_space.high[np.newaxis, ...], num_stack, axis=0)
         self.observation_space = Box(low=low, high=high, dtype=self.observation_space.dtype)
 
+    def _new_block(self, carry):
+        frame_space = self.env.observation_space
+        block = np.empty((self.block_size + self.num_stack - 1,) + frame_space.shape, dtype=frame_space.dtype)
+        if carry > 0:
+            block[:carry] = self.block[self.position - carry:self.position]
+        self.block = block
+        self.position = carry
+        self.episode_start = 0
+
+    def _append(self, observation, new_episode=False):
+        if self.lz4_compress:
+            if new_episode:
+                for frame in self.frames:
+                    frame.leave_window()
+                self.frames.clear()
+            elif len(self.frames) == self.num_stack:
+                self.frames[0].leave_window()
+            frame = CompressedFrame(observation)
+            frame.enter_window()
+            self.frames.append(frame)
+            return
+
+        if self.block is None or self.position == len(self.block):
+            carry = 0 if new_episode or self.block is None else \
+                min(self.num_stack - 1, self.position - self.episode_start)
+            self._new_block(carry)
+        if new_episode:
+            self.episode_start = self.position
+        self.block[self.position] = observation
+        self.position += 1
+
     def _get_observation(self):
-        assert len(self.frames) == self.num_stack, (len(self.frames), self.num_stack)
-        return LazyFrames(list(self.frames), self.lz4_compress)
+        if self.lz4_compress:
+            frames = list(self.frames)
+            # the first frame of the episode is repeated
+            return LazyFrames([frames[0]] * (self.num_stack - len(frames)) + frames, self.lz4_compress)
+
+        start = self.position - self.num_stack
+        if start >= self.episode_start:
+            frames = self.block[start:self.position]
+            frames.flags.writeable = False
+        else:
+            frames = self.block[np.maximum(np.arange(start, self.position), self.episode_start)]
+        return LazyFrames(frames)
 
     def step(self, action):
         observation, reward, done, info = self.env.step(action)
-        self.frames.append(observation)
+        self._append(observation)
         return self._get_observation(), reward, done, info
 
     def reset(self, **kwargs):
         observation = self.env.reset(**kwargs)
-        [self.frames.append(observation) for _ in range(self.num_stack)]
-        return self._get_observation()
\ No newline at end of file
+        self._append(observation, new_episode=True)
+        return self._get_observation()
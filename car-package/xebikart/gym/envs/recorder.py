@@ -0,0 +1,244 @@
+"""
+Record the episodes of an environment, to analyze them or train offline without the simulator.
+
+Rows are steps, the first row of an episode is the reset. Columns are written by chunks of
+`chunk_size` rows, each chunk is a directory of .npy files, loaded with memory mapping:
+
+    episode, step, action, reward, done, x, y, z, speed, cte, steering, throttle, hit
+    observation (when not an image)
+    images.bin, image_offsets.npy: jpeg of the simulator camera of each row, as sent by the simulator
+
+    env = EpisodeRecorderWrapper(DonkeyEnv(), "runs/episodes")
+    ...
+    dataset = EpisodeDataset("runs/episodes")
+    dataset.column("cte"), dataset.image(42)
+"""
+
+import base64
+import os
+import queue
+import threading
+from io import BytesIO
+
+import numpy as np
+from gym.core import Wrapper
+
+INFO_FIELDS = ["x", "y", "z", "speed", "cte", "steering", "throttle", "hit"]
+# value of an info field missing from a step, NaN by default
+INFO_DEFAULTS = {"hit": False}
+CHUNK_FORMAT = "chunk-{:06d}"
+
+
+class _ChunkWriter(object):
+    """
+    Columns of the rows received, written to a new chunk every `chunk_size` rows.
+    """
+    def __init__(self, path, chunk_size):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.chunk_index = len([name for name in os.listdir(path)
+                                if name.startswith("chunk-") and not name.endswith(".tmp")])
+        self.clear()
+
+    def clear(self):
+        self.columns = {name: [] for name in ["episode", "step", "action", "reward", "done"] + INFO_FIELDS}
+        self.observations = []
+        self.images = []
+
+    def add(self, row):
+        episode, step, action, reward, done, info, observation, image = row
+        self.columns["episode"].append(episode)
+        self.columns["step"].append(step)
+        self.columns["action"].append(action)
+        self.columns["reward"].append(reward)
+        self.columns["done"].append(done)
+        for name in INFO_FIELDS:
+            self.columns[name].append(info.get(name, INFO_DEFAULTS.get(name, np.nan)))
+        if observation is not None:
+            self.observations.append(observation)
+        if image is not None:
+            self.images.append(image)
+        if len(self.columns["step"]) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.columns["step"]) == 0:
+            return
+        chunk_path = os.path.join(self.path, CHUNK_FORMAT.format(self.chunk_index))
+        # written aside, then renamed, a chunk is complete or absent
+        tmp_path = chunk_path + ".tmp"
+        os.makedirs(tmp_path, exist_ok=True)
+        dtypes = {"episode": np.int32, "step": np.int32, "action": np.float32, "reward": np.float32,
+                  "done": np.bool_, "hit": np.bool_}
+        for name, values in self.columns.items():
+            np.save(os.path.join(tmp_path, name + ".npy"), np.array(values, dtype=dtypes.get(name, np.float32)))
+        if len(self.observations) > 0:
+            np.save(os.path.join(tmp_path, "observation.npy"), np.stack(self.observations))
+        if len(self.images) > 0:
+            jpegs = [base64.b64decode(image) if len(image) > 0 else b"" for image in self.images]
+            offsets = np.zeros(len(jpegs) + 1, dtype=np.int64)
+            np.cumsum([len(jpeg) for jpeg in jpegs], out=offsets[1:])
+            with open(os.path.join(tmp_path, "images.bin"), "wb") as f:
+                for jpeg in jpegs:
+                    f.write(jpeg)
+            np.save(os.path.join(tmp_path, "image_offsets.npy"), offsets)
+        os.rename(tmp_path, chunk_path)
+        self.chunk_index += 1
+        self.clear()
+
+
+class EpisodeRecorderWrapper(Wrapper):
+    def __init__(self, env, path, chunk_size=1000, record_images=True, record_observations=None, max_queue_size=10000):
+        """
+        Record steps in a background thread: actions, rewards, info fields, observations
+        and the jpeg images of the simulator, without encoding them again.
+
+        :param env:
+        :param path: (str) directory of the chunks, a new recording appends to it
+        :param chunk_size: (int) rows per chunk
+        :param record_images: (bool) record the camera images of DonkeyEnv
+        :param record_observations: (bool) by default, observations are recorded unless they are the camera images
+        :param max_queue_size: (int) rows waiting to be written, step() blocks beyond
+        """
+        super(EpisodeRecorderWrapper, self).__init__(env)
+
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        viewer = getattr(env.unwrapped, "viewer", None)
+        self.handler = getattr(viewer, "handler", None) if record_images else None
+        if record_observations is None:
+            record_observations = self.handler is None or self.env.observation_space.shape != \
+                getattr(env.unwrapped, "camera_shape", None)
+        self.record_observations = record_observations
+        self.action_size = int(np.prod(self.env.action_space.shape))
+
+        episodes = [0]
+        for name in sorted(os.listdir(path)):
+            if name.startswith("chunk-") and not name.endswith(".tmp"):
+                episodes.append(int(np.load(os.path.join(path, name, "episode.npy"), mmap_mode="r")[-1]) + 1)
+        self.episode = max(episodes) - 1
+        self.current_step = 0
+
+        self.rows = queue.Queue(maxsize=max_queue_size)
+        self.writer = _ChunkWriter(path, chunk_size)
+        # exception of the writer thread, raised by step(), reset() and close()
+        self.error = None
+        self.thread = threading.Thread(target=self._write)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _write(self):
+        row = None
+        try:
+            while True:
+                row = self.rows.get()
+                if row is None:
+                    break
+                self.writer.add(row)
+            self.writer.flush()
+        except Exception as e:
+            self.error = e
+            # rows are dropped until close(), so that step() never blocks on a full queue
+            while row is not None:
+                row = self.rows.get()
+
+    def _raise_error(self):
+        if self.error is not None:
+            raise self.error
+
+    def _record(self, action, reward, done, info, observation):
+        self._raise_error()
+        image = None
+        if self.handler is not None:
+            # base64 jpeg of the last observation, b"" for a black image
+            image = self.handler.observed_image_data or b""
+        if self.record_observations:
+            observation = np.array(observation)
+        else:
+            observation = None
+        self.rows.put((self.episode, self.current_step, action, reward, done, info, observation, image))
+
+    def reset(self, **kwargs):
+        observation = self.env.reset(**kwargs)
+        self.episode += 1
+        self.current_step = 0
+        info = self.env.unwrapped.info() if hasattr(self.env.unwrapped, "info") else {}
+        self._record(np.full(self.action_size, np.nan, dtype=np.float32), 0., False, info, observation)
+        return observation
+
+    def step(self, action):
+        # copied before the step, DonkeyEnv scales the throttle in place
+        recorded_action = np.array(action, dtype=np.float32).reshape(-1)
+        observation, reward, done, info = self.env.step(action)
+        self.current_step += 1
+        self._record(recorded_action, reward, done, dict(info), observation)
+        return observation, reward, done, info
+
+    def close(self):
+        if self.thread is not None:
+            self.rows.put(None)
+            self.thread.join()
+            self.thread = None
+        result = self.env.close()
+        self._raise_error()
+        return result
+
+
+class EpisodeDataset(object):
+    """
+    Recorded episodes, columns are memory mapped.
+
+    :param path: (str) directory of the chunks
+    """
+    def __init__(self, path):
+        self.path = path
+        self.chunks = sorted(os.path.join(path, name) for name in os.listdir(path)
+                             if name.startswith("chunk-") and not name.endswith(".tmp"))
+        self.chunk_sizes = [len(np.load(os.path.join(chunk, "step.npy"), mmap_mode="r")) for chunk in self.chunks]
+        self.chunk_starts = np.concatenate([[0], np.cumsum(self.chunk_sizes)]).astype(np.int64)
+
+    def __len__(self):
+        return int(self.chunk_starts[-1])
+
+    def chunk_columns(self, name):
+        """
+        :param name: (str) column
+        :return: ([np.memmap]) column of each chunk
+        """
+        return [np.load(os.path.join(chunk, name + ".npy"), mmap_mode="r") for chunk in self.chunks]
+
+    def column(self, name):
+        """
+        :param name: (str) column
+        :return: (np.ndarray) column of all the rows
+        """
+        columns = self.chunk_columns(name)
+        if len(columns) == 1:
+            return columns[0]
+        return np.concatenate(columns)
+
+    def jpeg(self, index):
+        """
+        :param index: (int) row
+        :return: (bytes) jpeg image, None for a black image
+        """
+        chunk = int(np.searchsorted(self.chunk_starts, index, side="right")) - 1
+        row = index - self.chunk_starts[chunk]
+        offsets = np.load(os.path.join(self.chunks[chunk], "image_offsets.npy"), mmap_mode="r")
+        start, end = int(offsets[row]), int(offsets[row + 1])
+        if start == end:
+            return None
+        images = np.memmap(os.path.join(self.chunks[chunk], "images.bin"), dtype=np.uint8, mode="r")
+        return images[start:end].tobytes()
+
+    def image(self, index):
+        """
+        :param index: (int) row
+        :return: (np.ndarray) RGB image, None for a black image
+        """
+        from PIL import Image
+
+        jpeg = self.jpeg(index)
+        if jpeg is None:
+            return None
+        return np.asarray(Image.open(BytesIO(jpeg)))
@@ -1,8 +1,47 @@
+"""
+Reward functions of DonkeyEnv.
 
+A reward function is called at each frame with `(reward, done, info)`, and its `batch` method computes
+the rewards of whole trajectories from arrays of the info fields, e.g. to relabel recorded episodes:
 
-def speed(min_throttle, max_throttle,
-          base_reward_weight, throttle_reward_weight,
-          crash_reward_weight, crash_speed_reward_weight):
+    rewards = relabel(smooth_driving(0.15, -1.), EpisodeDataset("runs/episodes"))
+
+State, like the previous steering, is kept by each instance and reset at the start of an episode.
+"""
+
+import numpy as np
+
+
+class RewardFunction(object):
+    def __call__(self, reward, done, info):
+        """
+        :param reward: (float) reward of the previous reward functions, 0 for the first one
+        :param done: (bool)
+        :param info: (dict) DonkeyEnv info
+        :return: (float)
+        """
+        raise NotImplementedError
+
+    def batch(self, dones, throttles, steerings, ctes, rewards=None, episode_starts=None):
+        """
+        :param dones: (np.ndarray) bool
+        :param throttles: (np.ndarray)
+        :param steerings: (np.ndarray)
+        :param ctes: (np.ndarray)
+        :param rewards: (np.ndarray) rewards of the previous reward functions, 0 by default
+        :param episode_starts: (np.ndarray) bool, first step of each episode, only the first one by default
+        :return: (np.ndarray) float32 rewards
+        """
+        raise NotImplementedError
+
+    def reset(self):
+        """
+        Called at the start of an episode.
+        """
+        pass
+
+
+class SpeedReward(RewardFunction):
     """
     default: [base_reward_weight] + [throttle_reward_weight]
     done: [crash_reward_weight] + [crash_speed_reward_weight] * [current_throttle] during a crash
@@ -13,57 +52,142 @@ def speed(min_throttle, max_throttle,
     :param throttle_reward_weight:
     :param crash_reward_weight:
     :param crash_speed_reward_weight:
-    :return:
     """
-    def _reward_fn(reward, done, info):
+    def __init__(self, min_throttle, max_throttle,
+                 base_reward_weight, throttle_reward_weight,
+                 crash_reward_weight, crash_speed_reward_weight):
+        self.min_throttle = min_throttle
+        self.max_throttle = max_throttle
+        self.base_reward_weight = base_reward_weight
+        self.throttle_reward_weight = throttle_reward_weight
+        self.crash_reward_weight = crash_reward_weight
+        self.crash_speed_reward_weight = crash_speed_reward_weight
+
+    def __call__(self, reward, done, info):
+        throttle = info["throttle"]
         if done:
             # penalize the agent for getting off the road fast
-            throttle = info["throttle"]
-            norm_throttle = (throttle - min_throttle) / (max_throttle - min_throttle)
-            return crash_reward_weight + crash_speed_reward_weight * norm_throttle
+            norm_throttle = (throttle - self.min_throttle) / (self.max_throttle - self.min_throttle)
+            return self.crash_reward_weight + self.crash_speed_reward_weight * norm_throttle
         else:
             # step_reward + throttle_reward
-            throttle = info["throttle"]
-            ref_throttle = (throttle / max_throttle)
-            throttle_reward = throttle_reward_weight * ref_throttle
-            return base_reward_weight + throttle_reward
-    return _reward_fn
+            ref_throttle = (throttle / self.max_throttle)
+            throttle_reward = self.throttle_reward_weight * ref_throttle
+            return self.base_reward_weight + throttle_reward
 
+    def batch(self, dones, throttles, steerings, ctes, rewards=None, episode_starts=None):
+        throttles = np.asarray(throttles, dtype=np.float32)
+        norm_throttles = (throttles - self.min_throttle) / (self.max_throttle - self.min_throttle)
+        crash_rewards = self.crash_reward_weight + self.crash_speed_reward_weight * norm_throttles
+        step_rewards = self.base_reward_weight + self.throttle_reward_weight * (throttles / self.max_throttle)
+        return np.where(dones, crash_rewards, step_rewards).astype(np.float32)
 
-def smooth_driving(max_steering_diff, steering_diff_reward_weight):
+
+class SmoothDrivingReward(RewardFunction):
     """
     diff between prev_steering - steering > max_steering_diff: steering_diff_reward_weight * (1 + error ** 2)
     default: default reward
 
     :param max_steering_diff:
     :param steering_diff_reward_weight:
-    :return:
     """
+    def __init__(self, max_steering_diff, steering_diff_reward_weight):
+        self.max_steering_diff = max_steering_diff
+        self.steering_diff_reward_weight = steering_diff_reward_weight
+        self.prev_steering = 0.
 
-    # hack way to keep last info in memory
-    class _Memory:
-        info = {
-            "throttle": 0.,
-            "steering": 0.
-        }
+    def reset(self):
+        self.prev_steering = 0.
 
-    def _reward_fn(reward, done, info):
+    def __call__(self, reward, done, info):
         steering = info["steering"]
-        prev_info = _Memory.info
-        prev_steering = prev_info["steering"]
-
-        steering_diff = (prev_steering - steering)
-        if abs(steering_diff) > max_steering_diff:
-            error = abs(steering_diff) - max_steering_diff
-            jerk_penalty = steering_diff_reward_weight * (1 + error ** 2)
+        steering_diff = (self.prev_steering - steering)
+        if abs(steering_diff) > self.max_steering_diff:
+            error = abs(steering_diff) - self.max_steering_diff
+            jerk_penalty = self.steering_diff_reward_weight * (1 + error ** 2)
         else:
             jerk_penalty = 0
 
         # Cancel reward if the continuity constrain is violated
         if jerk_penalty > 0 and reward > 0:
             reward = 0
-        # Save new info into _Memory
-        _Memory.info = info
+        self.prev_steering = steering
         return reward - jerk_penalty
 
-    return _reward_fn
+    def batch(self, dones, throttles, steerings, ctes, rewards=None, episode_starts=None):
+        steerings = np.asarray(steerings, dtype=np.float32)
+        if rewards is None:
+            rewards = np.zeros(len(steerings), dtype=np.float32)
+        prev_steerings = np.empty_like(steerings)
+        prev_steerings[0] = 0.
+        prev_steerings[1:] = steerings[:-1]
+        if episode_starts is not None:
+            prev_steerings[np.asarray(episode_starts, dtype=bool)] = 0.
+
+        errors = np.abs(prev_steerings - steerings) - self.max_steering_diff
+        jerk_penalties = np.where(errors > 0, self.steering_diff_reward_weight * (1 + errors ** 2), 0.)
+        # Cancel reward if the continuity constrain is violated
+        rewards = np.where((jerk_penalties > 0) & (rewards > 0), 0., rewards)
+        return (rewards - jerk_penalties).astype(np.float32)
+
+
+class ChainedReward(RewardFunction):
+    """
+    Each reward function is given the reward of the previous one.
+
+    :param reward_fns: ([RewardFunction])
+    """
+    def __init__(self, *reward_fns):
+        self.reward_fns = reward_fns
+
+    def reset(self):
+        for reward_fn in self.reward_fns:
+            reward_fn.reset()
+
+    def __call__(self, reward, done, info):
+        for reward_fn in self.reward_fns:
+            reward = reward_fn(reward, done, info)
+        return reward
+
+    def batch(self, dones, throttles, steerings, ctes, rewards=None, episode_starts=None):
+        for reward_fn in self.reward_fns:
+            rewards = reward_fn.batch(dones, throttles, steerings, ctes, rewards, episode_starts)
+        return rewards
+
+
+def speed(min_throttle, max_throttle,
+          base_reward_weight, throttle_reward_weight,
+          crash_reward_weight, crash_speed_reward_weight):
+    """
+    :return: (SpeedReward)
+    """
+    return SpeedReward(min_throttle, max_throttle,
+                       base_reward_weight, throttle_reward_weight,
+                       crash_reward_weight, crash_speed_reward_weight)
+
+
+def smooth_driving(max_steering_diff, steering_diff_reward_weight):
+    """
+    :return: (SmoothDrivingReward)
+    """
+    return SmoothDrivingReward(max_steering_diff, steering_diff_reward_weight)
+
+
+def relabel(reward_fn, dataset):
+    """
+    Compute the rewards of recorded episodes with another reward function, from the info recorded
+    at each step: with frame skip, the reward function sees the last frame of each step only.
+
+    :param reward_fn: (RewardFunction)
+    :param dataset: (EpisodeDataset)
+    :return: (np.ndarray) reward of each row, 0 for the resets
+    """
+    steps = dataset.column("step")
+    transitions = steps > 0
+    relabeled = np.zeros(len(steps), dtype=np.float32)
+    relabeled[transitions] = reward_fn.batch(dataset.column("done")[transitions],
+                                             dataset.column("throttle")[transitions],
+                                             dataset.column("steering")[transitions],
+                                             dataset.column("cte")[transitions],
+                                             episode_starts=steps[transitions] == 1)
+    return relabeled
@@ -0,0 +1,235 @@
+import multiprocessing
+import os
+import signal
+import tempfile
+import traceback
+
+import numpy as np
+
+from xebikart.gym.utils import find_free_port
+
+
+def _unity_process(env):
+    """
+    :return: (DonkeyUnityProcess) simulator of a (wrapped) DonkeyEnv, None if it has none
+    """
+    return getattr(env.unwrapped, "unity_process", None)
+
+
+def _worker(remote, parent_remote, env_fn, port, observation_timeout):
+    """
+    Run one environment, its observations are written to the shared observation file.
+    """
+    parent_remote.close()
+    env = None
+    try:
+        if observation_timeout is not None:
+            env = env_fn(port=port, observation_timeout=observation_timeout)
+        else:
+            env = env_fn(port=port)
+        unity_process = _unity_process(env)
+        unity_pid = unity_process.process.pid if unity_process is not None and unity_process.process else None
+        remote.send(("spaces", (env.observation_space, env.action_space, unity_pid)))
+
+        _, (path, index, n_envs) = remote.recv()
+        observations = np.memmap(path, dtype=env.observation_space.dtype, mode="r+",
+                                 shape=(n_envs,) + env.observation_space.shape)
+        while True:
+            cmd, data = remote.recv()
+            if cmd == "step":
+                if unity_process is not None and unity_process.process is not None \
+                        and not unity_process.is_alive():
+                    raise RuntimeError("Simulator on port {} is not running".format(port))
+                observation, reward, done, info = env.step(data)
+                if done:
+                    info["terminal_observation"] = np.array(observation)
+                    observation = env.reset()
+                observations[index] = observation
+                remote.send(("step", (reward, done, info)))
+            elif cmd == "reset":
+                observations[index] = env.reset()
+                remote.send(("reset", None))
+            elif cmd == "close":
+                break
+            else:
+                raise NotImplementedError(cmd)
+    except KeyboardInterrupt:
+        pass
+    except Exception:
+        try:
+            remote.send(("error", traceback.format_exc()))
+        except (BrokenPipeError, EOFError):
+            pass
+    finally:
+        if env is not None:
+            env.close()
+        remote.close()
+
+
+class DonkeyVecEnv(object):
+    """
+    Run `n_envs` environments, each with its own simulator, in worker processes.
+
+    Each environment is created in its worker by `env_fn(port=port, observation_timeout=observation_timeout)`
+    on a free port, e.g. `functools.partial(create_env, vae)` or `DonkeyEnv`. Observations are written by the workers
+    to a shared memory file and returned as one batch. Like stable-baselines vectorized environments,
+    an environment is reset as soon as it is done, and its last observation is in info["terminal_observation"].
+
+    A worker whose simulator crashed, disconnected or stopped sending telemetry for `observation_timeout`
+    seconds is restarted on a new port, the environment is then reported as done, with info["crashed"] = True.
+
+    :param env_fn: function creating an environment, with `port` and `observation_timeout` keyword arguments
+    :param n_envs: (int)
+    :param start_method: (str) multiprocessing start method, env_fn must be picklable for "spawn"
+    :param observation_timeout: (float) seconds without telemetry before a simulator is considered frozen,
+        None to call `env_fn(port=port)` only, a frozen simulator is then never detected
+    """
+
+    def __init__(self, env_fn, n_envs, start_method="fork", observation_timeout=60.):
+        self.env_fn = env_fn
+        self.observation_timeout = observation_timeout
+        self.num_envs = n_envs
+        self.context = multiprocessing.get_context(start_method)
+        self.closed = False
+        self.waiting = False
+
+        self.processes = [None] * n_envs
+        self.remotes = [None] * n_envs
+        self.unity_pids = [None] * n_envs
+        self.ports = [None] * n_envs
+        # simulators are started in parallel
+        for index in range(n_envs):
+            self._start_worker(index)
+        spaces = [self._wait_worker(index) for index in range(n_envs)]
+        self.observation_space, self.action_space = spaces[0]
+
+        shared_directory = "/dev/shm" if os.path.isdir("/dev/shm") else None
+        observations_file = tempfile.NamedTemporaryFile(prefix="donkey-vec-env-", dir=shared_directory,
+                                                        delete=False)
+        self.observations_path = observations_file.name
+        observations_file.close()
+        self.observations = np.memmap(self.observations_path, dtype=self.observation_space.dtype, mode="w+",
+                                      shape=(n_envs,) + self.observation_space.shape)
+        for index in range(n_envs):
+            self._attach(index)
+
+    def _start_worker(self, index):
+        port = find_free_port()
+        remote, work_remote = self.context.Pipe()
+        process = self.context.Process(target=_worker, daemon=True,
+                                       args=(work_remote, remote, self.env_fn, port, self.observation_timeout))
+        process.start()
+        work_remote.close()
+        self.processes[index] = process
+        self.remotes[index] = remote
+        self.ports[index] = port
+
+    def _wait_worker(self, index):
+        """
+        :return: (gym.Space, gym.Space) observation and action spaces of the environment
+        """
+        try:
+            cmd, data = self.remotes[index].recv()
+        except EOFError:
+            cmd, data = "error", "worker died"
+        if cmd == "error":
+            raise RuntimeError("Unable to start environment {} on port {}:\n{}".format(index, self.ports[index], data))
+        observation_space, action_space, self.unity_pids[index] = data
+        print("Environment {} started on port {}".format(index, self.ports[index]))
+        return observation_space, action_space
+
+    def _attach(self, index):
+        self.remotes[index].send(("attach", (self.observations_path, index, self.num_envs)))
+
+    def _stop_worker(self, index):
+        remote, process = self.remotes[index], self.processes[index]
+        try:
+            remote.send(("close", None))
+        except (BrokenPipeError, EOFError, OSError):
+            pass
+        process.join(10)
+        if process.is_alive():
+            process.terminate()
+            process.join()
+        remote.close()
+        # the simulator runs in its own process group, do not leave it behind
+        if self.unity_pids[index] is not None:
+            try:
+                os.killpg(os.getpgid(self.unity_pids[index]), signal.SIGTERM)
+            except (ProcessLookupError, PermissionError):
+                pass
+
+    def _restart_worker(self, index, error):
+        print("Restarting environment {}: {}".format(index, error))
+        terminal_observation = np.array(self.observations[index])
+        self._stop_worker(index)
+        self._start_worker(index)
+        self._wait_worker(index)
+        self._attach(index)
+        self.remotes[index].send(("reset", None))
+        self._receive(index, "reset")
+        return 0., True, {"crashed": True, "terminal_observation": terminal_observation}
+
+    def _receive(self, index, expected):
+        """
+        :return: the reply of the worker, or raises RuntimeError if it failed
+        """
+        try:
+            cmd, data = self.remotes[index].recv()
+        except (EOFError, ConnectionResetError) as e:
+            raise RuntimeError("Worker died: {}".format(e))
+        if cmd == "error":
+            raise RuntimeError(data)
+        assert cmd == expected
+        return data
+
+    def reset(self):
+        """
+        :return: (np.ndarray) observations
+        """
+        for remote in self.remotes:
+            remote.send(("reset", None))
+        for index in range(self.num_envs):
+            try:
+                self._receive(index, "reset")
+            except RuntimeError as e:
+                self._restart_worker(index, e)
+        return np.array(self.observations)
+
+    def step_async(self, actions):
+        for remote, action in zip(self.remotes, actions):
+            remote.send(("step", action))
+        self.waiting = True
+
+    def step_wait(self):
+        """
+        :return: (np.ndarray, np.ndarray, np.ndarray, [dict]) observations, rewards, dones and infos
+        """
+        results = []
+        for index in range(self.num_envs):
+            try:
+                results.append(self._receive(index, "step"))
+            except RuntimeError as e:
+                results.append(self._restart_worker(index, e))
+        self.waiting = False
+        rewards, dones, infos = zip(*results)
+        return np.array(self.observations), np.array(rewards, dtype=np.float32), np.array(dones), list(infos)
+
+    def step(self, actions):
+        self.step_async(actions)
+        return self.step_wait()
+
+    def close(self):
+        if self.closed:
+            return
+        if self.waiting:
+            for index in range(self.num_envs):
+                try:
+                    self._receive(index, "step")
+                except RuntimeError:
+                    pass
+        for index in range(self.num_envs):
+            self._stop_worker(index)
+        del self.observations
+        os.remove(self.observations_path)
+        self.closed = True
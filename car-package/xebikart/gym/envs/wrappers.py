@@ -4,6 +4,8 @@ from gym.core import Wrapper, ObservationWrapper, ActionWrapper
 from gym.spaces import Box
 
 import xebikart.images.transformer as images_transformer
+from xebikart.gym.envs.encoder import BatchedVAEEncoder
+from xebikart.history import CommandHistory
 
 
 class CropObservationWrapper(ObservationWrapper):
@@ -73,19 +75,24 @@ class EdgingObservationWrapper(ObservationWrapper):
 
 
 class ConvVariationalAutoEncoderObservationWrapper(ObservationWrapper):
-    def __init__(self, env, vae):
+    def __init__(self, env, vae, encoder=None):
         """
         Apply VAE (Variational Auto Encoder) on observation.
         Based on keras implementation
 
         :param env:
         :param vae: tensorflow.keras.model
+        :param encoder: (BatchedVAEEncoder) shared by environments running in threads,
+            a new one is created by default
         """
         super(ConvVariationalAutoEncoderObservationWrapper, self).__init__(env)
 
         self.vae = vae
         self.vae_input_shape = self.vae.input_shape[1:]
         z_size = self.vae.output_shape[1]
+        if encoder is None:
+            encoder = BatchedVAEEncoder(vae)
+        self.encoder = encoder
 
         original_shape = self.env.observation_space.shape
 
@@ -97,9 +104,7 @@ class ConvVariationalAutoEncoderObservationWrapper(ObservationWrapper):
                                      dtype=np.float32)
 
     def observation(self, observation):
-        normalize_obs = observation / 255.
-        normalize_obs = np.expand_dims(normalize_obs, 0)
-        return np.squeeze(self.vae.predict(normalize_obs))
+        return self.encoder.encode_one(observation)
 
 
 class HistoryBasedWrapper(Wrapper):
@@ -122,8 +127,7 @@ class HistoryBasedWrapper(Wrapper):
         # Save last n commands (throttle + steering)
         self.n_commands = self.env.action_space.shape[0]
         self.n_command_history = n_command_history
-        # shape (1, x) to keep same as observation
-        self.command_history = np.zeros(self.n_commands * self.n_command_history)
+        self.history = CommandHistory(self.n_commands, self.n_command_history)
 
         # Max steering diff
         self.max_steering_diff = max_steering_diff
@@ -134,8 +138,12 @@ class HistoryBasedWrapper(Wrapper):
                                      shape=(original_shape + self.n_commands * self.n_command_history,),
                                      dtype=self.env.observation_space.dtype)
 
+    @property
+    def command_history(self):
+        return self.history.commands.reshape(-1)
+
     def reset(self, **kwargs):
-        self.command_history = np.zeros(self.n_commands * self.n_command_history)
+        self.history.reset()
         observation = self.env.reset(**kwargs)
         return self.observation(observation)
 
@@ -146,7 +154,7 @@ class HistoryBasedWrapper(Wrapper):
 
     def action(self, action):
         # Clip steering angle rate to enforce continuity
-        prev_steering = self.command_history[-2]
+        prev_steering = self.history.last[0]
         # Add an extra at clipping to penalty in case of bad decision
         # Take a look at reward function
         max_diff = self.max_steering_diff + 1e-5
@@ -154,13 +162,12 @@ class HistoryBasedWrapper(Wrapper):
         action[0] = prev_steering + diff
 
         # Update command history
-        self.command_history = np.roll(self.command_history, shift=-self.n_commands)
-        self.command_history[-self.n_commands:] = action
+        self.history.append(action)
         return action
 
     def observation(self, observation):
-        command_history_reshaped = np.concatenate((observation, self.command_history), axis=-1)
-        return np.squeeze(command_history_reshaped)
+        # a new array, observations may be kept by the agent
+        return self.history.observation(observation)
 
 
 class ClipSteeringBasedOnPrevious(ActionWrapper):
@@ -0,0 +1,261 @@
+"""
+Replay buffer stored in memory-mapped files, to keep millions of transitions on disk.
+
+    buffer = ReplayBuffer("runs/replay", capacity=2000000, observation_shape=(52,), action_shape=(2,),
+                          storage_dtype=np.float16)
+    buffer.add(observation, action, reward, next_observation, done)
+    observations, actions, rewards, next_observations, dones = buffer.sample(256)
+    buffer.save()
+    ...
+    buffer = ReplayBuffer.open("runs/replay")
+
+It has the add / sample / can_sample / len interface of the stable-baselines replay buffer,
+and can replace it on a model, e.g. `model.replay_buffer = buffer`.
+
+Stacked observations of a FrameStack are stored as the index of their frames, each frame is stored once:
+
+    buffer = ReplayBuffer("runs/replay", capacity=500000, observation_shape=(4, 80, 160, 2), action_shape=(2,),
+                          storage_dtype=np.uint8, frame_stack=4)
+"""
+
+import json
+import os
+
+import numpy as np
+
+METADATA_FILE = "replay_buffer.json"
+
+
+class ReplayBuffer(object):
+    """
+    Circular buffer of transitions in preallocated .npy files of `path`, an existing buffer is overwritten.
+
+    :param path: (str) directory
+    :param capacity: (int) number of transitions
+    :param observation_shape: (tuple)
+    :param action_shape: (tuple)
+    :param observation_dtype: (np.dtype) of the sampled observations
+    :param storage_dtype: (np.dtype) of the stored observations, e.g. np.float16 for latent vectors
+        or np.uint8 for images, observation_dtype by default. Float observations stored as unsigned
+        integers are expected in [0, 1], and scaled to the range of the integer, e.g. [0, 255] for np.uint8
+    :param pack_bits: (bool) observations are binary, e.g. edges, and stored as bits
+    :param action_dtype: (np.dtype)
+    :param frame_stack: (int) observations are stacks of `frame_stack` frames, as returned by FrameStack,
+        observation_shape included. Only the last frame of the observations is stored, and the stacks are
+        rebuilt from the index of their frames, the first frame of the episode being repeated.
+        Transitions must be added in order, from a single environment
+    :param seed: (int) seed of the sampling
+    """
+    def __init__(self, path, capacity, observation_shape, action_shape, observation_dtype=np.float32,
+                 storage_dtype=None, pack_bits=False, action_dtype=np.float32, frame_stack=1, seed=None):
+        self._setup(path, capacity, observation_shape, action_shape, observation_dtype, storage_dtype,
+                    pack_bits, action_dtype, frame_stack, seed)
+        os.makedirs(path, exist_ok=True)
+        for name in self.specs:
+            shape, dtype = self.specs[name]
+            self.arrays[name] = np.lib.format.open_memmap(self._array_path(name), mode="w+", dtype=dtype,
+                                                          shape=(capacity,) + shape)
+        self.save()
+
+    def _setup(self, path, capacity, observation_shape, action_shape, observation_dtype, storage_dtype,
+               pack_bits, action_dtype, frame_stack, seed):
+        self.path = path
+        self.capacity = capacity
+        self.observation_shape = tuple(observation_shape)
+        self.action_shape = tuple(action_shape)
+        self.observation_dtype = np.dtype(observation_dtype)
+        self.storage_dtype = np.dtype(storage_dtype if storage_dtype is not None else observation_dtype)
+        self.pack_bits = pack_bits
+        self.action_dtype = np.dtype(action_dtype)
+        self.frame_stack = frame_stack
+        if frame_stack > 1 and (len(self.observation_shape) < 2 or self.observation_shape[0] != frame_stack):
+            raise ValueError("observation_shape {} is not a stack of {} frames"
+                             .format(self.observation_shape, frame_stack))
+        # shape of the stored observations, the last frame of the stacks
+        self.frame_shape = self.observation_shape[1:] if frame_stack > 1 else self.observation_shape
+        # float observations quantized to integers
+        self.scale = None
+        if not pack_bits and self.observation_dtype.kind == "f" and self.storage_dtype.kind in "iu":
+            if self.storage_dtype.kind != "u":
+                raise ValueError("float observations can not be stored as {}, use an unsigned integer dtype"
+                                 .format(self.storage_dtype))
+            self.scale = float(np.iinfo(self.storage_dtype).max)
+        self.position = 0
+        self.size = 0
+        self.random = np.random.RandomState(seed)
+
+        self.observation_size = int(np.prod(self.frame_shape))
+        if pack_bits:
+            stored_observation = ((self.observation_size + 7) // 8,), np.uint8
+        else:
+            stored_observation = self.frame_shape, self.storage_dtype
+        self.specs = {
+            "observations": stored_observation,
+            "actions": (self.action_shape, self.action_dtype),
+            "rewards": ((), np.float32),
+            "next_observations": stored_observation,
+            "dones": ((), np.bool_)
+        }
+        if frame_stack > 1:
+            # number of previous frames of the episode in the stack of the observation, at most frame_stack - 1
+            self.specs["histories"] = ((), np.int8 if frame_stack <= 128 else np.int32)
+        self.arrays = {}
+
+    @classmethod
+    def open(cls, path, seed=None):
+        """
+        Resume a saved buffer.
+
+        :param path: (str) directory
+        :param seed: (int)
+        :return: (ReplayBuffer)
+        """
+        with open(os.path.join(path, METADATA_FILE)) as f:
+            metadata = json.load(f)
+        buffer = cls.__new__(cls)
+        buffer._setup(path, metadata["capacity"], metadata["observation_shape"], metadata["action_shape"],
+                      metadata["observation_dtype"], metadata["storage_dtype"], metadata["pack_bits"],
+                      metadata["action_dtype"], metadata.get("frame_stack", 1), seed)
+        buffer.position = metadata["position"]
+        buffer.size = metadata["size"]
+        for name in buffer.specs:
+            buffer.arrays[name] = np.load(buffer._array_path(name), mmap_mode="r+")
+        return buffer
+
+    def _array_path(self, name):
+        return os.path.join(self.path, name + ".npy")
+
+    def save(self):
+        """
+        Flush the arrays and write the position, transitions added after are lost if the buffer is not saved again.
+        """
+        for array in self.arrays.values():
+            array.flush()
+        metadata = {
+            "capacity": self.capacity,
+            "observation_shape": list(self.observation_shape),
+            "action_shape": list(self.action_shape),
+            "observation_dtype": self.observation_dtype.str,
+            "storage_dtype": self.storage_dtype.str,
+            "pack_bits": self.pack_bits,
+            "action_dtype": self.action_dtype.str,
+            "frame_stack": self.frame_stack,
+            "position": self.position,
+            "size": self.size
+        }
+        metadata_path = os.path.join(self.path, METADATA_FILE)
+        with open(metadata_path + ".tmp", "w") as f:
+            json.dump(metadata, f)
+        os.replace(metadata_path + ".tmp", metadata_path)
+
+    def close(self):
+        self.save()
+        self.arrays = {}
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def buffer_size(self):
+        return self.capacity
+
+    def can_sample(self, n_samples):
+        return self.size >= n_samples
+
+    def is_full(self):
+        return self.size == self.capacity
+
+    def _encode_observations(self, observations):
+        observations = np.asarray(observations)
+        if self.pack_bits:
+            observations = observations.reshape(observations.shape[:-len(self.frame_shape)] + (-1,))
+            return np.packbits(observations != 0, axis=-1)
+        if self.scale is not None:
+            return np.rint(np.clip(observations, 0., 1.) * self.scale).astype(self.storage_dtype)
+        return observations
+
+    def _decode_observations(self, observations):
+        if self.pack_bits:
+            observations = np.unpackbits(observations, axis=-1)[..., :self.observation_size]
+            observations = observations.reshape(observations.shape[:-1] + self.frame_shape)
+        if self.scale is not None:
+            return observations.astype(self.observation_dtype) / self.observation_dtype.type(self.scale)
+        return observations.astype(self.observation_dtype, copy=False)
+
+    def add(self, observation, action, reward, next_observation, done):
+        """
+        :param observation: (np.ndarray)
+        :param action: (np.ndarray)
+        :param reward: (float)
+        :param next_observation: (np.ndarray)
+        :param done: (bool)
+        """
+        index = self.position
+        if self.frame_stack > 1:
+            # LazyFrames are not stacked to get their last frame
+            observation, next_observation = observation[-1], next_observation[-1]
+            previous = (index - 1) % self.capacity
+            if self.size == 0 or self.arrays["dones"][previous]:
+                self.arrays["histories"][index] = 0
+            else:
+                self.arrays["histories"][index] = min(self.arrays["histories"][previous] + 1, self.frame_stack - 1)
+        self.arrays["observations"][index] = self._encode_observations(observation)
+        self.arrays["actions"][index] = action
+        self.arrays["rewards"][index] = reward
+        self.arrays["next_observations"][index] = self._encode_observations(next_observation)
+        self.arrays["dones"][index] = done
+        self.position = (self.position + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    def extend(self, observations, actions, rewards, next_observations, dones):
+        """
+        Add a batch of transitions, e.g. a step of vectorized environments.
+        """
+        if self.frame_stack > 1:
+            raise ValueError("stacked observations are added one transition at a time, with add")
+        indexes = (self.position + np.arange(len(rewards))) % self.capacity
+        self.arrays["observations"][indexes] = self._encode_observations(observations)
+        self.arrays["actions"][indexes] = actions
+        self.arrays["rewards"][indexes] = rewards
+        self.arrays["next_observations"][indexes] = self._encode_observations(next_observations)
+        self.arrays["dones"][indexes] = dones
+        self.position = (self.position + len(rewards)) % self.capacity
+        self.size = min(self.size + len(rewards), self.capacity)
+
+    def sample(self, batch_size, env=None):
+        """
+        :param batch_size: (int)
+        :param env: ignored, for compatibility with stable-baselines
+        :return: (np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray)
+            observations, actions, rewards, next observations and dones, as float
+        """
+        # sorted indexes read the files sequentially
+        indexes = np.sort(self.random.randint(0, self.size, size=batch_size))
+        if self.frame_stack > 1:
+            observations, next_observations = self._sample_stacks(indexes)
+        else:
+            observations = self._decode_observations(self.arrays["observations"][indexes])
+            next_observations = self._decode_observations(self.arrays["next_observations"][indexes])
+        return (observations,
+                self.arrays["actions"][indexes],
+                self.arrays["rewards"][indexes],
+                next_observations,
+                self.arrays["dones"][indexes].astype(np.float32))
+
+    def _sample_stacks(self, indexes):
+        """
+        :param indexes: (np.ndarray) of the transitions
+        :return: (np.ndarray, np.ndarray) stacked observations and next observations
+        """
+        # the oldest transitions may refer to frames already overwritten, they repeat their oldest frame left
+        ages = (self.position - 1 - indexes) % self.capacity
+        histories = np.minimum(self.arrays["histories"][indexes], self.size - 1 - ages)
+        # frame k of a stack is the last frame of the observation frame_stack - 1 - k transitions before
+        offsets = np.arange(self.frame_stack - 1, -1, -1)
+        frame_indexes = (indexes[:, None] - np.minimum(offsets[None, :], histories[:, None])) % self.capacity
+        frames = self._decode_observations(self.arrays["observations"][frame_indexes.ravel()])
+        observations = frames.reshape((len(indexes),) + self.observation_shape)
+        next_observations = np.empty_like(observations)
+        next_observations[:, :-1] = observations[:, 1:]
+        next_observations[:, -1] = self._decode_observations(self.arrays["next_observations"][indexes])
+        return observations, next_observations
@@ -3,6 +3,7 @@ import zipfile
 import shutil
 import platform
 import os
+import socket
 
 
 def download_simulator(url, output_path):
@@ -96,3 +97,12 @@ def is_os_x():
 def assert_supported_version():
     if not is_linux() and not is_os_x():
         raise RuntimeError("Only support Linux or Darwin platform.")
+
+
+def find_free_port():
+    """
+    :return: (int) a TCP port free at the time of the call
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('', 0))
+        return sock.getsockname()[1]
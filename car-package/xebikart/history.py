@@ -0,0 +1,63 @@
+import numpy as np
+
+
+class CommandHistory(object):
+    """
+    Last `n_history` commands, appended to the observations of the models using them,
+    in the gym environments and on the car.
+
+    Each command is written twice in a buffer of 2 * n_history commands, so that the history,
+    oldest first, is always a contiguous view and nothing is allocated per step.
+
+    :param n_commands: (int) size of a command, e.g. 2 for steering and throttle
+    :param n_history: (int) number of commands
+    :param dtype: (np.dtype)
+    """
+    def __init__(self, n_commands, n_history, dtype=np.float32):
+        self.n_commands = n_commands
+        self.n_history = n_history
+        self.size = n_commands * n_history
+        self.buffer = np.zeros((2 * n_history, n_commands), dtype=dtype)
+        # index of the oldest command
+        self.position = 0
+
+    def reset(self):
+        self.buffer[:] = 0
+        self.position = 0
+
+    def append(self, command):
+        """
+        :param command: (np.ndarray) replaces the oldest command
+        """
+        self.buffer[self.position] = command
+        self.buffer[self.position + self.n_history] = command
+        self.position = (self.position + 1) % self.n_history
+
+    @property
+    def commands(self):
+        """
+        :return: (np.ndarray) view of the commands, oldest first, (n_history, n_commands)
+        """
+        return self.buffer[self.position:self.position + self.n_history]
+
+    @property
+    def last(self):
+        """
+        :return: (np.ndarray) view of the last command
+        """
+        return self.buffer[self.position + self.n_history - 1]
+
+    def observation(self, observation, out=None):
+        """
+        Observation followed by the commands, oldest first.
+
+        :param observation: (np.ndarray) 1D
+        :param out: (np.ndarray) preallocated output, of size len(observation) + size
+        :return: (np.ndarray) out, or a new array
+        """
+        observation_size = observation.shape[-1]
+        if out is None:
+            out = np.empty(observation_size + self.size, dtype=self.buffer.dtype)
+        out[:observation_size] = observation
+        out[observation_size:] = self.commands.reshape(-1)
+        return out
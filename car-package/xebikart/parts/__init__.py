@@ -1,6 +1,3 @@
-from donkeycar.parts.transform import Lambda
-
-
 def add_mqtt_image_base64_publisher(vehicle, cfg, topic, car_id, camera_input):
     from xebikart.parts.mqtt import FrameMQTTPublisher
     from xebikart.parts.image import EncodeToBase64
@@ -11,14 +8,23 @@ def add_mqtt_image_base64_publisher(vehicle, cfg, topic, car_id, camera_input):
     vehicle.add(publisher, inputs=["encoder/base64"], threaded=True)
 
 
+def add_mjpeg_preview_server(vehicle, camera_input, port=8887, max_fps=10., max_clients=4):
+    from xebikart.parts.preview import MJPEGPreviewServer
+
+    preview = MJPEGPreviewServer(port=port, max_fps=max_fps, max_clients=max_clients)
+    vehicle.add(preview, inputs=[camera_input], threaded=True)
+
+
 def add_mqtt_metadata_publisher(vehicle, cfg, topic, car_id,
                                 steering="user/angle", throttle="user/throttle", mode="user/mode",
                                 location="lidar/position",
                                 borders="lidar/borders",
+                                deadbands=None, keyframe_interval=5.
                                 ):
     from xebikart.parts.mqtt import MetadataMQTTPublisher
 
-    mqtt_client = MetadataMQTTPublisher(car_id, cfg=cfg, topic=topic, publish_delay=0.1)
+    mqtt_client = MetadataMQTTPublisher(car_id, cfg=cfg, topic=topic, publish_delay=0.1,
+                                        deadbands=deadbands, keyframe_interval=keyframe_interval)
     vehicle.add(
         mqtt_client,
         inputs=[
@@ -64,6 +70,8 @@ def add_lidar_sensor(vehicle, cfg, position="lidar/position", borders="lidar/bor
 
 
 def add_logger(vehicle, prefix, input):
+    from donkeycar.parts.transform import Lambda
+
     def _log(i):
         print(prefix, ": ", i)
 
@@ -43,10 +43,18 @@ class ExtractColorAreaInBox:
         return detect.bounding_color_area_in_box(img_arr, self.color_to_detect, self.epsilon, self.nb_pixel_min)
 
 
+def encode_jpeg(img_arr, quality=75):
+    """
+    :param img_arr: (np.ndarray) RGB image
+    :param quality: (int) jpeg quality, from 1 to 95
+    :return: (bytes) jpeg frame
+    """
+    img = Image.fromarray(np.uint8(img_arr))
+    bytes = BytesIO()
+    img.save(bytes, format='jpeg', quality=quality)
+    return bytes.getvalue()
+
+
 class EncodeToBase64:
     def run(self, img_arr):
-        img = Image.fromarray(np.uint8(img_arr))
-        bytes = BytesIO()
-        img.save(bytes, format='jpeg')
-        frame = bytes.getvalue()
-        return base64.b64encode(frame)
+        return base64.b64encode(encode_jpeg(img_arr))
@@ -4,6 +4,7 @@ import time
 from collections import deque
 from operator import itemgetter
 
+import numpy as np
 import serial
 from rplidar import RPLidar as rpl
 from xebikart.box import MinimumBoundingBox
@@ -13,6 +14,41 @@ ANGLE_MAX = 360
 ANGLE_HISTORY_LENGTH = 10
 
 
+def decimate_by_angle(angles, distances, resolution):
+    """
+    Keep the closest measure of each angular bin, bins are sorted by angle.
+
+    :param angles: (np.ndarray) degrees
+    :param distances: (np.ndarray)
+    :param resolution: (float) bin width in degrees
+    :return: (np.ndarray) indices of the kept measures
+    """
+    n_bins = int(math.ceil(ANGLE_MAX / resolution))
+    bins = (np.asarray(angles) // resolution).astype(np.int64) % n_bins
+    # sort by bin, then by distance: the first measure of each bin is the closest one
+    order = np.lexsort((distances, bins))
+    sorted_bins = bins[order]
+    first_of_bin = np.empty(len(order), dtype=bool)
+    first_of_bin[:1] = True
+    first_of_bin[1:] = sorted_bins[1:] != sorted_bins[:-1]
+    return order[first_of_bin]
+
+
+def decimate_by_grid(positions, cell_size):
+    """
+    Keep the first point of each grid cell, in the original order.
+
+    :param positions: (np.ndarray) shape (n, 2)
+    :param cell_size: (float) in the unit of positions
+    :return: (np.ndarray) indices of the kept points
+    """
+    if len(positions) == 0:
+        return np.zeros(0, dtype=np.int64)
+    cells = np.floor_divide(positions, cell_size).astype(np.int64)
+    _, indices = np.unique(cells, axis=0, return_index=True)
+    return np.sort(indices)
+
+
 # These sample was extracted and adapted from donkeycar parts samples. Original version can be found here:
 # https://github.com/autorope/donkeycar/blob/dev/donkeycar/parts/lidar.py
 # donkeycar setup does not automatically include theses parts, not sure why yet...
@@ -50,13 +86,23 @@ class LidarScan(object):
 
 
 class LidarPosition:
+    """
+    Position of the car in the room, from the minimum bounding box of the lidar measures.
+
+    Borders are decimated once per scan, before being published or used on the car:
+    one point per angular bin of `border_angle_resolution` degrees (the closest one),
+    then one point per grid cell of `border_grid_size` (lidar unit). None disables a stage.
+    The position is always computed from all measures.
+    """
 
-    def __init__(self, refresh_time_in_seconds=0.5):
+    def __init__(self, refresh_time_in_seconds=0.5, border_angle_resolution=2., border_grid_size=None):
         self.measures = []
         self.angle_history = deque([])
         self.position = (0, 0, 0)
         self.border_positions = []
         self.refresh_time_in_seconds = refresh_time_in_seconds
+        self.border_angle_resolution = border_angle_resolution
+        self.border_grid_size = border_grid_size
         self.on = True
 
     def choose_angle(self, corner_points, angle):
@@ -79,13 +125,23 @@ class LidarPosition:
 
         return angle1 if angle_delta_sum1 < angle_delta_sum2 else angle2
 
-    def measures_to_positions(self):
-        return [
-            (
-                int(distance * math.sin(math.radians(angle))),
-                int(distance * math.cos(math.radians(angle)))
-            ) for (angle, distance) in self.measures
-        ]
+    def measures_to_positions(self, measures=None):
+        measures = np.asarray(self.measures if measures is None else measures, dtype=np.float64)
+        angles = np.radians(measures[:, 0])
+        distances = measures[:, 1]
+        # truncate like int()
+        return np.stack([
+            (distances * np.sin(angles)).astype(np.int64),
+            (distances * np.cos(angles)).astype(np.int64)
+        ], axis=1)
+
+    def decimate_borders(self, measures, positions):
+        indices = np.arange(len(positions))
+        if self.border_angle_resolution is not None:
+            indices = decimate_by_angle(measures[:, 0], measures[:, 1], self.border_angle_resolution)
+        if self.border_grid_size is not None:
+            indices = indices[decimate_by_grid(positions[indices], self.border_grid_size)]
+        return positions[indices]
 
     def rotate(self, point, angle):
         rotation_angle = math.radians(-angle)
@@ -107,7 +163,8 @@ class LidarPosition:
             if len(self.measures) < 1:
                 continue
 
-            positions = self.measures_to_positions()
+            measures = np.asarray(self.measures, dtype=np.float64)
+            positions = self.measures_to_positions(measures)
 
             bounding_box = MinimumBoundingBox(positions)
             bounding_box_angle = math.degrees(bounding_box.unit_vector_angle) % 360
@@ -117,7 +174,7 @@ class LidarPosition:
             rotated_corner_points = [self.rotate(point, angle) for point in bounding_box.corner_points]
             position = self.corner_points_to_position(rotated_corner_points)
 
-            self.border_positions = [[x, y] for (x, y) in positions]
+            self.border_positions = self.decimate_borders(measures, positions).tolist()
             self.position = (angle, position[0], position[1])
             self.angle_history.append(angle)
             if len(self.angle_history) > ANGLE_HISTORY_LENGTH:
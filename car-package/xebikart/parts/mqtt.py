@@ -1,34 +1,531 @@
 import json
 import logging
+import mmap
+import os
 import queue
+import struct
+import threading
 import time
+from collections import Counter, OrderedDict
 
 import paho.mqtt.client as mqtt
 
-
-class MQTTClient:
-
-    def __init__(self, cfg, publish_delay=1):
-        self.publish_delay = publish_delay
-
-        self.client = mqtt.Client()
+# Outgoing traffic classes, from the most to the least urgent
+PRIORITY_TELEMETRY = 1
+PRIORITY_BULK = 2
+
+# Command type of messages published on the car topic itself
+DEFAULT_COMMAND = "mode"
+# Command type of messages published on the stop sub-topic, decoded as the stop mode
+STOP_COMMAND = "stop"
+# sub-topic of the car topic -> command type, messages on other sub-topics are ignored
+COMMAND_SUB_TOPICS = {"": DEFAULT_COMMAND, DEFAULT_COMMAND: DEFAULT_COMMAND, STOP_COMMAND: STOP_COMMAND}
+
+_shared_connections = {}
+_shared_connections_lock = threading.Lock()
+
+
+def shared_connection(cfg):
+    """
+    Get the MQTT connection shared by all parts of the car, it is created on first use.
+    Every caller must `release()` it on shutdown, the connection is closed with the last reference.
+
+    :param cfg: car config (RABBITMQ_*)
+    :return: MQTTConnection
+    """
+    key = (cfg.RABBITMQ_HOST, cfg.RABBITMQ_PORT, cfg.RABBITMQ_USERNAME)
+    with _shared_connections_lock:
+        connection = _shared_connections.get(key)
+        if connection is None or connection.closed:
+            spool = None
+            if getattr(cfg, "MQTT_SPOOL_PATH", None) is not None:
+                spool = MQTTSpool(cfg.MQTT_SPOOL_PATH, cfg.MQTT_SPOOL_SIZE)
+            connection = MQTTConnection(cfg, spool=spool)
+            _shared_connections[key] = connection
+        connection.acquire()
+        return connection
+
+
+def metadata_payload(car_id, mode, user_angle, user_throttle, location, borders):
+    """
+    Build the metadata message of a car.
+
+    :param location: (angle, x, y) from the lidar, or None
+    :param borders: [[x, y], ...] from the lidar
+    :return: (dict)
+    """
+    if location is None:
+        location = (0, 0, 0)
+    return {
+        'car': car_id,
+        'mode': mode,
+        'user': {
+            "angle": user_angle,
+            "throttle": user_throttle
+        },
+        'angle': location[0],
+        'position': {
+            'x': location[1],
+            'y': location[2]
+        },
+        'borders': borders
+    }
+
+
+def frame_payload(car_id, frame_base64):
+    """
+    Build the video message of a car.
+
+    :param frame_base64: (bytes) base64 encoded jpeg
+    :return: (dict)
+    """
+    return {
+        'car': car_id,
+        'frame': frame_base64.decode("utf-8")
+    }
+
+
+class _TopicNode:
+    __slots__ = ("children", "callbacks")
+
+    def __init__(self):
+        self.children = {}
+        self.callbacks = []
+
+
+class TopicRouter:
+    """
+    Dispatch topics to callbacks registered on MQTT topic filters, with `+` and `#` wildcards.
+    Filters are stored in a tree of topic levels: matching a topic costs its depth,
+    whatever the number of registered filters.
+    """
+
+    def __init__(self):
+        self.root = _TopicNode()
+        self.topic_filters = {}
+
+    def add(self, topic_filter, callback):
+        """
+        :return: (bool) True if the filter was not registered yet
+        """
+        node = self.root
+        for level in topic_filter.split("/"):
+            node = node.children.setdefault(level, _TopicNode())
+        node.callbacks.append(callback)
+        self.topic_filters[topic_filter] = self.topic_filters.get(topic_filter, 0) + 1
+        return self.topic_filters[topic_filter] == 1
+
+    def remove(self, topic_filter, callback):
+        """
+        :return: (bool) True if the filter has no more callbacks
+        """
+        path = [self.root]
+        for level in topic_filter.split("/"):
+            node = path[-1].children.get(level)
+            if node is None:
+                return False
+            path.append(node)
+        if callback not in path[-1].callbacks:
+            return False
+        path[-1].callbacks.remove(callback)
+        self.topic_filters[topic_filter] -= 1
+        if self.topic_filters[topic_filter] > 0:
+            return False
+        del self.topic_filters[topic_filter]
+        # prune empty branches
+        for parent, level, node in reversed(list(zip(path[:-1], topic_filter.split("/"), path[1:]))):
+            if node.callbacks or node.children:
+                break
+            del parent.children[level]
+        return True
+
+    def filters(self):
+        return list(self.topic_filters.keys())
+
+    def match(self, topic):
+        """
+        :param topic: (str)
+        :return: callbacks of all filters matching the topic
+        """
+        levels = topic.split("/")
+        callbacks = []
+        nodes = [self.root]
+        for depth, level in enumerate(levels):
+            next_nodes = []
+            for node in nodes:
+                # wildcards do not match topics starting with $ (broker topics)
+                if not (depth == 0 and level.startswith("$")):
+                    multi = node.children.get("#")
+                    if multi is not None:
+                        callbacks.extend(multi.callbacks)
+                    single = node.children.get("+")
+                    if single is not None:
+                        next_nodes.append(single)
+                exact = node.children.get(level)
+                if exact is not None:
+                    next_nodes.append(exact)
+            nodes = next_nodes
+            if not nodes:
+                return callbacks
+        for node in nodes:
+            callbacks.extend(node.callbacks)
+            # "a/#" also matches "a"
+            multi = node.children.get("#")
+            if multi is not None:
+                callbacks.extend(multi.callbacks)
+        return callbacks
+
+
+class MQTTSpool:
+    """
+    Size-capped ring of outgoing messages in a memory-mapped file, the oldest messages are dropped when it is full.
+    The file outlives the process: messages spooled before a restart are replayed on the next connection.
+
+    Each record is: u32 size of topic + payload, u16 size of topic, topic, payload.
+
+    :param path: (str) spool file
+    :param size: (int) capacity in bytes
+    """
+
+    HEADER = struct.Struct("<4sQQQQ")
+    RECORD = struct.Struct("<IH")
+    MAGIC = b"XKS1"
+    WRAP = 0xFFFFFFFF
+
+    def __init__(self, path, size):
+        self.path = path
+        self.capacity = size
+        self.lock = threading.Lock()
+        # number of records dropped on overflow, see commit()
+        self.dropped = 0
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        file_size = self.HEADER.size + size
+        with open(path, "a+b") as f:
+            if os.path.getsize(path) != file_size:
+                f.truncate(file_size)
+        self.file = open(path, "r+b")
+        self.mm = mmap.mmap(self.file.fileno(), file_size)
+
+        magic, self.head, self.tail, self.used, self.count = self.HEADER.unpack_from(self.mm, 0)
+        if magic != self.MAGIC or max(self.head, self.tail, self.used) > size:
+            self.head, self.tail, self.used, self.count = 0, 0, 0, 0
+            self._write_header()
+        elif self.count > 0:
+            logging.info("MQTT spool: %d messages left from a previous run", self.count)
+
+    def __len__(self):
+        return self.count
+
+    def _write_header(self):
+        self.HEADER.pack_into(self.mm, 0, self.MAGIC, self.head, self.tail, self.used, self.count)
+
+    def _read(self, head):
+        """
+        :return: (topic, payload, position after the record, bytes used by the record)
+        """
+        skipped = 0
+        if self.capacity - head < self.RECORD.size \
+                or self.RECORD.unpack_from(self.mm, self.HEADER.size + head)[0] == self.WRAP:
+            skipped = self.capacity - head
+            head = 0
+        size, topic_size = self.RECORD.unpack_from(self.mm, self.HEADER.size + head)
+        start = self.HEADER.size + head + self.RECORD.size
+        topic = self.mm[start:start + topic_size].decode("utf-8")
+        payload = self.mm[start + topic_size:start + size]
+        return topic, payload, head + self.RECORD.size + size, skipped + self.RECORD.size + size
+
+    def _pop(self):
+        _, _, self.head, used = self._read(self.head)
+        self.used -= used
+        self.count -= 1
+        if self.count == 0:
+            self.head, self.tail, self.used = 0, 0, 0
+
+    def append(self, topic, payload):
+        """
+        :return: (bool) False if the message is larger than the spool
+        """
+        topic = topic.encode("utf-8")
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        record_size = self.RECORD.size + len(topic) + len(payload)
+        if record_size > self.capacity:
+            return False
+
+        with self.lock:
+            while True:
+                wrap = self.tail + record_size > self.capacity
+                needed = record_size + (self.capacity - self.tail if wrap else 0)
+                if self.capacity - self.used >= needed:
+                    break
+                self._pop()
+                self.dropped += 1
+            if wrap:
+                if self.capacity - self.tail >= self.RECORD.size:
+                    self.RECORD.pack_into(self.mm, self.HEADER.size + self.tail, self.WRAP, 0)
+                self.used += self.capacity - self.tail
+                self.tail = 0
+            position = self.HEADER.size + self.tail
+            self.RECORD.pack_into(self.mm, position, len(topic) + len(payload), len(topic))
+            position += self.RECORD.size
+            self.mm[position:position + len(topic)] = topic
+            self.mm[position + len(topic):position + len(topic) + len(payload)] = payload
+            self.tail += record_size
+            self.used += record_size
+            self.count += 1
+            self._write_header()
+        return True
+
+    def peek(self, max_records):
+        """
+        Read the oldest records without removing them, see commit().
+
+        :return: ([(topic, payload)], marker to give to commit)
+        """
+        with self.lock:
+            records = []
+            head = self.head
+            for _ in range(min(max_records, self.count)):
+                topic, payload, head, _ = self._read(head)
+                records.append((topic, payload))
+            return records, self.dropped
+
+    def commit(self, n_records, marker):
+        """
+        Remove the first `n_records` returned by peek(), except those already dropped on overflow since.
+        """
+        with self.lock:
+            for _ in range(min(max(n_records - (self.dropped - marker), 0), self.count)):
+                self._pop()
+            self._write_header()
+
+    def close(self):
+        with self.lock:
+            self.mm.flush()
+            self.mm.close()
+            self.file.close()
+
+
+class MQTTConnection:
+    """
+    One paho client (one socket, one network thread) multiplexed between all parts of the car.
+
+    - Parts register topics with a paho style callback `fn(client, userdata, msg)`,
+      subscriptions are restored after each reconnection.
+      Incoming messages are dispatched with a TopicRouter.
+    - Telemetry messages are handed to paho right away.
+    - Bulk messages (video) are coalesced per topic, only the latest one is kept,
+      and no more than `max_inflight_bulk` of them are queued in paho at a time:
+      telemetry never waits behind a backlog of frames.
+    - Reconnection is done by the paho network thread, with an exponential backoff
+      between `min_reconnect_delay` and `max_reconnect_delay` seconds.
+      Creating the connection never blocks, even if the broker is down.
+    - With a `spool`, telemetry published while disconnected is appended to it, and replayed
+      after reconnection by batches of `replay_batch_size`, at most `replay_rate` messages per second.
+      Messages keep going through the spool until it is empty, so their order is preserved.
+      Bulk messages are not spooled, only the latest one matters.
+
+    :param cfg: car config (RABBITMQ_*)
+    :param client_id: (str)
+    :param keepalive: (int) seconds
+    :param min_reconnect_delay: (int) seconds
+    :param max_reconnect_delay: (int) seconds
+    :param max_inflight_bulk: (int) number of bulk messages paho may hold at once
+    :param spool: MQTTSpool or None
+    :param replay_rate: (float) messages per second
+    :param replay_batch_size: (int)
+    """
+
+    def __init__(self, cfg, client_id="", keepalive=60,
+                 min_reconnect_delay=1, max_reconnect_delay=30, max_inflight_bulk=1,
+                 spool=None, replay_rate=500., replay_batch_size=50):
+        self.max_inflight_bulk = max_inflight_bulk
+        self.spool = spool
+        self.replay_rate = replay_rate
+        self.replay_batch_size = replay_batch_size
+        self.replay_thread = None
+
+        self.lock = threading.RLock()
+        self.connected = False
+        self.closed = False
+        self.references = 0
+        self.router = TopicRouter()
+        # topic -> latest payload not yet handed to paho
+        self.bulk_pending = OrderedDict()
+        # mids of bulk messages handed to paho and not yet written on the socket
+        self.bulk_inflight = set()
+
+        self.client = mqtt.Client(client_id)
         self.client.on_connect = self.on_connect
+        self.client.on_disconnect = self.on_disconnect
         self.client.on_message = self.on_message
         self.client.on_publish = self.on_publish
         self.client.username_pw_set(username=cfg.RABBITMQ_USERNAME, password=cfg.RABBITMQ_PASSWORD)
-        self.client.connect(cfg.RABBITMQ_HOST, cfg.RABBITMQ_PORT, 60)
+        self.client.reconnect_delay_set(min_delay=min_reconnect_delay, max_delay=max_reconnect_delay)
+        # connect from the network thread, so that an unreachable broker is retried with backoff
+        self.client.connect_async(cfg.RABBITMQ_HOST, cfg.RABBITMQ_PORT, keepalive)
         self.client.loop_start()
-        self.client.subscribe(cfg.RABBITMQ_TOPIC + "/cars/" + str(cfg.CAR_ID))
+
+        logging.debug("MQTT connection initialized")
+
+    def acquire(self):
+        with self.lock:
+            self.references += 1
+        return self
+
+    def release(self):
+        with self.lock:
+            self.references -= 1
+            if self.references > 0:
+                return
+            self.closed = True
+        self.client.loop_stop()
+        self.client.disconnect()
+        if self.spool is not None:
+            self.spool.close()
+
+    def on_connect(self, mqttc, obj, flags, rc):
+        logging.debug("Connected: " + str(rc))
+        if rc != mqtt.MQTT_ERR_SUCCESS:
+            return
+        with self.lock:
+            self.connected = True
+            topics = self.router.filters()
+        for topic in topics:
+            self.client.subscribe(topic)
+        self._pump_bulk()
+        self._start_replay()
+
+    def on_disconnect(self, mqttc, obj, rc):
+        logging.debug("Disconnected: " + str(rc))
+        with self.lock:
+            self.connected = False
+            # packets still queued in paho are dropped on disconnection
+            self.bulk_inflight.clear()
+
+    def on_message(self, mqttc, obj, msg):
+        with self.lock:
+            callbacks = self.router.match(msg.topic)
+        for callback in callbacks:
+            try:
+                callback(mqttc, obj, msg)
+            except Exception as e:
+                logging.error("Error when processing message on %s: %s", msg.topic, e)
+
+    def on_publish(self, mqttc, obj, mid):
+        with self.lock:
+            if mid not in self.bulk_inflight:
+                return
+            self.bulk_inflight.discard(mid)
+        self._pump_bulk()
+
+    def subscribe(self, topic, callback):
+        """
+        :param topic: (str) topic filter, wildcards allowed
+        :param callback: fn(client, userdata, msg)
+        """
+        with self.lock:
+            new_topic = self.router.add(topic, callback)
+            connected = self.connected
+        if new_topic and connected:
+            self.client.subscribe(topic)
+
+    def unsubscribe(self, topic, callback):
+        with self.lock:
+            removed_topic = self.router.remove(topic, callback)
+            connected = self.connected
+        if removed_topic and connected:
+            self.client.unsubscribe(topic)
+
+    def publish(self, topic, payload, priority=PRIORITY_TELEMETRY):
+        """
+        :param topic: (str)
+        :param payload: (str|bytes)
+        :param priority: PRIORITY_TELEMETRY or PRIORITY_BULK
+        """
+        if priority == PRIORITY_BULK:
+            with self.lock:
+                self.bulk_pending.pop(topic, None)
+                self.bulk_pending[topic] = payload
+            self._pump_bulk()
+        elif self.spool is not None:
+            # decided under the lock of the replay exit, a message cannot be left behind in the spool
+            with self.lock:
+                if not self.connected or len(self.spool) > 0:
+                    self.spool.append(topic, payload)
+                elif self.client.publish(topic, payload).rc == mqtt.MQTT_ERR_NO_CONN:
+                    self.spool.append(topic, payload)
+                else:
+                    return
+                connected = self.connected
+            if connected:
+                self._start_replay()
+        else:
+            self.client.publish(topic, payload)
+
+    def _start_replay(self):
+        with self.lock:
+            if self.spool is None or len(self.spool) == 0 or self.replay_thread is not None:
+                return
+            self.replay_thread = threading.Thread(target=self._replay, daemon=True)
+            self.replay_thread.start()
+
+    def _replay(self):
+        logging.info("Replaying %d spooled messages", len(self.spool))
+        while True:
+            with self.lock:
+                if not self.connected or self.closed or len(self.spool) == 0:
+                    # publish() appends to the spool under the same lock, and restarts the replay
+                    self.replay_thread = None
+                    break
+            start_time = time.time()
+            records, marker = self.spool.peek(self.replay_batch_size)
+            published = 0
+            for topic, payload in records:
+                if self.client.publish(topic, payload).rc != mqtt.MQTT_ERR_SUCCESS:
+                    break
+                published += 1
+            self.spool.commit(published, marker)
+            if published < len(records):
+                # disconnected again, the next connection resumes the replay
+                with self.lock:
+                    self.replay_thread = None
+                return
+            sleep_time = len(records) / self.replay_rate - (time.time() - start_time)
+            if sleep_time > 0.:
+                time.sleep(sleep_time)
+        logging.info("Spool replayed")
+
+    def _pump_bulk(self):
+        with self.lock:
+            while (self.connected
+                   and len(self.bulk_pending) > 0
+                   and len(self.bulk_inflight) < self.max_inflight_bulk):
+                topic, payload = self.bulk_pending.popitem(last=False)
+                # lock is held while publishing, so that on_publish cannot miss the mid
+                info = self.client.publish(topic, payload)
+                if info.rc == mqtt.MQTT_ERR_SUCCESS and not info.is_published():
+                    self.bulk_inflight.add(info.mid)
+
+
+class MQTTClient:
+
+    def __init__(self, cfg, publish_delay=1, connection=None):
+        self.publish_delay = publish_delay
 
         self.cfg = cfg
         self.running = True
         self.output_payload = None
         self.input_payload = None
 
-        logging.debug("MQTT client initialized")
+        self.topic = cfg.RABBITMQ_TOPIC + "/cars/" + str(cfg.CAR_ID)
+        self.connection = connection.acquire() if connection is not None else shared_connection(cfg)
+        self.connection.subscribe(self.topic, self.on_message)
 
-    def on_connect(self, mqttc, obj, flags, rc):
-        logging.debug("Connected: " + str(rc))
+        logging.debug("MQTT client initialized")
 
     def on_message(self, mqttc, obj, msg):
         logging.debug("Message received: " + str(msg.payload))
@@ -36,18 +533,15 @@ class MQTTClient:
             text_payload = msg.payload.decode("UTF-8")
             dict_payload = json.loads(text_payload)
             if 'mode' in dict_payload and 'car' in dict_payload and dict_payload['car'] == self.cfg.CAR_ID:
-                self.input_payload['mode'] = dict_payload['mode']
+                self.input_payload = {'mode': dict_payload['mode']}
         except Exception as e:
             logging.error("Error when processing message", e)
 
-    def on_publish(self, mqttc, obj, result):
-        logging.debug("Message published: " + str(result))
-
     def update(self):
         while self.running:
             if self.output_payload is not None:
                 try:
-                    self.client.publish(self.cfg.RABBITMQ_TOPIC, json.dumps(self.output_payload))
+                    self.connection.publish(self.cfg.RABBITMQ_TOPIC, json.dumps(self.output_payload))
                     time.sleep(self.publish_delay)
                 except Exception as e:
                     logging.error("Error when publishing message", e)
@@ -58,20 +552,7 @@ class MQTTClient:
             user_angle, user_throttle,  # from controller
             location, borders  # from lidar
     ):
-        self.output_payload = {
-            'car': self.cfg.CAR_ID,
-            'mode': mode,
-            'user': {
-                "angle": user_angle,
-                "throttle": user_throttle
-            },
-            'angle': location[0],
-            'position': {
-                'x': location[1],
-                'y': location[2]
-            },
-            'borders': borders
-        }
+        self.output_payload = metadata_payload(self.cfg.CAR_ID, mode, user_angle, user_throttle, location, borders)
         if self.input_payload is not None:
             return self.input_payload['mode']
         else:
@@ -79,30 +560,22 @@ class MQTTClient:
 
     def shutdown(self):
         self.running = False
-        self.client.loop_stop()
-        self.client.disconnect()
+        self.connection.unsubscribe(self.topic, self.on_message)
+        self.connection.release()
 
 
 class MQTTSubscriber:
-    def __init__(self, cfg, topic):
+    def __init__(self, cfg, topic, connection=None):
         self.topic = topic
 
-        self.client = mqtt.Client()
-        self.client.on_connect = self.on_connect
-        self.client.on_message = self.on_message
-        self.client.username_pw_set(username=cfg.RABBITMQ_USERNAME, password=cfg.RABBITMQ_PASSWORD)
-        self.client.connect(cfg.RABBITMQ_HOST, cfg.RABBITMQ_PORT, 60)
-        self.client.loop_start()
-        self.client.subscribe(self.topic)
-
         self.cfg = cfg
         self.running = True
         self.input_queue = queue.Queue()
 
-        logging.debug("MQTT client initialized")
+        self.connection = connection.acquire() if connection is not None else shared_connection(cfg)
+        self.connection.subscribe(self.topic, self.on_message)
 
-    def on_connect(self, mqttc, obj, flags, rc):
-        logging.debug("Connected: " + str(rc))
+        logging.debug("MQTT client initialized")
 
     def on_message(self, mqttc, obj, msg):
         logging.debug("Message received: " + str(msg.payload))
@@ -115,69 +588,240 @@ class MQTTSubscriber:
 
     def shutdown(self):
         self.running = False
-        self.client.loop_stop()
-        self.client.disconnect()
+        self.connection.unsubscribe(self.topic, self.on_message)
+        self.connection.release()
 
 
 class MQTTPublisher:
-    def __init__(self, cfg, topic, publish_delay=1):
+    """
+    :param max_queue_size: (int) messages waiting to be published, the oldest is dropped when full
+    """
+
+    def __init__(self, cfg, topic, publish_delay=1, priority=PRIORITY_TELEMETRY, connection=None,
+                 max_queue_size=100):
         self.publish_delay = publish_delay
         self.topic = topic
-
-        self.client = mqtt.Client()
-        self.client.on_connect = self.on_connect
-        self.client.on_publish = self.on_publish
-        self.client.username_pw_set(username=cfg.RABBITMQ_USERNAME, password=cfg.RABBITMQ_PASSWORD)
-        self.client.connect(cfg.RABBITMQ_HOST, cfg.RABBITMQ_PORT, 60)
-        self.client.loop_start()
+        self.priority = priority
 
         self.cfg = cfg
         self.running = True
-        self.output_queue = queue.Queue()
-
-        logging.debug("MQTT client initialized")
+        self.output_queue = queue.Queue(maxsize=max_queue_size)
+        self.dropped = 0
 
-    def on_connect(self, mqttc, obj, flags, rc):
-        logging.debug("Connected: " + str(rc))
+        self.connection = connection.acquire() if connection is not None else shared_connection(cfg)
 
-    def on_publish(self, mqttc, obj, result):
-        logging.debug("Message published: " + str(result))
+        logging.debug("MQTT client initialized")
 
     def update(self):
         while self.running:
             try:
                 while not self.output_queue.empty():
                     msg = self.output_queue.get_nowait()
-                    self.client.publish(self.topic, msg)
+                    self.connection.publish(self.topic, msg, priority=self.priority)
             except queue.Empty as e:
                 pass
             time.sleep(self.publish_delay)
 
+    def enqueue(self, msg):
+        while True:
+            try:
+                self.output_queue.put_nowait(msg)
+                return
+            except queue.Full:
+                try:
+                    self.output_queue.get_nowait()
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
+
     def run_threaded(self, *args):
         raise NotImplementedError
 
     def shutdown(self):
         self.running = False
-        self.client.loop_stop()
-        self.client.disconnect()
+        self.connection.release()
 
 
 class FrameMQTTPublisher(MQTTPublisher):
     def __init__(self, car_id, *args, **kwargs):
+        kwargs.setdefault('priority', PRIORITY_BULK)
         super(FrameMQTTPublisher, self).__init__(*args, **kwargs)
         self.car_id = car_id
 
     def run_threaded(self, frame_base64):
-        self.output_queue.put_nowait(json.dumps({
-            'car': self.car_id,
-            'frame': frame_base64.decode("utf-8")
-        }))
+        self.enqueue(json.dumps(frame_payload(self.car_id, frame_base64)))
+
+
+class MetadataChangeDetector:
+    """
+    Turn the full metadata of each cycle into keyframes and deltas, or nothing when nothing moved.
+
+    - keyframe: full metadata_payload, sent first and then at least every `keyframe_interval` seconds
+    - delta: only the fields which moved beyond their dead-band since they were last sent,
+      the mode when it changed, and the borders as points added / removed since the last keyframe
+
+    Messages carry `type` ("keyframe" or "delta") and `seq`, deltas also carry the `keyframe` they apply to.
+
+    :param deadbands: dict with "steering", "throttle", "heading" (degrees) and "position" (lidar unit) keys
+    :param keyframe_interval: (float) seconds
+    """
+
+    def __init__(self, deadbands, keyframe_interval=5.):
+        self.deadbands = {"steering": 0., "throttle": 0., "heading": 0., "position": 0.}
+        self.deadbands.update(deadbands)
+        self.keyframe_interval = keyframe_interval
+        self.seq = 0
+        self.keyframe_seq = None
+        self.keyframe_time = None
+        self.keyframe_borders = Counter()
+        # last values sent for each field
+        self.sent = None
+        self.last_borders = None
+        self.sent_borders_delta = None
+
+    @staticmethod
+    def _moved(previous, current, deadband):
+        if previous is None or current is None:
+            return previous is not current
+        return abs(current - previous) > deadband
+
+    def _heading_moved(self, previous, current):
+        if previous is None or current is None:
+            return previous is not current
+        return abs((current - previous + 180) % 360 - 180) > self.deadbands["heading"]
+
+    def _keyframe(self, payload, now):
+        self.seq += 1
+        self.keyframe_seq = self.seq
+        self.keyframe_time = now
+        self.keyframe_borders = Counter(tuple(point) for point in payload['borders'] or [])
+        self.sent = payload
+        self.last_borders = payload['borders']
+        self.sent_borders_delta = ([], [])
+        return dict(payload, type="keyframe", seq=self.seq)
+
+    def _borders_delta(self, borders):
+        # borders may contain the same point several times
+        borders = Counter(tuple(point) for point in borders or [])
+        added = [list(point) for point in (borders - self.keyframe_borders).elements()]
+        removed = [list(point) for point in (self.keyframe_borders - borders).elements()]
+        return added, removed
+
+    def update(self, payload, now):
+        """
+        :param payload: (dict) from metadata_payload
+        :param now: (float) seconds
+        :return: (dict) message to publish, or None
+        """
+        if self.sent is None or now - self.keyframe_time >= self.keyframe_interval:
+            return self._keyframe(payload, now)
+
+        delta = {}
+        if payload['mode'] != self.sent['mode']:
+            delta['mode'] = payload['mode']
+        user = {}
+        if self._moved(self.sent['user']['angle'], payload['user']['angle'], self.deadbands["steering"]):
+            user['angle'] = payload['user']['angle']
+        if self._moved(self.sent['user']['throttle'], payload['user']['throttle'], self.deadbands["throttle"]):
+            user['throttle'] = payload['user']['throttle']
+        if user:
+            delta['user'] = user
+        if self._heading_moved(self.sent['angle'], payload['angle']):
+            delta['angle'] = payload['angle']
+        position, sent_position = payload['position'], self.sent['position']
+        if (self._moved(sent_position['x'], position['x'], self.deadbands["position"])
+                or self._moved(sent_position['y'], position['y'], self.deadbands["position"])):
+            delta['position'] = position
+
+        # borders only change when the lidar computed new ones
+        if payload['borders'] is not self.last_borders:
+            self.last_borders = payload['borders']
+            added, removed = self._borders_delta(payload['borders'])
+            if (added or removed) and len(added) + len(removed) >= len(payload['borders'] or []):
+                # the delta would be larger than the borders themselves
+                return self._keyframe(payload, now)
+            if (added, removed) != self.sent_borders_delta:
+                self.sent_borders_delta = (added, removed)
+                delta['borders'] = {'added': added, 'removed': removed}
+
+        if not delta:
+            return None
+        # remember what the consumers know
+        self.sent = dict(self.sent)
+        self.sent.update({key: value for key, value in delta.items() if key in ('mode', 'angle', 'position')})
+        self.sent['user'] = dict(self.sent['user'], **user)
+        self.seq += 1
+        return dict(delta, car=payload['car'], type="delta", seq=self.seq, keyframe=self.keyframe_seq)
+
+
+class MetadataState:
+    """
+    Rebuild the full metadata of a car from the messages of MetadataMQTTPublisher,
+    whether it publishes changes only or full payloads.
+    """
+
+    def __init__(self):
+        self.state = None
+        self.keyframe_seq = None
+        self.keyframe_borders = []
+
+    def apply(self, message):
+        """
+        :param message: (dict) decoded message
+        :return: (dict) full state in the metadata_payload format, None until the first keyframe
+        """
+        message_type = message.get('type')
+        if message_type is None or message_type == "keyframe":
+            # the state is only changed once the whole message is read
+            state = {key: value for key, value in message.items() if key not in ('type', 'seq')}
+            state['borders'] = message.get('borders') or []
+            self.state = state
+            self.keyframe_seq = message.get('seq')
+            self.keyframe_borders = state['borders']
+            return self.state
+        if self.state is None or message.get('keyframe') != self.keyframe_seq:
+            # missed keyframe, wait for the next one
+            return None
+
+        state = dict(self.state)
+        for key in ('mode', 'angle', 'position'):
+            if key in message:
+                state[key] = message[key]
+        if 'user' in message:
+            if not isinstance(message['user'], dict):
+                raise ValueError("invalid user in metadata delta")
+            state['user'] = dict(state.get('user') or {}, **message['user'])
+        if 'borders' in message:
+            if not isinstance(message['borders'], dict):
+                raise ValueError("invalid borders in metadata delta")
+            removed = Counter(tuple(point) for point in message['borders'].get('removed') or [])
+            borders = []
+            for point in self.keyframe_borders:
+                if removed[tuple(point)] > 0:
+                    removed[tuple(point)] -= 1
+                else:
+                    borders.append(point)
+            state['borders'] = borders + (message['borders'].get('added') or [])
+        self.state = state
+        return self.state
 
 
 class MetadataMQTTPublisher(MQTTPublisher):
-    def __init__(self, car_id, *args, **kwargs):
+    """
+    Publish the metadata of the car, every cycle or, with `deadbands`, only when it changes
+    (see MetadataChangeDetector, consumers rebuild the full state with MetadataState).
+
+    :param car_id:
+    :param deadbands: dict with "steering", "throttle", "heading" and "position" keys, None to publish every cycle
+    :param keyframe_interval: (float) max seconds between two full payloads when publishing changes only
+    """
+
+    def __init__(self, car_id, *args, deadbands=None, keyframe_interval=5., **kwargs):
         super(MetadataMQTTPublisher, self).__init__(*args, **kwargs)
         self.car_id = car_id
+        self.change_detector = None
+        if deadbands is not None:
+            self.change_detector = MetadataChangeDetector(deadbands, keyframe_interval=keyframe_interval)
 
     def run_threaded(self, *args):
         (mode,
@@ -185,37 +829,100 @@ class MetadataMQTTPublisher(MQTTPublisher):
          user_angle, user_throttle,
          # from lidar
          location, borders) = args
-        if location is None:
-            location = (0, 0, 0)
-        self.output_queue.put_nowait(json.dumps({
-            'car': self.car_id,
-            'mode': mode,
-            'user': {
-                "angle": user_angle,
-                "throttle": user_throttle
-            },
-            'angle': location[0],
-            'position': {
-                'x': location[1],
-                'y': location[2]
-            },
-            'borders': borders
-        }))
+        payload = metadata_payload(self.car_id, mode, user_angle, user_throttle, location, borders)
+        if self.change_detector is not None:
+            payload = self.change_detector.update(payload, time.time())
+            if payload is None:
+                return
+        self.enqueue(json.dumps(payload))
 
 
 class RemoteModeMQTTSubscriber(MQTTSubscriber):
-    def __init__(self, car_id, *args, **kwargs):
-        super(RemoteModeMQTTSubscriber, self).__init__(*args, **kwargs)
+    """
+    Remote commands of one car.
+
+    Commands are published on `<topic>/cars/<car_id>`, or on a sub-topic naming the command type
+    (`<topic>/cars/<car_id>/stop`, `<topic>/cars/<car_id>/mode`), so the broker never delivers
+    the commands of other cars. Messages on other sub-topics are ignored.
+    Only the raw payload of the latest command is kept, whatever its type, it is decoded in `run()`.
+
+    Messages on the legacy `<topic>` shared by all cars are still accepted when `shared_topic` is set:
+    they are dropped without being decoded unless the payload mentions the car id.
+
+    :param car_id:
+    :param shared_topic: (bool) also listen to `<topic>`
+    """
+
+    def __init__(self, car_id, cfg, topic, shared_topic=True, connection=None):
         self.car_id = car_id
+        self.car_topic = topic + "/cars/" + str(car_id)
+        self.shared_topic = topic if shared_topic else None
+        self.car_id_marker = str(car_id).encode("utf-8")
+
+        self.command_lock = threading.Lock()
+        # (command type, raw payload) of the latest command
+        self.command = None
+
+        super(RemoteModeMQTTSubscriber, self).__init__(cfg, self.car_topic + "/#", connection=connection)
+        if self.shared_topic is not None:
+            self.connection.subscribe(self.shared_topic, self.on_shared_message)
+
+    def _store(self, command_type, payload):
+        with self.command_lock:
+            self.command = (command_type, payload)
+
+    def on_message(self, mqttc, obj, msg):
+        command_type = COMMAND_SUB_TOPICS.get(msg.topic[len(self.car_topic) + 1:])
+        if command_type is None:
+            logging.debug("Ignoring command on %s", msg.topic)
+            return
+        self._store(command_type, msg.payload)
+
+    def on_shared_message(self, mqttc, obj, msg):
+        if b"carId" not in msg.payload or self.car_id_marker not in msg.payload:
+            return
+        dict_payload = json.loads(msg.payload.decode("UTF-8"))
+        if ('mode' in dict_payload
+                and 'data' in dict_payload
+                and 'carId' in dict_payload['data']
+                and dict_payload['data']['carId'] == self.car_id):
+            mode = dict_payload['mode']
+            self._store(STOP_COMMAND if mode == STOP_COMMAND else DEFAULT_COMMAND, {'mode': mode})
+
+    @staticmethod
+    def decode_command(command_type, payload):
+        """
+        :param command_type: (str) DEFAULT_COMMAND or STOP_COMMAND, see COMMAND_SUB_TOPICS
+        :param payload: raw payload, or already decoded dict
+        :return: (str) mode
+        """
+        if command_type == STOP_COMMAND:
+            return STOP_COMMAND
+        if isinstance(payload, dict):
+            return payload.get('mode', "")
+        text_payload = payload.decode("UTF-8")
+        try:
+            dict_payload = json.loads(text_payload)
+        except ValueError:
+            # plain text mode
+            return text_payload
+        if isinstance(dict_payload, dict):
+            return dict_payload.get('mode', "")
+        return str(dict_payload)
 
     def run(self):
-        mode = ""
-
-        while not self.input_queue.empty():
-            dict_payload = self.input_queue.get_nowait()
-            if ('mode' in dict_payload
-                    and 'data' in dict_payload
-                    and 'carId' in dict_payload['data']
-                    and dict_payload['data']['carId'] == self.car_id):
-                mode = dict_payload['mode']
-        return mode
+        with self.command_lock:
+            if self.command is None:
+                return ""
+            (command_type, payload), self.command = self.command, None
+
+        try:
+            return self.decode_command(command_type, payload)
+        except Exception as e:
+            logging.error("Error when decoding command %s: %s", command_type, e)
+            return ""
+
+    def shutdown(self):
+        if self.shared_topic is not None:
+            self.connection.unsubscribe(self.shared_topic, self.on_shared_message)
+        super(RemoteModeMQTTSubscriber, self).shutdown()
@@ -0,0 +1,147 @@
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+from xebikart.parts.image import encode_jpeg
+
+BOUNDARY = "frame"
+
+INDEX_PAGE = b"""<html>
+<head><title>xebikart preview</title></head>
+<body style="margin: 0; background: black"><img src="/stream" style="height: 100%"></body>
+</html>
+"""
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _PreviewRequestHandler(BaseHTTPRequestHandler):
+    # set by MJPEGPreviewServer
+    preview = None
+
+    def do_GET(self):
+        if self.path == "/":
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html")
+            self.send_header("Content-Length", str(len(INDEX_PAGE)))
+            self.end_headers()
+            self.wfile.write(INDEX_PAGE)
+        elif self.path == "/stream":
+            self.stream()
+        else:
+            self.send_error(404)
+
+    def stream(self):
+        if not self.preview.add_client():
+            self.send_error(503, "Too many preview clients")
+            return
+        try:
+            self.send_response(200)
+            self.send_header("Content-Type", "multipart/x-mixed-replace; boundary=" + BOUNDARY)
+            self.send_header("Cache-Control", "no-cache")
+            self.end_headers()
+            sequence = 0
+            while True:
+                sequence, jpeg = self.preview.wait_frame(sequence)
+                if jpeg is None:
+                    break
+                self.wfile.write(b"--" + BOUNDARY.encode() + b"\r\n"
+                                 b"Content-Type: image/jpeg\r\n"
+                                 b"Content-Length: " + str(len(jpeg)).encode() + b"\r\n\r\n" + jpeg + b"\r\n")
+        except (ConnectionError, OSError) as e:
+            logging.debug("Preview client disconnected: " + str(e))
+        finally:
+            self.preview.remove_client()
+
+    def log_message(self, format, *args):
+        logging.debug("Preview: " + format % args)
+
+
+class MJPEGPreviewServer:
+    """
+    Serve the camera as a multipart MJPEG stream, on http://<car>:<port>/ or /stream.
+
+    The drive loop only hands over the latest image. A single thread encodes it,
+    at most `max_fps` times per second and only while clients are connected,
+    and all clients receive the same jpeg.
+
+    :param host: (str)
+    :param port: (int)
+    :param max_fps: (float)
+    :param max_clients: (int) extra clients get a 503
+    :param quality: (int) jpeg quality
+    """
+
+    def __init__(self, host="0.0.0.0", port=8887, max_fps=10., max_clients=4, quality=75):
+        self.max_fps = max_fps
+        self.max_clients = max_clients
+        self.quality = quality
+
+        self.running = True
+        self.image = None
+        self.image_updated = False
+        # latest jpeg and its sequence number, guarded by frame_condition
+        self.frame_condition = threading.Condition()
+        self.jpeg = None
+        self.sequence = 0
+        self.clients = 0
+
+        handler = type("PreviewRequestHandler", (_PreviewRequestHandler,), {"preview": self})
+        self.server = _ThreadingHTTPServer((host, port), handler)
+        self.server_thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.server_thread.start()
+
+        logging.info("MJPEG preview on http://%s:%d/", host, port)
+
+    def add_client(self):
+        with self.frame_condition:
+            if self.clients >= self.max_clients:
+                return False
+            self.clients += 1
+            return True
+
+    def remove_client(self):
+        with self.frame_condition:
+            self.clients -= 1
+
+    def wait_frame(self, sequence, timeout=5.):
+        """
+        :param sequence: (int) sequence number of the last frame sent to the client
+        :return: (int, bytes) next frame, jpeg is None when the server stops
+        """
+        with self.frame_condition:
+            while self.running and self.sequence <= sequence:
+                self.frame_condition.wait(timeout)
+            if not self.running:
+                return sequence, None
+            return self.sequence, self.jpeg
+
+    def update(self):
+        period = 1. / self.max_fps
+        while self.running:
+            start_time = time.time()
+            if self.clients > 0 and self.image_updated:
+                self.image_updated = False
+                jpeg = encode_jpeg(self.image, quality=self.quality)
+                with self.frame_condition:
+                    self.jpeg = jpeg
+                    self.sequence += 1
+                    self.frame_condition.notify_all()
+            time.sleep(max(0., period - (time.time() - start_time)))
+
+    def run_threaded(self, img_arr):
+        if img_arr is not None:
+            self.image = img_arr
+            self.image_updated = True
+
+    def shutdown(self):
+        self.running = False
+        with self.frame_condition:
+            self.frame_condition.notify_all()
+        self.server.shutdown()
+        self.server.server_close()
@@ -1,6 +1,8 @@
 import numpy as np
 import tensorflow as tf
 
+from xebikart.history import CommandHistory
+
 
 class MemorySoftActorCriticModel(object):
     def __init__(self, checkpoint_path, n_command_history, min_throttle, max_throttle):
@@ -15,20 +17,21 @@ class MemorySoftActorCriticModel(object):
         saver = tf.compat.v1.train.import_meta_graph(checkpoint_path + ".meta")
         saver.restore(self.sess, checkpoint_path)
 
-        # History
-        self.n_command_history = 2 * n_command_history
-        self.command_history = np.zeros(self.n_command_history)
+        # History, same as HistoryBasedWrapper
+        self.history = CommandHistory(2, n_command_history)
+        # batch of one observation, allocated on the first run
+        self.model_input = None
 
     def run(self, img_arr):
+        if self.model_input is None:
+            self.model_input = np.zeros((1, img_arr.shape[-1] + self.history.size), dtype=np.float32)
         # append history
-        img_history = np.concatenate((img_arr, self.command_history), axis=-1)
-        img_history = np.expand_dims(img_history, axis=0)
-        actions = self.sess.run(self.output_tensor, {self.input_tensor: img_history})
-        action = np.squeeze(actions, axis=0)
+        self.history.observation(img_arr, out=self.model_input[0])
+        actions = self.sess.run(self.output_tensor, {self.input_tensor: self.model_input})
+        action = actions[0]
 
         # Update command history
-        self.command_history = np.roll(self.command_history, shift=-2, axis=-1)
-        self.command_history[..., -2:] = action
+        self.history.append(action)
 
         # outputs = [steering, throttle]
         steering = action[0]
@@ -1,53 +1,202 @@
 #!/usr/bin/env python3
 
-import time
-import logging
+"""
+Telemetry gateway: subscribes once to the broker and broadcasts events to many SSE clients.
 
-from flask import Flask, Response
-from paho.mqtt.client import Client
+    GET /events                  all events
+    GET /events?car=1            events of car 1 only
+    GET /events?car=1&hz=2       at most 2 events per second and per car
 
-import config
+Each client has its own bounded queue, a client which does not read fast enough
+to keep its queue from filling up is disconnected instead of slowing down the others.
 
+Events are the full metadata of a car, rebuilt from the deltas of the cars publishing changes only.
+Events without car are forwarded as received, to the clients not filtering on a car.
 
-class Subscriber():
+    PYTHONPATH=../car-package ./api.py
+"""
 
-    def __init__(self):
-        self.messages = []
-        self.client = Client("sample-api-subscriber")
-        self.client.on_connect = self.on_connect
-        self.client.on_message = self.on_message
-        self.client.on_subscribe = self.on_subscribe
-        self.client.username_pw_set(username=config.RABBITMQ_USERNAME, password=config.RABBITMQ_PASSWORD)
-        self.client.connect(config.RABBITMQ_HOST, config.RABBITMQ_PORT, 60)
-        self.client.subscribe(config.RABBITMQ_TOPIC)
-        self.client.loop_start()
+import asyncio
+import json
+import logging
+import time
+from urllib.parse import urlsplit, parse_qs
+
+from consumer import AsyncBatchConsumer, MetadataDecoder
 
-    def on_connect(self, client, userdata, flags, rc):
-        logging.debug("Connected with result code " + str(rc))
+import config
 
-    def on_message(self, cli, userdata, msg):
-        logging.debug(msg.topic + " " + str(msg.payload.decode()))
-        self.messages.append(str(msg.payload.decode()))
 
-    def on_subscribe(self, client, obj, mid, granted_qos):
-        logging.debug("Subscribed: " + str(mid) + " " + str(granted_qos))
+def decode_car(metadata):
+    """
+    :param metadata: decoded event
+    :return: (str) car of the event, None if the event has none
+    """
+    car = metadata.get('car') if isinstance(metadata, dict) else None
+    return str(car) if car is not None else None
+
+
+class EventClient:
+    """
+    :param queue_size: (int) events waiting to be written before the client is evicted
+    :param car: (str) only forward events of this car
+    :param max_rate: (float) max events per second and per car
+    """
+
+    def __init__(self, queue_size, car=None, max_rate=None):
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.car = car
+        self.min_interval = 1. / max_rate if max_rate else 0.
+        self.last_sent = {}
+        self.evicted = False
+        self.writer = None
+
+    def accepts(self, car, now):
+        if self.car is not None and self.car != car:
+            return False
+        if self.min_interval > 0.:
+            if now - self.last_sent.get(car, 0.) < self.min_interval:
+                return False
+            self.last_sent[car] = now
+        return True
+
+    def evict(self):
+        self.evicted = True
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        # wake up the writer, or drop the connection if it is stuck on a full socket
+        self.queue.put_nowait(None)
+        if self.writer is not None:
+            self.writer.transport.abort()
+
+
+class Broadcaster:
+    """
+    Decode each event once and fan it out to the queues of all clients.
+    """
+
+    def __init__(self, queue_size):
+        self.queue_size = queue_size
+        self.clients = set()
+        self.received = 0
+        self.evicted = 0
+
+    def register(self, car=None, max_rate=None):
+        client = EventClient(self.queue_size, car=car, max_rate=max_rate)
+        self.clients.add(client)
+        return client
+
+    def unregister(self, client):
+        self.clients.discard(client)
+
+    def publish_batch(self, messages):
+        for message in messages:
+            # clients get the full metadata, even from a car publishing deltas
+            self.publish(json.dumps(message.value).encode(), decode_car(message.value))
+
+    def publish(self, payload, car):
+        self.received += 1
+        # one SSE frame for all clients
+        frame = b"data: " + payload.replace(b"\n", b"\ndata: ") + b"\n\n"
+        now = time.monotonic()
+        for client in list(self.clients):
+            if not client.accepts(car, now):
+                continue
+            try:
+                client.queue.put_nowait(frame)
+            except asyncio.QueueFull:
+                logging.info("Evicting slow client")
+                self.unregister(client)
+                client.evict()
+                self.evicted += 1
+
+
+class EventServer:
+    """
+    Minimal HTTP server streaming events as Server-Sent Events.
+
+    :param broadcaster: Broadcaster
+    :param keepalive: (float) seconds without event before sending an SSE comment
+    """
+
+    def __init__(self, broadcaster, keepalive=15.):
+        self.broadcaster = broadcaster
+        self.keepalive = keepalive
+
+    async def handle(self, reader, writer):
+        try:
+            request_line = await reader.readline()
+            # skip headers
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+            parts = request_line.decode("latin-1").split()
+            if len(parts) < 2 or parts[0] != "GET" or urlsplit(parts[1]).path != "/events":
+                writer.write(b"HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+                await writer.drain()
+                return
+            params = parse_qs(urlsplit(parts[1]).query)
+            car = params.get("car", [None])[0]
+            max_rate = float(params["hz"][0]) if "hz" in params else None
+            await self.stream(writer, car, max_rate)
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError) as e:
+            logging.debug("Client dropped: " + str(e))
+        finally:
+            writer.close()
+
+    async def stream(self, writer, car, max_rate):
+        writer.write(b"HTTP/1.1 200 OK\r\n"
+                     b"Content-Type: text/event-stream\r\n"
+                     b"Cache-Control: no-cache\r\n"
+                     b"Connection: keep-alive\r\n"
+                     b"Access-Control-Allow-Origin: *\r\n\r\n")
+        await writer.drain()
+
+        client = self.broadcaster.register(car=car, max_rate=max_rate)
+        client.writer = writer
+        try:
+            while not client.evicted:
+                try:
+                    frame = await asyncio.wait_for(client.queue.get(), self.keepalive)
+                except asyncio.TimeoutError:
+                    frame = b": keepalive\n\n"
+                if frame is None:
+                    break
+                # write everything already queued in one go
+                frames = [frame]
+                while not client.queue.empty():
+                    frame = client.queue.get_nowait()
+                    if frame is None:
+                        break
+                    frames.append(frame)
+                writer.write(b"".join(frames))
+                await writer.drain()
+        finally:
+            self.broadcaster.unregister(client)
+
+
+async def report(broadcaster, consumer, interval):
+    while True:
+        await asyncio.sleep(interval)
+        logging.info("clients: %d, evicted: %d, %s",
+                     len(broadcaster.clients), broadcaster.evicted, consumer.metrics.report())
+
+
+async def main():
+    loop = asyncio.get_running_loop()
+    broadcaster = Broadcaster(queue_size=config.API_CLIENT_QUEUE_SIZE)
+    consumer = AsyncBatchConsumer("sample-api-subscriber", [config.RABBITMQ_TOPIC], broadcaster.publish_batch, loop,
+                                  decoder=MetadataDecoder())
+    event_server = EventServer(broadcaster)
+    server = await asyncio.start_server(event_server.handle, config.API_HOST, config.API_PORT,
+                                        backlog=1024)
+    logging.info("Serving events on http://%s:%d/events", config.API_HOST, config.API_PORT)
+    try:
+        async with server:
+            await asyncio.gather(server.serve_forever(), consumer.run(), report(broadcaster, consumer, 10.))
+    finally:
+        consumer.stop()
 
 
 if __name__ == "__main__":
     logging.basicConfig(format=config.LOG_FORMAT, level=config.LOG_LEVEL, handlers=[logging.StreamHandler()])
-
-    subscriber = Subscriber()
-    app = Flask(__name__)
-
-
-    @app.route('/events')
-    def get():
-        def eventStream():
-            while True:
-                if (len(subscriber.messages) > 0):
-                    yield "data: " + subscriber.messages.pop() + "\n"
-
-        return Response(eventStream(), mimetype="text/event-stream")
-
-
-    app.run()
+    asyncio.run(main())
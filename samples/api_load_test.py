@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+
+"""
+Load test of the telemetry gateway (api.py) with hundreds of simulated browser clients.
+
+Events are published on the broker with their send time, every client measures the delay
+until the event reaches it through the gateway. Slow clients, which never read, can be added
+to check that they are evicted without slowing down the others: the test fails if one of them
+is still connected at the end.
+
+    ./api_load_test.py --clients 500 --slow-clients 20 --rate 100 --duration 30
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import sys
+import time
+
+from paho.mqtt.client import Client
+
+import config
+
+
+class Stats:
+    def __init__(self):
+        self.connected = 0
+        self.disconnected = 0
+        self.evicted = 0
+        self.events = 0
+        self.latencies = []
+
+    def percentile(self, p):
+        if len(self.latencies) == 0:
+            return float("nan")
+        latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, int(p / 100. * len(latencies)))]
+
+
+async def browser_client(args, url_path, stats, stop):
+    reader, writer = await asyncio.open_connection(args.host, config.API_PORT)
+    writer.write(("GET " + url_path + " HTTP/1.1\r\nHost: load-test\r\nAccept: text/event-stream\r\n\r\n").encode())
+    await writer.drain()
+    await reader.readuntil(b"\r\n\r\n")
+    stats.connected += 1
+    try:
+        while not stop.is_set():
+            frame = await reader.readuntil(b"\n\n")
+            if not frame.startswith(b"data: "):
+                continue
+            received_at = time.time()
+            payload = json.loads(frame[len(b"data: "):])
+            stats.events += 1
+            if 'sent_at' in payload:
+                stats.latencies.append(received_at - payload['sent_at'])
+    except (asyncio.IncompleteReadError, ConnectionError):
+        stats.disconnected += 1
+    finally:
+        writer.close()
+
+
+async def slow_client(args, url_path, stats, stop):
+    reader, writer = await asyncio.open_connection(args.host, config.API_PORT)
+    # never read, the socket buffers fill up and the gateway has to evict this client
+    writer.transport.pause_reading()
+    writer.write(("GET " + url_path + " HTTP/1.1\r\nHost: load-test\r\n\r\n").encode())
+    await writer.drain()
+    stats.connected += 1
+    await stop.wait()
+    # an evicted client reaches the end of the stream once what was buffered is read,
+    # the gateway keeps writing to a client still connected
+    writer.transport.resume_reading()
+    try:
+        while await asyncio.wait_for(reader.read(1 << 16), args.eviction_timeout):
+            pass
+        stats.evicted += 1
+    except ConnectionError:
+        stats.evicted += 1
+    except asyncio.TimeoutError:
+        pass
+    finally:
+        writer.close()
+
+
+async def publish(rate, n_cars, stop):
+    client = Client("sample-api-load-test")
+    client.username_pw_set(username=config.RABBITMQ_USERNAME, password=config.RABBITMQ_PASSWORD)
+    client.connect(config.RABBITMQ_HOST, config.RABBITMQ_PORT, 60)
+    client.loop_start()
+    sent = 0
+    start = time.monotonic()
+    while not stop.is_set():
+        client.publish(config.RABBITMQ_TOPIC, json.dumps({
+            'car': sent % n_cars,
+            'mode': "ai_v2_mode",
+            'user': {"angle": 0., "throttle": 0.2},
+            'angle': 90,
+            'position': {'x': 1200, 'y': 800},
+            'borders': [[i, i] for i in range(50)],
+            'sent_at': time.time()
+        }))
+        sent += 1
+        # fixed rate, without drift
+        await asyncio.sleep(max(0., start + sent / rate - time.monotonic()))
+    client.loop_stop()
+    client.disconnect()
+    return sent
+
+
+async def main(args):
+    stop = asyncio.Event()
+    stats = Stats()
+    slow_stats = Stats()
+    url_path = "/events" + ("?car=" + args.car if args.car is not None else "")
+
+    clients = [asyncio.ensure_future(browser_client(args, url_path, stats, stop)) for _ in range(args.clients)]
+    clients += [asyncio.ensure_future(slow_client(args, url_path, slow_stats, stop)) for _ in range(args.slow_clients)]
+    # let every client connect before publishing
+    await asyncio.sleep(2.)
+    publisher = asyncio.ensure_future(publish(args.rate, args.cars, stop))
+    await asyncio.sleep(args.duration)
+    stop.set()
+    sent = await publisher
+    # slow clients check if they were evicted
+    slow_clients = clients[args.clients:]
+    await asyncio.gather(*slow_clients, return_exceptions=True)
+    for client in clients:
+        client.cancel()
+    await asyncio.gather(*clients, return_exceptions=True)
+
+    expected = sent * args.clients / (args.cars if args.car is not None else 1)
+    print("clients connected:       %d (+ %d slow)" % (stats.connected, slow_stats.connected))
+    print("clients disconnected:    %d" % stats.disconnected)
+    print("events published:        %d (%.1f/s)" % (sent, sent / args.duration))
+    print("events delivered:        %d (%.1f/s, %.1f%% of expected)"
+          % (stats.events, stats.events / args.duration, 100. * stats.events / max(expected, 1)))
+    print("latency p50/p95/p99 (ms): %.1f / %.1f / %.1f"
+          % tuple(1000. * stats.percentile(p) for p in (50, 95, 99)))
+    print("slow clients evicted:    %d / %d" % (slow_stats.evicted, args.slow_clients))
+    return slow_stats.evicted == args.slow_clients
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1", help="gateway host")
+    parser.add_argument("--clients", type=int, default=500)
+    parser.add_argument("--slow-clients", type=int, default=0)
+    parser.add_argument("--rate", type=float, default=50., help="events published per second")
+    parser.add_argument("--cars", type=int, default=4)
+    parser.add_argument("--car", default=None, help="subscribe to one car only")
+    parser.add_argument("--duration", type=float, default=30.)
+    parser.add_argument("--eviction-timeout", type=float, default=5.,
+                        help="seconds without data before a slow client is considered still connected")
+    args = parser.parse_args()
+
+    logging.basicConfig(format=config.LOG_FORMAT, level=logging.INFO, handlers=[logging.StreamHandler()])
+    if not asyncio.run(main(args)):
+        logging.error("Slow clients were not evicted")
+        sys.exit(1)
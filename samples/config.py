@@ -10,3 +10,14 @@ RABBITMQ_PASSWORD = "admin"
 RABBITMQ_HOST = "localhost"
 RABBITMQ_PORT = 1883
 RABBITMQ_TOPIC = "xebikart-events"
+RABBITMQ_VIDEO_TOPIC = "xebikart-car-video"
+
+# API
+API_HOST = "0.0.0.0"
+API_PORT = 5000
+API_CLIENT_QUEUE_SIZE = 256
+
+# RECORDER
+RECORDER_PATH = "recordings"
+RECORDER_TOPICS = [RABBITMQ_TOPIC]
+RECORDER_SESSION_GAP = 300
@@ -0,0 +1,323 @@
+"""
+Batched MQTT consumer for the backend services of the fleet.
+
+paho's network thread only appends the raw messages to a bounded ring, the oldest
+messages are dropped when the consumer does not keep up. Messages are then decoded and
+handed over in batches, to worker threads (BatchConsumer) or to an asyncio loop
+(AsyncBatchConsumer):
+
+    def handle(messages):
+        for message in messages:
+            print(message.topic, message.value)
+
+    consumer = BatchConsumer("my-service", [config.RABBITMQ_TOPIC], handle)
+    ...
+    logging.info(consumer.metrics.report())
+    consumer.stop()
+"""
+
+import asyncio
+import json
+import logging
+import threading
+import time
+from collections import deque, namedtuple
+
+from paho.mqtt.client import Client
+
+import config
+
+# value is the output of the decoder
+Message = namedtuple("Message", ["topic", "payload", "value", "received_at"])
+
+
+class MetadataDecoder:
+    """
+    Decoder of the metadata topic: cars publishing changes only (see MetadataMQTTPublisher) send deltas,
+    the full metadata of each car is rebuilt with MetadataState, as if it had been sent every time.
+    Messages without car are not metadata of a car, they are decoded as is.
+    Deltas received before the first keyframe of their car are skipped.
+
+    Deltas must be decoded in reception order: use a single worker with BatchConsumer.
+    Needs the car package, e.g. PYTHONPATH=../car-package
+    """
+
+    def __init__(self):
+        # car -> MetadataState
+        self.states = {}
+
+    def __call__(self, payload):
+        from xebikart.parts.mqtt import MetadataState
+
+        message = json.loads(payload)
+        if not isinstance(message, dict) or message.get('car') is None:
+            return message
+        car = message['car']
+        if car not in self.states:
+            self.states[car] = MetadataState()
+        state = self.states[car].apply(message)
+        if state is None:
+            raise ValueError("delta of car {} before its keyframe".format(car))
+        return state
+
+
+class MessageRing:
+    """
+    Bounded FIFO between the network thread and the consumers, drops the oldest message when full.
+    """
+
+    def __init__(self, size):
+        # append / popleft of a deque are thread safe
+        self.messages = deque(maxlen=size)
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self.messages)
+
+    def append(self, message):
+        # a single producer, the paho network thread
+        if len(self.messages) == self.messages.maxlen:
+            self.dropped += 1
+        self.messages.append(message)
+
+    def pop_batch(self, batch_size):
+        batch = []
+        try:
+            for _ in range(batch_size):
+                batch.append(self.messages.popleft())
+        except IndexError:
+            pass
+        return batch
+
+
+class ConsumerMetrics:
+    """
+    Counters of a consumer, report() gives the rates since the previous report.
+    """
+
+    def __init__(self, ring):
+        self.ring = ring
+        self.lock = threading.Lock()
+        self.received = 0
+        self.processed = 0
+        self.decode_errors = 0
+        self.handler_errors = 0
+        self.batches = 0
+        # seconds between reception and decoding of the oldest message of the last batch
+        self.lag = 0.
+        self.max_lag = 0.
+        self.last_report = (time.time(), 0, 0)
+
+    def add_handler_error(self):
+        with self.lock:
+            self.handler_errors += 1
+
+    def add_batch(self, processed, decode_errors, lag):
+        with self.lock:
+            self.batches += 1
+            self.processed += processed
+            self.decode_errors += decode_errors
+            self.lag = lag
+            self.max_lag = max(self.max_lag, lag)
+
+    def snapshot(self):
+        """
+        :return: (dict) counters, rates in messages per second and queue depth
+        """
+        now = time.time()
+        with self.lock:
+            last_time, last_received, last_processed = self.last_report
+            elapsed = max(now - last_time, 1e-9)
+            snapshot = {
+                "received": self.received,
+                "processed": self.processed,
+                "dropped": self.ring.dropped,
+                "decode_errors": self.decode_errors,
+                "handler_errors": self.handler_errors,
+                "queued": len(self.ring),
+                "received_rate": (self.received - last_received) / elapsed,
+                "processed_rate": (self.processed - last_processed) / elapsed,
+                "mean_batch_size": self.processed / max(self.batches, 1),
+                "lag": self.lag,
+                "max_lag": self.max_lag
+            }
+            self.last_report = (now, self.received, self.processed)
+            self.max_lag = 0.
+        return snapshot
+
+    def report(self):
+        return ("received: {received} ({received_rate:.1f}/s), processed: {processed} ({processed_rate:.1f}/s), "
+                "queued: {queued}, dropped: {dropped}, errors: {decode_errors}/{handler_errors}, "
+                "batch: {mean_batch_size:.1f}, lag: {lag:.3f}s (max {max_lag:.3f}s)").format(**self.snapshot())
+
+
+class BaseConsumer:
+    """
+    :param client_id: (str) MQTT client id
+    :param topics: ([str]) topic filters
+    :param handler: function called with a list of Message
+    :param decoder: function called with each payload, a message is skipped if it raises
+    :param batch_size: (int) max messages per batch
+    :param queue_size: (int) max messages waiting to be decoded
+    """
+
+    def __init__(self, client_id, topics, handler, decoder=json.loads, batch_size=500, queue_size=100000):
+        self.topics = topics
+        self.handler = handler
+        self.decoder = decoder
+        self.batch_size = batch_size
+        self.ring = MessageRing(queue_size)
+        self.metrics = ConsumerMetrics(self.ring)
+        self.running = True
+
+        self.client = Client(client_id)
+        self.client.on_connect = self.on_connect
+        self.client.on_message = self.on_message
+        self.client.on_subscribe = self.on_subscribe
+        self.client.username_pw_set(username=config.RABBITMQ_USERNAME, password=config.RABBITMQ_PASSWORD)
+
+    def connect(self):
+        self.client.connect_async(config.RABBITMQ_HOST, config.RABBITMQ_PORT, 60)
+        self.client.loop_start()
+
+    def on_connect(self, client, userdata, flags, rc):
+        logging.debug("Connected with result code " + str(rc))
+        for topic in self.topics:
+            self.client.subscribe(topic)
+
+    def on_subscribe(self, client, obj, mid, granted_qos):
+        logging.debug("Subscribed: " + str(mid) + " " + str(granted_qos))
+
+    def on_message(self, client, userdata, msg):
+        # no decoding in the network thread
+        self.ring.append((msg.topic, msg.payload, time.time()))
+        self.metrics.received += 1
+        self.notify()
+
+    def notify(self):
+        raise NotImplementedError
+
+    def next_batch(self):
+        """
+        :return: ([Message]) decoded messages, empty if nothing is queued
+        """
+        raw_batch = self.ring.pop_batch(self.batch_size)
+        if len(raw_batch) == 0:
+            return []
+        lag = time.time() - raw_batch[0][2]
+        batch = []
+        decode_errors = 0
+        for topic, payload, received_at in raw_batch:
+            try:
+                batch.append(Message(topic, payload, self.decoder(payload), received_at))
+            except Exception as e:
+                # a malformed message must not stop the consumer
+                decode_errors += 1
+                logging.debug("Skipping invalid message (%r): %s", e, payload[:100])
+        self.metrics.add_batch(len(batch), decode_errors, lag)
+        return batch
+
+    def disconnect(self):
+        self.client.loop_stop()
+        self.client.disconnect()
+
+
+class BatchConsumer(BaseConsumer):
+    """
+    Process batches on `workers` threads, with more than one worker batches may be handled out of order.
+    A worker waits for a full batch at most `max_wait` seconds, long waits give large batches to handlers
+    which write to disk or to a database.
+
+    :param workers: (int)
+    :param max_wait: (float) seconds
+    """
+
+    def __init__(self, client_id, topics, handler, workers=1, max_wait=0.05, **kwargs):
+        super(BatchConsumer, self).__init__(client_id, topics, handler, **kwargs)
+        self.max_wait = max_wait
+        self.batch_ready = threading.Event()
+        self.workers = [threading.Thread(target=self.update) for _ in range(workers)]
+        for worker in self.workers:
+            worker.start()
+        self.connect()
+
+    def notify(self):
+        if len(self.ring) >= self.batch_size:
+            self.batch_ready.set()
+
+    def update(self):
+        while self.running:
+            self.batch_ready.wait(self.max_wait)
+            self.batch_ready.clear()
+            self.drain()
+        self.drain()
+
+    def drain(self):
+        while True:
+            try:
+                batch = self.next_batch()
+                if len(batch) == 0:
+                    return
+                self.handler(batch)
+            except Exception:
+                # the worker keeps running
+                self.metrics.add_handler_error()
+                logging.exception("Error while handling a batch")
+
+    def stop(self):
+        self.disconnect()
+        self.running = False
+        self.batch_ready.set()
+        for worker in self.workers:
+            worker.join()
+
+
+class AsyncBatchConsumer(BaseConsumer):
+    """
+    Process batches on an asyncio loop, `handler` may be a coroutine function. Start with `await consumer.run()`.
+
+    :param loop: asyncio loop
+    """
+
+    def __init__(self, client_id, topics, handler, loop, **kwargs):
+        super(AsyncBatchConsumer, self).__init__(client_id, topics, handler, **kwargs)
+        self.loop = loop
+        self.message_ready = asyncio.Event()
+        # avoid one call_soon_threadsafe per message
+        self.wakeup_pending = False
+
+    def notify(self):
+        if not self.wakeup_pending:
+            self.wakeup_pending = True
+            self.loop.call_soon_threadsafe(self._wakeup)
+
+    def _wakeup(self):
+        self.wakeup_pending = False
+        self.message_ready.set()
+
+    async def run(self):
+        self.connect()
+        try:
+            while self.running:
+                await self.message_ready.wait()
+                self.message_ready.clear()
+                while True:
+                    try:
+                        batch = self.next_batch()
+                        if len(batch) == 0:
+                            break
+                        result = self.handler(batch)
+                        if asyncio.iscoroutine(result):
+                            await result
+                    except Exception:
+                        # the loop keeps running, the other tasks of the gather are not cancelled
+                        self.metrics.add_handler_error()
+                        logging.exception("Error while handling a batch")
+                    # let the other tasks run between batches
+                    await asyncio.sleep(0)
+        finally:
+            self.disconnect()
+
+    def stop(self):
+        self.running = False
+        self.loop.call_soon_threadsafe(self.message_ready.set)
@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+
+"""
+MQTT telemetry benchmark: simulates a fleet of cars to size the event infrastructure.
+
+Every simulated car publishes metadata and video messages at a fixed rate, built with the
+payload builders of the car (xebikart.parts.mqtt), plus a sequence number and a send time.
+A consumer subscribed to both topics decodes every message, like the backend samples do,
+and measures end-to-end latency, throughput and drops.
+
+    # against the broker of config.py
+    PYTHONPATH=../car-package ./mqtt_benchmark.py --cars 10 --metadata-hz 10 --video-hz 10
+
+    # without broker, to measure the cost of the payloads and of the consumer alone
+    PYTHONPATH=../car-package ./mqtt_benchmark.py --transport fake --cars 50
+"""
+
+import argparse
+import base64
+import heapq
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+
+from paho.mqtt.client import Client, topic_matches_sub
+
+from xebikart.parts.mqtt import metadata_payload, frame_payload
+
+import config
+
+METADATA = "metadata"
+VIDEO = "video"
+
+
+class BrokerTransport:
+    """
+    One MQTT connection per simulated car, like on the real cars, and one for the consumer.
+    """
+
+    def __init__(self, n_cars):
+        self.publishers = [self._client("benchmark-car-%d" % car_id) for car_id in range(n_cars)]
+        self.consumer = None
+
+    @staticmethod
+    def _client(client_id):
+        client = Client(client_id)
+        client.username_pw_set(username=config.RABBITMQ_USERNAME, password=config.RABBITMQ_PASSWORD)
+        client.connect(config.RABBITMQ_HOST, config.RABBITMQ_PORT, 60)
+        client.loop_start()
+        return client
+
+    def subscribe(self, topics, callback):
+        subscribed = threading.Event()
+        self.consumer = self._client("benchmark-consumer")
+        self.consumer.on_message = lambda client, userdata, msg: callback(msg.topic, msg.payload)
+        self.consumer.on_subscribe = lambda client, userdata, mid, granted_qos: subscribed.set()
+        self.consumer.subscribe([(topic, 0) for topic in topics])
+        subscribed.wait(10.)
+
+    def publish(self, car_id, topic, payload):
+        self.publishers[car_id].publish(topic, payload)
+
+    def close(self):
+        for client in self.publishers + [self.consumer]:
+            client.loop_stop()
+            client.disconnect()
+
+
+class FakeTransport:
+    """
+    In-process broker: messages go through a bounded queue to a delivery thread.
+    Messages are dropped, like by a broker, when the consumer does not keep up.
+    """
+
+    def __init__(self, n_cars, max_queued=10000):
+        self.messages = queue.Queue(maxsize=max_queued)
+        self.subscriptions = []
+        self.running = True
+        self.thread = threading.Thread(target=self._deliver, daemon=True)
+        self.thread.start()
+
+    def subscribe(self, topics, callback):
+        self.subscriptions.extend((topic, callback) for topic in topics)
+
+    def publish(self, car_id, topic, payload):
+        try:
+            # paho encodes str payloads
+            self.messages.put_nowait((topic, payload.encode("utf-8")))
+        except queue.Full:
+            pass
+
+    def _deliver(self):
+        while self.running:
+            try:
+                topic, payload = self.messages.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            for subscription, callback in self.subscriptions:
+                if topic_matches_sub(subscription, topic):
+                    callback(topic, payload)
+
+    def close(self):
+        self.running = False
+        self.thread.join()
+
+
+class SimulatedCar:
+    """
+    Realistic metadata: a car driving in circles with lidar borders around it,
+    and video frames with the size of the camera jpeg.
+    """
+
+    def __init__(self, car_id, n_borders, frame_size):
+        self.car_id = car_id
+        self.n_borders = n_borders
+        # random bytes do not compress, base64 gives the same size as a real frame
+        self.frame_base64 = base64.b64encode(os.urandom(frame_size))
+        self.sequences = {METADATA: 0, VIDEO: 0}
+
+    def metadata(self):
+        t = time.time() + self.car_id
+        location = (int(t * 36) % 360, int(2000 + 1000 * random.random()), int(1500 + 800 * random.random()))
+        borders = [[random.randint(-3000, 3000), random.randint(-3000, 3000)] for _ in range(self.n_borders)]
+        payload = metadata_payload(self.car_id, "ai_v2_mode", random.uniform(-1, 1), 0.2, location, borders)
+        return self._stamp(METADATA, payload)
+
+    def frame(self):
+        return self._stamp(VIDEO, frame_payload(self.car_id, self.frame_base64))
+
+    def _stamp(self, kind, payload):
+        self.sequences[kind] += 1
+        payload['seq'] = self.sequences[kind]
+        payload['sent_at'] = time.time()
+        return json.dumps(payload)
+
+
+class Consumer:
+    """
+    Decode every message and keep latency, sequence gaps and volume per kind of message.
+    """
+
+    def __init__(self, topics):
+        self.topics = topics
+        self.lock = threading.Lock()
+        self.latencies = {kind: [] for kind in topics}
+        self.received = {kind: 0 for kind in topics}
+        self.bytes = {kind: 0 for kind in topics}
+        self.reordered = {kind: 0 for kind in topics}
+        self.last_sequences = {}
+
+    def on_message(self, topic, payload):
+        received_at = time.time()
+        message = json.loads(payload)
+        kind = VIDEO if topic == self.topics[VIDEO] else METADATA
+        with self.lock:
+            self.received[kind] += 1
+            self.bytes[kind] += len(payload)
+            self.latencies[kind].append(received_at - message['sent_at'])
+            key = (kind, message['car'])
+            if message['seq'] < self.last_sequences.get(key, 0):
+                self.reordered[kind] += 1
+            self.last_sequences[key] = max(message['seq'], self.last_sequences.get(key, 0))
+
+
+def run(transport, cars, rates, duration, topics):
+    """
+    Publish the messages of all cars from a single scheduler, in send time order.
+
+    :return: number of messages sent per kind
+    """
+    sent = {kind: 0 for kind in rates}
+    start = time.monotonic()
+    # (next send time, car id, kind)
+    schedule = [(start + random.random() / rates[kind], car.car_id, kind)
+                for car in cars for kind in rates if rates[kind] > 0]
+    heapq.heapify(schedule)
+    while len(schedule) > 0:
+        send_time, car_id, kind = heapq.heappop(schedule)
+        if send_time > start + duration:
+            break
+        delay = send_time - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        car = cars[car_id]
+        transport.publish(car_id, topics[kind], car.metadata() if kind == METADATA else car.frame())
+        sent[kind] += 1
+        heapq.heappush(schedule, (send_time + 1. / rates[kind], car_id, kind))
+    return sent
+
+
+def percentile(values, p):
+    if len(values) == 0:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100. * len(values)))]
+
+
+def report(consumer, sent, duration):
+    for kind in sent:
+        received = consumer.received[kind]
+        latencies = consumer.latencies[kind]
+        print("%s:" % kind)
+        print("  sent / received:           %d / %d (drop rate %.2f%%, reordered %d)"
+              % (sent[kind], received, 100. * (sent[kind] - received) / max(sent[kind], 1), consumer.reordered[kind]))
+        print("  throughput:                %.1f msg/s, %.2f MB/s"
+              % (received / duration, consumer.bytes[kind] / duration / 1e6))
+        print("  latency p50/p90/p99/max (ms): %.1f / %.1f / %.1f / %.1f"
+              % tuple(1000. * percentile(latencies, p) for p in (50, 90, 99, 100)))
+
+
+def main(args):
+    topics = {METADATA: config.RABBITMQ_TOPIC, VIDEO: config.RABBITMQ_VIDEO_TOPIC}
+    rates = {METADATA: args.metadata_hz, VIDEO: args.video_hz}
+    if args.transport == "broker":
+        transport = BrokerTransport(args.cars)
+    else:
+        transport = FakeTransport(args.cars)
+    consumer = Consumer(topics)
+    transport.subscribe(list(topics.values()), consumer.on_message)
+
+    cars = [SimulatedCar(car_id, args.borders, args.frame_size) for car_id in range(args.cars)]
+    logging.info("Simulating %d cars for %.0f s", args.cars, args.duration)
+    sent = run(transport, cars, rates, args.duration, topics)
+    # let in flight messages arrive
+    time.sleep(args.drain)
+    transport.close()
+    report(consumer, sent, args.duration)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--transport", choices=["broker", "fake"], default="broker")
+    parser.add_argument("--cars", type=int, default=10)
+    parser.add_argument("--metadata-hz", type=float, default=10.)
+    parser.add_argument("--video-hz", type=float, default=10.)
+    parser.add_argument("--borders", type=int, default=200, help="lidar border points per metadata message")
+    parser.add_argument("--frame-size", type=int, default=6000, help="jpeg frame size in bytes")
+    parser.add_argument("--duration", type=float, default=30.)
+    parser.add_argument("--drain", type=float, default=2., help="seconds to wait for late messages")
+    args = parser.parse_args()
+
+    logging.basicConfig(format=config.LOG_FORMAT, level=logging.INFO, handlers=[logging.StreamHandler()])
+    main(args)
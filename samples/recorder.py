@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+
+"""
+Fleet telemetry recorder: persists the metadata stream of all cars.
+
+Messages are buffered as received and decoded in batches by a writer thread (see consumer.py),
+the full metadata of the cars publishing changes only is rebuilt (MetadataDecoder),
+then appended to one binary file per column:
+
+    <RECORDER_PATH>/car=<id>/session=<start>/
+        time.f8             reception time (seconds since epoch), sorted
+        angle.f4, x.f4, y.f4, user_angle.f4, user_throttle.f4
+        mode.u2             mode code, see modes.json
+        borders_end.i8      end offset of the borders of each row in borders.i4
+        borders.i4          flat x, y pairs
+        index.f8, index.i8  time and row of the first message of each batch
+
+A new session starts for a car when it has not sent anything for RECORDER_SESSION_GAP seconds,
+even within a batch.
+Files are plain arrays, they are read back with memory mapping, see SessionReader.
+
+    PYTHONPATH=../car-package ./recorder.py
+"""
+
+import json
+import logging
+import os
+import time
+
+import numpy as np
+
+from consumer import BatchConsumer, MetadataDecoder
+
+import config
+
+FLOAT_COLUMNS = ("angle", "x", "y", "user_angle", "user_throttle")
+MODE_DTYPE = np.uint16
+
+
+class SessionWriter:
+    """
+    Append-only columnar files of one car session.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.rows = self._count_rows()
+        self.borders_length = os.path.getsize(self._file("borders.i4")) // 4 \
+            if os.path.exists(self._file("borders.i4")) else 0
+        self.modes = {}
+        if os.path.exists(self._file("modes.json")):
+            with open(self._file("modes.json")) as f:
+                self.modes = json.load(f)
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def _count_rows(self):
+        time_path = self._file("time.f8")
+        return os.path.getsize(time_path) // 8 if os.path.exists(time_path) else 0
+
+    def _append(self, name, array):
+        with open(self._file(name), "ab") as f:
+            f.write(array.tobytes())
+
+    def _mode_code(self, mode):
+        if mode not in self.modes:
+            if len(self.modes) > np.iinfo(MODE_DTYPE).max:
+                raise ValueError("Too many modes in session {}".format(self.path))
+            self.modes[mode] = len(self.modes)
+            with open(self._file("modes.json"), "w") as f:
+                json.dump(self.modes, f)
+        return self.modes[mode]
+
+    def write(self, times, rows):
+        """
+        :param times: reception times
+        :param rows: full metadata of the car, see MetadataDecoder
+        """
+        columns = {name: np.full(len(rows), np.nan, dtype=np.float32) for name in FLOAT_COLUMNS}
+        modes = np.empty(len(rows), dtype=MODE_DTYPE)
+        borders_end = np.empty(len(rows), dtype=np.int64)
+        borders = []
+        for i, row in enumerate(rows):
+            position = row.get('position') or {}
+            user = row.get('user') or {}
+            for name, value in (("angle", row.get('angle')),
+                                ("x", position.get('x')),
+                                ("y", position.get('y')),
+                                ("user_angle", user.get('angle')),
+                                ("user_throttle", user.get('throttle'))):
+                if value is not None:
+                    columns[name][i] = value
+            modes[i] = self._mode_code(str(row.get('mode')))
+            borders.extend(row.get('borders') or [])
+            borders_end[i] = self.borders_length + 2 * len(borders)
+
+        self._append("index.f8", np.array([times[0]], dtype=np.float64))
+        self._append("index.i8", np.array([self.rows], dtype=np.int64))
+        for name in FLOAT_COLUMNS:
+            self._append(name + ".f4", columns[name])
+        self._append("mode.u2", modes)
+        self._append("borders.i4", np.array(borders, dtype=np.int32).reshape(-1))
+        self._append("borders_end.i8", borders_end)
+        # time is written last, it gives the number of complete rows
+        self._append("time.f8", np.asarray(times, dtype=np.float64))
+
+        self.rows += len(rows)
+        self.borders_length = int(borders_end[-1])
+
+
+class SessionReader:
+    """
+    Memory mapped view of a recorded session.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.time = self._map("time.f8", np.float64)
+        self.rows = len(self.time)
+        self.index_time = self._map("index.f8", np.float64)
+        self.index_row = self._map("index.i8", np.int64)
+        self.modes = {}
+        if os.path.exists(os.path.join(path, "modes.json")):
+            with open(os.path.join(path, "modes.json")) as f:
+                self.modes = {code: mode for mode, code in json.load(f).items()}
+
+    def _map(self, name, dtype):
+        file_path = os.path.join(self.path, name)
+        if not os.path.exists(file_path) or os.path.getsize(file_path) == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(file_path, dtype=dtype, mode="r")
+
+    def _row_range(self, start_time, end_time):
+        # coarse lookup in the batch index, then exact lookup in the rows of these batches only
+        first_batch = max(np.searchsorted(self.index_time, start_time, side="right") - 1, 0)
+        last_batch = np.searchsorted(self.index_time, end_time, side="right")
+        low = int(self.index_row[first_batch]) if first_batch < len(self.index_row) else self.rows
+        high = int(self.index_row[last_batch]) if last_batch < len(self.index_row) else self.rows
+        times = self.time[low:high]
+        return (low + int(np.searchsorted(times, start_time, side="left")),
+                low + int(np.searchsorted(times, end_time, side="right")))
+
+    def read_range(self, start_time, end_time):
+        """
+        :param start_time: (float) seconds since epoch, included
+        :param end_time: (float) seconds since epoch, included
+        :return: dict of column -> array, borders as a list of (n, 2) arrays
+        """
+        low, high = self._row_range(start_time, end_time)
+        data = {"time": np.array(self.time[low:high])}
+        for name in FLOAT_COLUMNS:
+            data[name] = np.array(self._map(name + ".f4", np.float32)[low:high])
+        if os.path.exists(os.path.join(self.path, "mode.u1")):
+            # sessions recorded with one byte mode codes
+            codes = self._map("mode.u1", np.uint8)
+        else:
+            codes = self._map("mode.u2", MODE_DTYPE)
+        data["mode"] = [self.modes.get(int(code)) for code in codes[low:high]]
+        borders_end = self._map("borders_end.i8", np.int64)
+        borders = self._map("borders.i4", np.int32)
+        start = int(borders_end[low - 1]) if low > 0 else 0
+        data["borders"] = []
+        for end in borders_end[low:high]:
+            data["borders"].append(np.array(borders[start:end]).reshape(-1, 2))
+            start = int(end)
+        return data
+
+
+class Recorder:
+    """
+    :param path: (str) root directory
+    :param batch_size: (int) max messages decoded and written at once
+    :param flush_interval: (float) max seconds between two writes
+    :param session_gap: (float) seconds of silence before a new session starts
+    """
+
+    def __init__(self, path, batch_size=5000, flush_interval=1., session_gap=300.):
+        self.path = path
+        self.session_gap = session_gap
+        # car -> (last reception time, SessionWriter)
+        self.sessions = {}
+        # a single worker, sessions are written and deltas decoded in reception order
+        self.consumer = BatchConsumer("sample-recorder", config.RECORDER_TOPICS, self.write,
+                                      decoder=MetadataDecoder(),
+                                      workers=1, max_wait=flush_interval, batch_size=batch_size)
+
+    def session(self, car, received_at):
+        last_received_at, writer = self.sessions.get(car, (None, None))
+        if writer is None or received_at - last_received_at > self.session_gap:
+            session_name = time.strftime("%Y%m%d-%H%M%S", time.localtime(received_at))
+            writer = SessionWriter(os.path.join(self.path, "car=" + str(car), "session=" + session_name))
+            logging.info("New session for car %s: %s", car, writer.path)
+        return writer
+
+    def write(self, messages):
+        by_car = {}
+        for message in messages:
+            row = message.value
+            if not isinstance(row, dict) or row.get('car') is None:
+                continue
+            times, rows = by_car.setdefault(row['car'], ([], []))
+            times.append(message.received_at)
+            rows.append(row)
+        for car, (times, rows) in by_car.items():
+            # rows of the batch are split where the car has been silent for session_gap
+            start = 0
+            for end in range(1, len(times) + 1):
+                if end < len(times) and times[end] - times[end - 1] <= self.session_gap:
+                    continue
+                writer = self.session(car, times[start])
+                writer.write(times[start:end], rows[start:end])
+                self.sessions[car] = (times[end - 1], writer)
+                start = end
+
+    def stop(self):
+        self.consumer.stop()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format=config.LOG_FORMAT, level=config.LOG_LEVEL, handlers=[logging.StreamHandler()])
+    recorder = Recorder(config.RECORDER_PATH, session_gap=config.RECORDER_SESSION_GAP)
+    try:
+        while True:
+            time.sleep(10)
+            logging.info(recorder.consumer.metrics.report())
+    except KeyboardInterrupt:
+        recorder.stop()
@@ -0,0 +1,166 @@
+"""
+The consumers of the metadata topic rebuild the full metadata of the cars publishing changes only.
+
+    PYTHONPATH=../car-package python -m unittest test_metadata
+"""
+
+import json
+import os
+import random
+import tempfile
+import unittest
+from collections import namedtuple
+
+import numpy as np
+
+from xebikart.parts.mqtt import MetadataChangeDetector, metadata_payload
+
+from api import Broadcaster
+from consumer import BaseConsumer, MetadataDecoder
+from recorder import Recorder, SessionReader, SessionWriter
+
+MQTTMessage = namedtuple("MQTTMessage", ["topic", "payload"])
+
+
+class QueueingConsumer(BaseConsumer):
+    """
+    Consumer without broker, batches are taken with next_batch().
+    """
+
+    def notify(self):
+        pass
+
+
+def metadata_stream(car_id, n_messages, seed=0):
+    """
+    :return: ([dict], [bytes]) full metadata of each cycle, and the payloads published with dead-bands
+    """
+    rng = random.Random(seed)
+    detector = MetadataChangeDetector({"steering": 0.05, "throttle": 0.02, "heading": 2, "position": 20},
+                                      keyframe_interval=1.)
+    borders = [[i, 2 * i] for i in range(50)]
+    steering = 0.
+    full, published = [], []
+    for step in range(n_messages):
+        if step % 5 == 0:
+            borders = [list(point) for point in borders]
+            borders[rng.randrange(len(borders))] = [rng.randint(0, 9999), 1]
+        steering += rng.uniform(-0.1, 0.1)
+        mode = "user" if step < n_messages // 2 else "ai_v2_mode"
+        payload = metadata_payload(car_id, mode, steering, 0.2, (90., 1000., 500. + 10 * step), borders)
+        message = detector.update(payload, step * 0.05)
+        if message is not None:
+            full.append(payload)
+            published.append(json.dumps(message).encode())
+    return full, published
+
+
+class TestMetadataConsumers(unittest.TestCase):
+    def setUp(self):
+        self.full, self.published = metadata_stream(1, 200)
+        # deltas only in the middle of the stream, the keyframes are needed
+        self.assertIn(b'"type": "delta"', self.published[1])
+        self.consumer = QueueingConsumer("test", [], None, decoder=MetadataDecoder(), batch_size=10000)
+        for payload in self.published:
+            self.consumer.on_message(None, None, MQTTMessage("xebikart-events", payload))
+
+    def assertMetadataEqual(self, state, payload):
+        self.assertEqual(state['mode'], payload['mode'])
+        self.assertAlmostEqual(state['user']['angle'], payload['user']['angle'], delta=0.05)
+        self.assertAlmostEqual(state['position']['y'], payload['position']['y'], delta=20)
+        self.assertEqual(sorted(map(tuple, state['borders'])), sorted(map(tuple, payload['borders'])))
+
+    def test_decoder(self):
+        batch = self.consumer.next_batch()
+        self.assertEqual(len(batch), len(self.published))
+        for message, payload in zip(batch, self.full):
+            self.assertMetadataEqual(message.value, payload)
+
+    def test_delta_before_keyframe(self):
+        decoder = MetadataDecoder()
+        with self.assertRaises(ValueError):
+            decoder(self.published[1])
+        # events without car are not metadata, they are kept as is
+        self.assertEqual(decoder(b'{"mode": "user"}'), {"mode": "user"})
+
+    def test_malformed_message(self):
+        def decoder(payload):
+            return json.loads(payload)['mode']
+
+        consumer = QueueingConsumer("test", [], None, decoder=decoder)
+        for payload in (b'{"mode": "user"}', b'{"car": 1}', b'not json', b'{"mode": "ai"}'):
+            consumer.on_message(None, None, MQTTMessage("xebikart-events", payload))
+        self.assertEqual([message.value for message in consumer.next_batch()], ["user", "ai"])
+        self.assertEqual(consumer.metrics.decode_errors, 2)
+
+    def test_keyframe_without_borders(self):
+        decoder = MetadataDecoder()
+        state = decoder(b'{"car": 1, "mode": "user"}')
+        self.assertEqual(state['borders'], [])
+        keyframe = json.loads(self.published[0])
+        keyframe.pop('borders')
+        decoder(json.dumps(keyframe).encode())
+        # deltas apply to the keyframe without borders
+        delta = json.loads(self.published[1])
+        delta['borders'] = {'added': [[1, 2]], 'removed': []}
+        state = decoder(json.dumps(delta).encode())
+        self.assertEqual(state['borders'], [[1, 2]])
+        self.assertEqual(state['mode'], self.full[1]['mode'])
+
+    def test_recorder(self):
+        batch = self.consumer.next_batch()
+        with tempfile.TemporaryDirectory() as path:
+            SessionWriter(path).write([message.received_at for message in batch],
+                                      [message.value for message in batch])
+            data = SessionReader(path).read_range(0., float("inf"))
+        self.assertEqual(len(data["time"]), len(self.full))
+        self.assertEqual(data["mode"], [payload['mode'] for payload in self.full])
+        for borders, payload in zip(data["borders"], self.full):
+            self.assertEqual(sorted(map(tuple, borders.tolist())), sorted(map(tuple, payload['borders'])))
+        np.testing.assert_allclose(data["y"], [payload['position']['y'] for payload in self.full], atol=20)
+
+    def test_recorder_modes(self):
+        rows = [{'car': 1, 'mode': "mode-{}".format(i)} for i in range(300)]
+        with tempfile.TemporaryDirectory() as path:
+            SessionWriter(path).write(list(range(len(rows))), rows)
+            data = SessionReader(path).read_range(0., float("inf"))
+        self.assertEqual(data["mode"], [row['mode'] for row in rows])
+
+    def test_recorder_session_gap(self):
+        Message = namedtuple("Message", ["received_at", "value"])
+        times = [0., 1., 2., 500., 501., 1000.]
+        with tempfile.TemporaryDirectory() as path:
+            # without consumer
+            recorder = Recorder.__new__(Recorder)
+            recorder.path, recorder.session_gap, recorder.sessions = path, 300., {}
+            recorder.write([Message(t, {'car': 1, 'mode': "user"}) for t in times[:5]])
+            recorder.write([Message(times[5], {'car': 1, 'mode': "user"})])
+            sessions = sorted(os.listdir(os.path.join(path, "car=1")))
+            self.assertEqual([len(SessionReader(os.path.join(path, "car=1", session)).time)
+                              for session in sessions], [3, 2, 1])
+
+    def test_api(self):
+        broadcaster = Broadcaster(queue_size=len(self.published))
+        client = broadcaster.register(car="1")
+        broadcaster.publish_batch(self.consumer.next_batch())
+        self.assertEqual(client.queue.qsize(), len(self.full))
+        for payload in self.full:
+            frame = client.queue.get_nowait()
+            self.assertTrue(frame.startswith(b"data: "))
+            self.assertMetadataEqual(json.loads(frame[len(b"data: "):]), payload)
+
+    def test_api_without_car(self):
+        broadcaster = Broadcaster(queue_size=10)
+        all_cars = broadcaster.register()
+        car = broadcaster.register(car="1")
+        consumer = QueueingConsumer("test", [], None, decoder=MetadataDecoder())
+        for payload in (b'{"event": "race started"}', b'["lap", 2]', self.published[0]):
+            consumer.on_message(None, None, MQTTMessage("xebikart-events", payload))
+        broadcaster.publish_batch(consumer.next_batch())
+        self.assertEqual([all_cars.queue.get_nowait() for _ in range(3)][:2],
+                         [b'data: {"event": "race started"}\n\n', b'data: ["lap", 2]\n\n'])
+        self.assertEqual(car.queue.qsize(), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()